@@ -1,10 +1,28 @@
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
 from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterVectorLayer
 from qgis.core import QgsProcessingParameterField
 from qgis.core import QgsProcessingParameterRasterDestination
-import processing
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterFileDestination
+
+import os
+import sys
+# The lithic_* helper modules live next to the scripts.
+_here = os.path.dirname(os.path.abspath(__file__))
+if _here not in sys.path:
+    sys.path.insert(0, _here)
+import lithic_arrays
+import lithic_io
+import lithic_layers
+import lithic_trend
+from lithic_cache import StepCache
+from lithic_pipeline import ModelGraph, Ref
+from lithic_profile import StepProfiler
 
 
 class TrendSurface(QgsProcessingAlgorithm):
@@ -13,163 +31,259 @@ class TrendSurface(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterVectorLayer('perimeter', 'Perimeter', types=[QgsProcessing.TypeVectorLine], defaultValue=None))
         self.addParameter(QgsProcessingParameterVectorLayer('points', 'Points', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
         self.addParameter(QgsProcessingParameterField('zfield', 'Z field', type=QgsProcessingParameterField.Numeric, parentLayerParameterName='points', allowMultiple=False, defaultValue=None))
-        self.addParameter(QgsProcessingParameterRasterDestination('Idw', 'IDW', createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterEnum('engine', 'Engine', options=['SAGA/GDAL child algorithms', 'In-process (NumPy)'], allowMultiple=False, defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('trendsolver', 'Trend surface solver', options=['Natural neighbour (saga:naturalneighbour)', 'Linear, interior cells only', 'Harmonic (multigrid)'], allowMultiple=False, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('tilesize', 'In-process tile size (cells, 0 for whole rasters)', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterBoolean('cache', 'Reuse cached intermediate results', defaultValue=False))
+        self.addParameter(QgsProcessingParameterBoolean('memory', 'Keep intermediate results in memory', defaultValue=False))
+        self.addParameter(QgsProcessingParameterBoolean('profile', 'Profile child algorithms', defaultValue=False))
+        self.addParameter(QgsProcessingParameterRasterDestination('Idw', 'IDW', optional=True, createByDefault=True, defaultValue=None))
         self.addParameter(QgsProcessingParameterRasterDestination('Trend', 'TREND', createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFileDestination('PROFILE', 'PROFILE REPORT', fileFilter='JSON files (*.json)', optional=True, createByDefault=False, defaultValue=None))
 
     def processAlgorithm(self, parameters, context, model_feedback):
-        # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
-        # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(9, model_feedback)
-        results = {}
-        outputs = {}
+        # Profiling measures every child algorithm (time, memory, data sizes); a report file implies it.
+        report = self.parameterAsFileOutput(parameters, 'PROFILE', context)
+        profile = report or self.parameterAsBoolean(parameters, 'profile', context)
+        profiler = StepProfiler(self.name()) if profile else None
 
-        # Convert lines to polygons
-        # The polygon is needed for buffer layer to define  output extent of Inverse-Distance-Weighted Interpolation; 
-        # IDW interpolation must extent beyond the perimeter points in order to be sampled for Z0 trend plane interpolation
-        alg_params = {
-            'LINES': parameters['perimeter'],
-            'POLYGONS': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ConvertLinesToPolygons'] = processing.run('saga:convertlinestopolygons', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        if self.parameterAsEnum(parameters, 'engine', context) == 1:
+            if profiler is None:
+                return self.processInProcess(parameters, context, model_feedback)
+            # The in-process engine is a single array computation, so it is profiled as one step.
+            profiler.start()
+            inputs = [parameters['perimeter'], parameters['points']]
+            with profiler.measure('InProcess', 'lithic_arrays.trend_surface', inputs, context,
+                                  model_feedback) as record:
+                results = record['outputs'] = self.processInProcess(parameters, context, model_feedback)
+            profiler.finish(model_feedback)
+            return self.withProfile(results, profiler, report)
 
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
+        # The child algorithms are collected in a dependency graph, which reports overall progress and can reuse
+        # cached intermediate results from earlier runs.
+        graph = ModelGraph(memory=self.parameterAsBoolean(parameters, 'memory', context))
+        solver = self.parameterAsEnum(parameters, 'trendsolver', context)
+
+        # The IDW raster over the buffered perimeter is only built when its destination is requested.  Otherwise the
+        # IDW is evaluated at the perimeter samples only, a few thousand estimates instead of every cell.
+        idw_raster = bool(self.parameterAsOutputLayer(parameters, 'Idw', context))
+
+        if idw_raster or solver == 0:
+            # Convert lines to polygons
+            # The polygon is needed for buffer layer to define  output extent of Inverse-Distance-Weighted Interpolation; 
+            # IDW interpolation must extent beyond the perimeter points in order to be sampled for Z0 trend plane interpolation
+            alg_params = {
+                'LINES': parameters['perimeter'],
+                'POLYGONS': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ConvertLinesToPolygons', 'saga:convertlinestopolygons', alg_params)
 
         # Convert lines to points
         # Points will be used to sample the IDW surface at the perimeter of the flake.  Point spacing interval is 0.2mm.
-        alg_params = {
-            'ADD         ': True,
-            'DIST': 0.2,
-            'LINES': parameters['perimeter'],
-            'POINTS': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ConvertLinesToPoints'] = processing.run('saga:convertlinestopoints', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        if idw_raster and solver == 0:
+            alg_params = {
+                'ADD         ': True,
+                'DIST': 0.2,
+                'LINES': parameters['perimeter'],
+                'POINTS': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ConvertLinesToPoints', 'saga:convertlinestopoints', alg_params)
 
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
+        if idw_raster:
+            # Buffer
+            # Needed to define  output extent of Inverse-Distance-Weighted Interpolation; 
+            # Interpolation must extent beyond the perimeter points in order to be sampled for Z0 trend plane interpolation
+            alg_params = {
+                'DISSOLVE': False,
+                'DISTANCE': 0.1,
+                'END_CAP_STYLE': 0,
+                'INPUT': Ref('ConvertLinesToPolygons', 'POLYGONS'),
+                'JOIN_STYLE': 0,
+                'MITER_LIMIT': 2,
+                'SEGMENTS': 5,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('Buffer', 'native:buffer', alg_params)
 
-        # Buffer
-        # Needed to define  output extent of Inverse-Distance-Weighted Interpolation; 
-        # Interpolation must extent beyond the perimeter points in order to be sampled for Z0 trend plane interpolation
-        alg_params = {
-            'DISSOLVE': False,
-            'DISTANCE': 0.1,
-            'END_CAP_STYLE': 0,
-            'INPUT': outputs['ConvertLinesToPolygons']['POLYGONS'],
-            'JOIN_STYLE': 0,
-            'MITER_LIMIT': 2,
-            'SEGMENTS': 5,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Buffer'] = processing.run('native:buffer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(3)
-        if feedback.isCanceled():
-            return {}
+            # Inverse distance weighted interpolation
+            # IDW: interpolate flake surface.  IDW used with power = 1.5, resolution = 0.05mm.  Precision is good, and outlying points are negated.
+            alg_params = {
+                'DW_BANDWIDTH': 1,
+                'DW_IDW_OFFSET': False,
+                'DW_IDW_POWER': 1.5,
+                'DW_WEIGHTING': 1,
+                'FIELD': parameters['zfield'],
+                'SEARCH_DIRECTION': 0,
+                'SEARCH_POINTS_ALL': 0,
+                'SEARCH_POINTS_MAX': 20,
+                'SEARCH_POINTS_MIN': -1,
+                'SEARCH_RADIUS': 1000,
+                'SEARCH_RANGE': 0,
+                'SHAPES': parameters['points'],
+                'TARGET_DEFINITION': 0,
+                'TARGET_TEMPLATE': None,
+                'TARGET_USER_FITS': 0,
+                'TARGET_USER_SIZE': 0.05,
+                'TARGET_USER_XMIN TARGET_USER_XMAX TARGET_USER_YMIN TARGET_USER_YMAX': Ref('Buffer', 'OUTPUT'),
+                'TARGET_OUT_GRID': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('InverseDistanceWeightedInterpolation', 'saga:inversedistanceweightedinterpolation', alg_params)
 
-        # Inverse distance weighted interpolation
-        # IDW: interpolate flake surface.  IDW used with power = 1.5, resolution = 0.05mm.  Precision is good, and outlying points are negated.
-        alg_params = {
-            'DW_BANDWIDTH': 1,
-            'DW_IDW_OFFSET': False,
-            'DW_IDW_POWER': 1.5,
-            'DW_WEIGHTING': 1,
-            'FIELD': parameters['zfield'],
-            'SEARCH_DIRECTION': 0,
-            'SEARCH_POINTS_ALL': 0,
-            'SEARCH_POINTS_MAX': 20,
-            'SEARCH_POINTS_MIN': -1,
-            'SEARCH_RADIUS': 1000,
-            'SEARCH_RANGE': 0,
-            'SHAPES': parameters['points'],
-            'TARGET_DEFINITION': 0,
-            'TARGET_TEMPLATE': None,
-            'TARGET_USER_FITS': 0,
-            'TARGET_USER_SIZE': 0.05,
-            'TARGET_USER_XMIN TARGET_USER_XMAX TARGET_USER_YMIN TARGET_USER_YMAX': outputs['Buffer']['OUTPUT'],
-            'TARGET_OUT_GRID': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['InverseDistanceWeightedInterpolation'] = processing.run('saga:inversedistanceweightedinterpolation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(4)
-        if feedback.isCanceled():
-            return {}
+            # Translate (convert format)
+            # SAGA raster output in QGIS 3.X defaults to SGRID and must be changed to TIF in order to be used and exported successfully. It's a pain in the ass and I wish I could fix it.
+            alg_params = {
+                'COPY_SUBDATASETS': False,
+                'DATA_TYPE': 0,
+                'INPUT': Ref('InverseDistanceWeightedInterpolation', 'TARGET_OUT_GRID'),
+                'NODATA': None,
+                'OPTIONS': '',
+                'TARGET_CRS': None,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('TranslateConvertFormat', 'gdal:translate', alg_params)
 
-        # Translate (convert format)
-        # SAGA raster output in QGIS 3.X defaults to SGRID and must be changed to TIF in order to be used and exported successfully. It's a pain in the ass and I wish I could fix it.
-        alg_params = {
-            'COPY_SUBDATASETS': False,
-            'DATA_TYPE': 0,
-            'INPUT': outputs['InverseDistanceWeightedInterpolation']['TARGET_OUT_GRID'],
-            'NODATA': None,
-            'OPTIONS': '',
-            'TARGET_CRS': None,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['TranslateConvertFormat'] = processing.run('gdal:translate', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(5)
-        if feedback.isCanceled():
-            return {}
+            # Clip raster with polygon
+            # Clip the IDW surface and export it.  Exporting makes it easy to check that the IDW surface was currectly interpolated. (Compare with the real artifact)
+            alg_params = {
+                'INPUT': Ref('InverseDistanceWeightedInterpolation', 'TARGET_OUT_GRID'),
+                'POLYGONS': Ref('ConvertLinesToPolygons', 'POLYGONS'),
+                'OUTPUT': parameters['Idw']
+            }
+            graph.add('ClipRasterWithPolygon', 'saga:cliprasterwithpolygon', alg_params, result='Idw')
 
-        # Add raster values to points
-        # Points created along perimeter line sample Z values from IDW surface.
-        alg_params = {
-            'GRIDS': outputs['TranslateConvertFormat']['OUTPUT'],
-            'RESAMPLING': 0,
-            'SHAPES': outputs['ConvertLinesToPoints']['POINTS'],
-            'RESULT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['AddRasterValuesToPoints'] = processing.run('saga:addrastervaluestopoints', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(6)
-        if feedback.isCanceled():
-            return {}
+        if solver == 0:
+            if idw_raster:
+                # Add raster values to points
+                # Points created along perimeter line sample Z values from IDW surface.
+                alg_params = {
+                    'GRIDS': Ref('TranslateConvertFormat', 'OUTPUT'),
+                    'RESAMPLING': 0,
+                    'SHAPES': Ref('ConvertLinesToPoints', 'POINTS'),
+                    'RESULT': QgsProcessing.TEMPORARY_OUTPUT
+                }
+                graph.add('AddRasterValuesToPoints', 'saga:addrastervaluestopoints', alg_params)
+                samples = Ref('AddRasterValuesToPoints', 'RESULT')
+            else:
+                # Perimeter samples
+                # Without the IDW raster, the IDW is evaluated in-process at the 0.2mm perimeter points only.
+                alg_params = {
+                    'CELLSIZE': 0.05,
+                    'FIELD': parameters['zfield'],
+                    'PERIMETER': parameters['perimeter'],
+                    'POINTS': parameters['points'],
+                    'SPACING': 0.2,
+                    'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+                }
+                graph.add_stage('PerimeterSamples', lithic_trend.perimeter_samples_stage, alg_params)
+                samples = Ref('PerimeterSamples', 'OUTPUT')
+
+            # Natural neighbour
+            # Z0 "trend" surface is interpolated between perimeter points.
+            alg_params = {
+                'FIELD': parameters['zfield'],
+                'METHOD': 0,
+                'SHAPES': samples,
+                'TARGET_TEMPLATE': None,
+                'TARGET_USER_FITS': 0,
+                'TARGET_USER_SIZE': 0.05,
+                'TARGET_USER_XMIN TARGET_USER_XMAX TARGET_USER_YMIN TARGET_USER_YMAX': None,
+                'WEIGHT': 0,
+                'TARGET_OUT_GRID': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('NaturalNeighbour', 'saga:naturalneighbour', alg_params)
+
+            # Clip raster with polygon
+            # Natural Neighbour surface (Z0 "trend" surface) is clipped and exported to "Trend".
+            alg_params = {
+                'INPUT': Ref('NaturalNeighbour', 'TARGET_OUT_GRID'),
+                'POLYGONS': Ref('ConvertLinesToPolygons', 'POLYGONS'),
+                'OUTPUT': parameters['Trend']
+            }
+            graph.add('ClipRasterWithPolygonTrend', 'saga:cliprasterwithpolygon', alg_params, result='Trend')
+        else:
+            # Trend surface solver
+            # The perimeter samples and the Z0 "trend" surface in one in-process step, computed on the cells inside the
+            # perimeter only: linear on the samples' triangulation, or harmonic with the perimeter as boundary.
+            alg_params = {
+                'CELLSIZE': 0.05,
+                'METHOD': lithic_arrays.TREND_METHODS[solver - 1],
+                'PERIMETER': parameters['perimeter'],
+                'SPACING': 0.2,
+                'OUTPUT': self.parameterAsOutputLayer(parameters, 'Trend', context)
+            }
+            if idw_raster:
+                alg_params['SURFACE'] = Ref('TranslateConvertFormat', 'OUTPUT')
+            else:
+                alg_params.update({'FIELD': parameters['zfield'], 'POINTS': parameters['points']})
+            graph.add_stage('TrendSolver', lithic_trend.trend_stage, alg_params, result='Trend')
+        cache = StepCache() if self.parameterAsBoolean(parameters, 'cache', context) else None
+        return self.withProfile(graph.run(context, model_feedback, cache=cache, profiler=profiler), profiler, report)
+
+    def withProfile(self, results, profiler, report):
+        if profiler is not None and report:
+            results['PROFILE'] = profiler.write(report)
+        return results
+
+    def processInProcess(self, parameters, context, model_feedback):
+        # Same chain as processAlgorithm, but kept in memory as arrays: perimeter rasterization, IDW, perimeter sampling,
+        # trend surface and clipping.  Only the final IDW and TREND rasters are written to disk.
+        feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
+        results = {}
+        solver = self.parameterAsEnum(parameters, 'trendsolver', context)
+        if not solver:
+            # Natural neighbour is SAGA's; quietly interpolating linearly instead would give another surface.
+            raise QgsProcessingException('The in-process engine has no natural neighbour solver; choose the linear or '
+                                         'harmonic trend surface solver, or the SAGA/GDAL engine')
 
-        # Clip raster with polygon
-        # Clip the IDW surface and export it.  Exporting makes it easy to check that the IDW surface was currectly interpolated. (Compare with the real artifact)
-        alg_params = {
-            'INPUT': outputs['InverseDistanceWeightedInterpolation']['TARGET_OUT_GRID'],
-            'POLYGONS': outputs['ConvertLinesToPolygons']['POLYGONS'],
-            'OUTPUT': parameters['Idw']
-        }
-        outputs['ClipRasterWithPolygon'] = processing.run('saga:cliprasterwithpolygon', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['Idw'] = outputs['ClipRasterWithPolygon']['OUTPUT']
-
-        feedback.setCurrentStep(7)
+        perimeter = self.parameterAsVectorLayer(parameters, 'perimeter', context)
+        points = self.parameterAsVectorLayer(parameters, 'points', context)
+        zfield = self.parameterAsString(parameters, 'zfield', context)
+        lines = lithic_layers.line_parts(perimeter)
+        xy, z = lithic_layers.point_values(points, zfield)
+        if not len(z):
+            raise QgsProcessingException('The points layer has no points with a numeric {} value'.format(zfield))
+        feedback.pushInfo('{} perimeter part(s), {} surface points'.format(len(lines), len(z)))
+
+        crs = points.crs().toWkt()
+        method = lithic_arrays.TREND_METHODS[solver - 1]
+        tile = self.parameterAsInt(parameters, 'tilesize', context)
+        idw_path = self.parameterAsOutputLayer(parameters, 'Idw', context)
+        trend_path = self.parameterAsOutputLayer(parameters, 'Trend', context)
+
+        feedback.setCurrentStep(1)
         if feedback.isCanceled():
             return {}
 
-        # Natural neighbour
-        # Z0 "trend" surface is interpolated between perimeter points.
-        alg_params = {
-            'FIELD': parameters['zfield'],
-            'METHOD': 0,
-            'SHAPES': outputs['AddRasterValuesToPoints']['RESULT'],
-            'TARGET_TEMPLATE': None,
-            'TARGET_USER_FITS': 0,
-            'TARGET_USER_SIZE': 0.05,
-            'TARGET_USER_XMIN TARGET_USER_XMAX TARGET_USER_YMIN TARGET_USER_YMAX': None,
-            'WEIGHT': 0,
-            'TARGET_OUT_GRID': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['NaturalNeighbour'] = processing.run('saga:naturalneighbour', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(8)
+        if tile:
+            # Large rasters are estimated and written one tile at a time, so memory does not grow with the raster.
+            # IDW tiles are only evaluated when they are written.
+            idw_grid, idw_tiles, trend_grid, trend_tiles = lithic_arrays.trend_surface_tiles(
+                lines, xy, z, tile=tile, method=method)
+
+            feedback.setCurrentStep(2)
+            if feedback.isCanceled():
+                return {}
+
+            if idw_path:
+                results['Idw'] = lithic_io.write_tiles(idw_path, idw_grid, idw_tiles, crs)
+                if feedback.isCanceled():
+                    return {}
+            if trend_path:
+                results['Trend'] = lithic_io.write_tiles(trend_path, trend_grid, trend_tiles, crs)
+            return results
+
+        # Without an IDW destination, the IDW is only evaluated at the perimeter samples.
+        idw_grid, idw, trend_grid, trend = lithic_arrays.trend_surface(lines, xy, z, method=method,
+                                                                       idw_raster=bool(idw_path))
+
+        feedback.setCurrentStep(2)
         if feedback.isCanceled():
             return {}
 
-        # Clip raster with polygon
-        # Natural Neighbour surface (Z0 "trend" surface) is clipped and exported to "Trend".
-        alg_params = {
-            'INPUT': outputs['NaturalNeighbour']['TARGET_OUT_GRID'],
-            'POLYGONS': outputs['ConvertLinesToPolygons']['POLYGONS'],
-            'OUTPUT': parameters['Trend']
-        }
-        outputs['ClipRasterWithPolygon'] = processing.run('saga:cliprasterwithpolygon', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['Trend'] = outputs['ClipRasterWithPolygon']['OUTPUT']
+        if idw_path:
+            results['Idw'] = lithic_io.write_raster(idw_path, idw_grid, idw, crs)
+        if trend_path:
+            results['Trend'] = lithic_io.write_raster(trend_path, trend_grid, trend, crs)
         return results
 
     def name(self):
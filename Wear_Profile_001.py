@@ -0,0 +1,122 @@
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingMultiStepFeedback
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterRasterLayer
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsProcessingParameterVectorLayer
+
+import csv
+import os
+import sys
+# The lithic_* helper modules live next to the scripts.
+_here = os.path.dirname(os.path.abspath(__file__))
+if _here not in sys.path:
+    sys.path.insert(0, _here)
+import lithic_arrays
+import lithic_io
+import lithic_layers
+
+# Laid out as MB_all_wear.csv, with the row name R's write.csv adds as the first, unnamed column, but the measures are
+# lithic_arrays.wear_profile's: loss in mm3 and loss as a percentage of the reconstructed volume, pooled and per face
+# (D dorsal, V ventral).  They are not that table's volume and index, so they have names of their own and are not
+# meant to be pooled with it.
+COLUMNS = ['', 'POS_mm', 'RghtLft', 'SECTION', 'loss', 'loss D', 'loss V', 'loss pct', 'loss pct D', 'loss pct V',
+           'mb', 'set', 'src', 'position']
+
+
+class WearProfile(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterRasterLayer('lithicsurface', 'Worn dorsal surface', defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterLayer('wornventralsurface', 'Worn ventral surface', defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterLayer('dorsalreconstruction', 'Dorsal reconstruction', defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterLayer('ventralreconstruction', 'Ventral reconstruction', defaultValue=None))
+        self.addParameter(QgsProcessingParameterVectorLayer('perimeter', 'Perimeter', types=[QgsProcessing.TypeVectorLine], defaultValue=None))
+        self.addParameter(QgsProcessingParameterVectorLayer('platformspolygon', 'Platform(s) [polygon]', types=[QgsProcessing.TypeVectorPolygon], defaultValue=None))
+        self.addParameter(QgsProcessingParameterString('mb', 'Microblade (mb)', defaultValue='MB11'))
+        self.addParameter(QgsProcessingParameterNumber('set', 'Experimental set', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('binsize', 'Profile interval (mm)', type=QgsProcessingParameterNumber.Double, minValue=0.001, defaultValue=0.1))
+        self.addParameter(QgsProcessingParameterBoolean('append', 'Append to an existing table', defaultValue=False))
+        self.addParameter(QgsProcessingParameterFileDestination('OUTPUT', 'WEAR PROFILE', fileFilter='CSV files (*.csv)', createByDefault=True, defaultValue=None))
+
+    def processAlgorithm(self, parameters, context, model_feedback):
+        # Missing volume is the reconstruction minus the worn surface, cell by cell, binned along the left and right
+        # edges from the distal end.  The end of the long axis nearer the platform polygon(s) is proximal.
+        feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
+
+        perimeter = self.parameterAsVectorLayer(parameters, 'perimeter', context)
+        lines = lithic_layers.line_parts(perimeter)
+        if not lines:
+            raise QgsProcessingException('The perimeter layer has no lines')
+        ring = max(lines, key=len)
+        proximal = self.parameterAsVectorLayer(parameters, 'platformspolygon', context).extent().center()
+
+        faces = []
+        for worn_name, reconstruction_name in [('lithicsurface', 'dorsalreconstruction'),
+                                               ('wornventralsurface', 'ventralreconstruction')]:
+            worn_path = self.parameterAsRasterLayer(parameters, worn_name, context).source()
+            reconstruction_path = self.parameterAsRasterLayer(parameters, reconstruction_name, context).source()
+            # Both surfaces on the worn surface's cells, grown to cover the reconstruction.
+            grid, worn = lithic_io.read_raster(worn_path)
+            grid, worn = lithic_arrays.extend_grid(grid, worn, *lithic_io.raster_bounds(reconstruction_path))
+            faces.append((grid, worn, lithic_io.read_raster_on(reconstruction_path, grid)))
+        feedback.setCurrentStep(1)
+        if feedback.isCanceled():
+            return {}
+
+        profile = lithic_arrays.wear_profile(faces, ring, (proximal.x(), proximal.y()),
+                                             self.parameterAsDouble(parameters, 'binsize', context))
+        feedback.pushInfo('{} profile rows, {:.6g} mm3 missing'.format(len(profile['side']), profile['loss'].sum()))
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return {}
+
+        path = self.parameterAsFileOutput(parameters, 'OUTPUT', context)
+        append = self.parameterAsBool(parameters, 'append', context) and os.path.isfile(path)
+        first = 1
+        if append:
+            with open(path, newline='') as f:
+                reader = csv.DictReader(f)
+                if reader.fieldnames != COLUMNS:
+                    raise QgsProcessingException('{} has other columns than a wear profile table ({}); not appending '
+                                                 'to it'.format(path, ', '.join(reader.fieldnames or [])))
+                first = max((int(row['']) for row in reader if row[''].isdigit()), default=0) + 1
+        mb = self.parameterAsString(parameters, 'mb', context)
+        number = self.parameterAsInt(parameters, 'set', context)
+        src = '{}-{}'.format(mb, number)
+        with open(path, 'a' if append else 'w', newline='') as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+            if not append:
+                writer.writerow(COLUMNS)
+            for row in range(len(profile['side'])):
+                side = lithic_arrays.WEAR_SIDES[profile['side'][row]]
+                section = lithic_arrays.WEAR_SECTIONS[profile['section'][row]]
+                dorsal, ventral = profile['face loss'][row]
+                percent_dorsal, percent_ventral = profile['face loss pct'][row]
+                writer.writerow([
+                    str(first + row), float(profile['position'][row]), side, section,
+                    float('{:.8g}'.format(profile['loss'][row])), float('{:.8g}'.format(dorsal)),
+                    float('{:.8g}'.format(ventral)), round(float(profile['loss pct'][row]), 4),
+                    round(float(percent_dorsal), 4), round(float(percent_ventral), 4), mb, number, src,
+                    '{} {}'.format(side, section),
+                ])
+        return {'OUTPUT': path}
+
+    def name(self):
+        return 'wear profile'
+
+    def displayName(self):
+        return 'wear profile'
+
+    def group(self):
+        return 'lithic analysis'
+
+    def groupId(self):
+        return 'lithic analysis'
+
+    def createInstance(self):
+        return WearProfile()
@@ -0,0 +1,367 @@
+"""
+Benchmarks for TrendSurface and EdgeFromProjection04 on synthetic microblades.
+
+    python benchmarks/run_benchmarks.py --sizes 10,20 --repeat 3 --save-baseline baseline.json
+    python benchmarks/run_benchmarks.py --sizes 10,20 --repeat 3 --baseline baseline.json --threshold 0.25
+
+Each size is a blade length in mm (the width is 0.3 of it) at --cellsize resolution; see synthetic.py.  Every stage of
+the in-process pipelines is timed on its own (best of --repeat runs): the trend surface (whole, tiled, trend only
+and harmonic), the density peaks, edge line, edge point overlays and scar clip, the infill (whole, tiled and preview),
+footprint and TIN reconstructions, the wear profile and the wear aggregation.  Each stage also records a few check
+values of its output (cell counts and sums).  With --qgis, both algorithms also run end to end in a headless QGIS with
+each engine; that needs QGIS and GDAL, everything else needs only NumPy and SciPy.
+
+Against a --baseline, a stage fails when it is more than --threshold slower (and slower by more than --min-seconds,
+so the shortest stages do not fail on noise) or when its check values differ by more than --tolerance.  With or
+without a baseline, the raster mask infill fails when it fills any cell differently from the alpha hull infill.  The
+exit status is 1 when any stage fails.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+if HERE not in sys.path:
+    sys.path.insert(0, HERE)
+import synthetic
+import lithic_aggregate
+import lithic_arrays
+
+# The 'Expected flake scar length (mm)' default of EdgeFromProjection04.
+SCAR_LENGTH = 0.8
+ALPHA = 0.275
+# Check value of stages that must agree with another stage cell for cell; anything but 0 fails.
+UNLIKE = 'cells unlike infill'
+# Blades and sets of the synthetic wear table: every profile row is repeated for each of them.
+BLADES = 40
+SETS = 10
+
+
+def _checks(grid, values):
+    finite = np.isfinite(values)
+    return {'cells': int(finite.sum()), 'sum': float(np.sum(values[finite]) * grid.cellsize ** 2)}
+
+
+def _tile_checks(grid, tiles):
+    cells = 0
+    total = 0.0
+    for _, _, values in tiles:
+        finite = np.isfinite(values)
+        cells += int(finite.sum())
+        total += float(np.sum(values[finite]))
+    return {'cells': cells, 'sum': total * grid.cellsize ** 2}
+
+
+def clipped_surface(data, line, scar_length=SCAR_LENGTH):
+    """
+    The worn dorsal DEM clipped the way EdgeFromProjection04 clips it: cells within the scar length of the edge line
+    and cells outside it have no data.  Returns the surface and the Z=0 edge points along the line.
+    """
+    grid = data['grid']
+    ring = lithic_arrays.close_ring(line)
+    edge = lithic_arrays.densify_line(ring, grid.cellsize)
+    inside = lithic_arrays.rasterize_polygons([ring], grid)
+    distance, _ = cKDTree(edge).query(grid.centres())
+    keep = inside & (distance.reshape(grid.shape) > scar_length)
+    return np.where(keep, data['dorsal'], np.nan), edge, np.zeros(len(edge))
+
+
+def wear_table(profile):
+    """
+    A table shaped like MB_all_wear.csv, as lithic_store.read_csv returns it, with BLADES x SETS copies of one
+    profile's loss and loss percentages in the volume and index columns.  Only its size and groups matter.
+    """
+    rows = len(profile['side'])
+    copies = BLADES * SETS
+    mb = np.repeat(['MB{}'.format(blade + 1) for blade in range(BLADES)], SETS * rows).astype(object)
+    number = np.tile(np.repeat(np.arange(1, SETS + 1), rows), BLADES)
+    side = np.array(lithic_arrays.WEAR_SIDES, dtype=object)[profile['side']]
+    section = np.array(lithic_arrays.WEAR_SECTIONS, dtype=object)[profile['section']]
+    scale = np.repeat(np.linspace(0.5, 1.5, copies), rows)
+    return {
+        'row': np.arange(1, copies * rows + 1),
+        'POS_mm': np.tile(profile['position'], copies),
+        'RghtLft': np.tile(side, copies),
+        'SECTION': np.tile(section, copies),
+        'position': np.tile(side + ' ' + section, copies),
+        'volume': np.tile(profile['loss'], copies) * scale,
+        'volume D': np.tile(profile['face loss'][:, 0], copies) * scale,
+        'volume V': np.tile(profile['face loss'][:, 1], copies) * scale,
+        'index': np.tile(profile['loss pct'], copies) * scale,
+        'index D': np.tile(profile['face loss pct'][:, 0], copies) * scale,
+        'index V': np.tile(profile['face loss pct'][:, 1], copies) * scale,
+        'mb': mb,
+        'set': number,
+        'src': np.array(['{}-{}'.format(m, n) for m, n in zip(mb, number)], dtype=object),
+    }
+
+
+def array_stages(data):
+    """
+    The in-process stages in pipeline order, as (name, function) pairs.  Each function returns its check values;
+    later stages use what earlier ones left in `state`.
+    """
+    state = {}
+    grid = data['grid']
+    perimeter = [data['perimeter']]
+
+    def trend():
+        idw_grid, idw, trend_grid, trend = lithic_arrays.trend_surface(perimeter, data['surface xy'], data['surface z'])
+        checks = {'idw ' + key: value for key, value in _checks(idw_grid, idw).items()}
+        checks.update(('trend ' + key, value) for key, value in _checks(trend_grid, trend).items())
+        return checks
+
+    def trend_only():
+        _, _, trend_grid, trend = lithic_arrays.trend_surface(perimeter, data['surface xy'], data['surface z'],
+                                                              idw_raster=False)
+        return {'trend ' + key: value for key, value in _checks(trend_grid, trend).items()}
+
+    def trend_harmonic():
+        _, _, trend_grid, trend = lithic_arrays.trend_surface(perimeter, data['surface xy'], data['surface z'],
+                                                              method='harmonic')
+        return {'trend ' + key: value for key, value in _checks(trend_grid, trend).items()}
+
+    def trend_tiles():
+        idw_grid, idw, trend_grid, trend = lithic_arrays.trend_surface_tiles(perimeter, data['surface xy'],
+                                                                             data['surface z'], tile=256)
+        checks = {'idw ' + key: value for key, value in _tile_checks(idw_grid, idw).items()}
+        checks.update(('trend ' + key, value) for key, value in _tile_checks(trend_grid, trend).items())
+        return checks
+
+    def peaks():
+        state['peaks'], z = lithic_arrays.density_peaks(data['projected'])
+        return {'peaks': len(z)}
+
+    def edge():
+        state['line'], state['segments'] = lithic_arrays.polar_edge(state['peaks'],
+                                                                    lithic_arrays.line_centroid(perimeter))
+        return {'vertices': len(state['line']), 'segments': len(state['segments'])}
+
+    def edge_points():
+        edge_xy = np.vstack([lithic_arrays.points_along(line, 0.2) for line in state['segments']])
+        perimeter_xy = np.vstack([lithic_arrays.points_along(line, 0.2) for line in perimeter])
+        outside_platforms = ~lithic_arrays.PolygonIndex([[data['platform']]]).contains(edge_xy)
+        worn = lithic_arrays.PolygonIndex([[lithic_arrays.close_ring(line)] for line in perimeter])
+        kept = ~lithic_arrays.PolygonIndex([[lithic_arrays.close_ring(state['line'])]]).contains(perimeter_xy)
+        outside = outside_platforms & ~worn.contains(edge_xy)
+        return {'edge points': int(outside.sum()), 'perimeter points': int(kept.sum())}
+
+    def clip():
+        state['surface'], state['xy'], state['z'] = clipped_surface(data, state['line'])
+        return {'cells': int(np.isfinite(state['surface']).sum()), 'edge points': len(state['z'])}
+
+    def infill():
+        filled_grid, state['filled'] = lithic_arrays.infill(grid, state['surface'], state['xy'], state['z'], ALPHA)
+        return _checks(filled_grid, state['filled'])
+
+    def infill_mask():
+        filled_grid, filled = lithic_arrays.infill(grid, state['surface'], state['xy'], state['z'], ALPHA, 'mask')
+        # The raster mask hull must cover the same cells as the alpha hull, with the same values.
+        unlike = ~np.isclose(filled, state['filled'], rtol=0, atol=1e-9, equal_nan=True)
+        return dict(_checks(filled_grid, filled), **{UNLIKE: int(unlike.sum())})
+
+    def infill_tiles():
+        surface_grid, surface = grid, state['surface']
+
+        def read(block):
+            # Surface values on a block of the (extended) output grid, NaN beyond the surface.
+            values = np.full(block.shape, np.nan)
+            rows, cols, inside = surface_grid.cell_index(block.centres())
+            values.ravel()[inside] = surface[rows[inside], cols[inside]]
+            return values
+
+        filled_grid, tiles = lithic_arrays.infill_tiles(read, grid, state['xy'], state['z'], ALPHA, tile=256)
+        return _tile_checks(filled_grid, tiles)
+
+    def infill_preview():
+        coarse_grid, coarse = lithic_arrays.pyramid(grid, state['surface'])[-1]
+        return _checks(*lithic_arrays.infill(coarse_grid, coarse, state['xy'], state['z'], ALPHA))
+
+    def footprint():
+        _, mask = lithic_arrays.footprint(grid, state['surface'], state['xy'], state['z'], ALPHA)
+        return {'cells': int(mask.sum())}
+
+    def tin():
+        tin_grid, surface = lithic_arrays.tin_reconstruction(grid, state['surface'], state['xy'], state['z'], ALPHA)
+        return _checks(tin_grid, surface)
+
+    def profile():
+        faces = [(grid, data['dorsal'], data['dorsal reconstruction']),
+                 (grid, data['ventral'], data['ventral reconstruction'])]
+        proximal = data['platform'][:-1].mean(axis=0)
+        state['profile'] = lithic_arrays.wear_profile(faces, data['perimeter'], proximal)
+        state['table'] = wear_table(state['profile'])
+        return {'rows': len(state['profile']['side']), 'volume': float(state['profile']['loss'].sum())}
+
+    def aggregate():
+        table = lithic_aggregate.wear_agg(state['table'])
+        return {'groups': len(table['src']), 'vol.sum': float(np.sum(table['vol.sum']))}
+
+    def aggregate_add():
+        aggregate = lithic_aggregate.WearAggregate()
+        aggregate.add(state['table'])
+        return {'groups': len(aggregate.groups), 'blades': len(aggregate.blades)}
+
+    return [
+        ('trend_surface', trend),
+        ('trend_surface_tiles', trend_tiles),
+        ('trend_surface_trend_only', trend_only),
+        ('trend_surface_harmonic', trend_harmonic),
+        ('density_peaks', peaks),
+        ('polar_edge', edge),
+        ('edge_points', edge_points),
+        ('scar_clip', clip),
+        ('infill', infill),
+        ('infill_mask', infill_mask),
+        ('infill_tiles', infill_tiles),
+        ('infill_preview', infill_preview),
+        ('footprint', footprint),
+        ('tin_reconstruction', tin),
+        ('wear_profile', profile),
+        ('wear_agg', aggregate),
+        ('wear_aggregate_add', aggregate_add),
+    ]
+
+
+def qgis_stages(data, folder):
+    """Both algorithms end to end in a headless QGIS, with each engine, for all their outputs and for one."""
+    import lithic_batch
+    import lithic_io
+
+    edge, trend = synthetic.write_specimen(data, folder)
+    lithic_batch.start_qgis()
+    import processing
+    from qgis.core import QgsProcessingContext, QgsProcessingFeedback
+
+    def run(class_name, parameters, outputs):
+        def stage():
+            result = processing.run(lithic_batch.algorithm_id(class_name), parameters, context=QgsProcessingContext(),
+                                    feedback=QgsProcessingFeedback())
+            checks = {}
+            for output in outputs:
+                grid, values = lithic_io.read_raster(result[output])
+                checks.update((output + ' ' + key, value) for key, value in _checks(grid, values).items())
+            return checks
+        return stage
+
+    stages = []
+    for engine, label in [(0, 'saga'), (1, 'numpy')]:
+        stages.append(('qgis_trend_surface_' + label,
+                       run('TrendSurface', dict(trend, engine=engine), ['Idw', 'Trend'])))
+        stages.append(('qgis_edge_from_projection_' + label,
+                       run('EdgeFromProjection04', dict(edge, engine=engine, reconstruction=1, threads=1),
+                           ['DorsalReconstruction', 'VentralReconstruction'])))
+        # One output only: the graphs skip the branches of the other.
+        stages.append(('qgis_trend_surface_trend_only_' + label,
+                       run('TrendSurface', dict(trend, engine=engine, Idw=None), ['Trend'])))
+        stages.append(('qgis_edge_from_projection_dorsal_only_' + label,
+                       run('EdgeFromProjection04', dict(edge, engine=engine, reconstruction=1, threads=1,
+                                                        VentralReconstruction=None), ['DorsalReconstruction'])))
+    return stages
+
+
+def time_stages(stages, repeat, log=print):
+    """Run each stage `repeat` times.  Returns {stage: {'seconds': best time, 'checks': check values}}."""
+    results = {}
+    for name, stage in stages:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            checks = stage()
+            times.append(time.perf_counter() - start)
+        results[name] = {'seconds': min(times), 'checks': checks}
+        log('  {:<32} {:9.3f} s  {}'.format(name, min(times), ', '.join(
+            '{} {:.6g}'.format(key, value) for key, value in checks.items())))
+    return results
+
+
+def compare(results, baseline, threshold, min_seconds, tolerance):
+    """Failures of `results` against `baseline`, as messages."""
+    failures = []
+    for size, stages in results.items():
+        for name, result in stages.items():
+            reference = baseline.get(size, {}).get(name)
+            if reference is None:
+                continue
+            limit = reference['seconds'] * (1 + threshold)
+            if result['seconds'] > limit and result['seconds'] - reference['seconds'] > min_seconds:
+                failures.append('{} {}: {:.3f} s, baseline {:.3f} s (+{:.0%})'.format(
+                    size, name, result['seconds'], reference['seconds'],
+                    result['seconds'] / reference['seconds'] - 1))
+            for key, expected in reference['checks'].items():
+                value = result['checks'].get(key)
+                if value is None or not np.isclose(value, expected, rtol=tolerance, atol=0):
+                    failures.append('{} {}: {} is {}, baseline {}'.format(size, name, key, value, expected))
+    return failures
+
+
+def disagreements(results):
+    """Stages whose output differs from the stage it must agree with, as messages."""
+    return ['{} {}: {} {}'.format(size, name, result['checks'][UNLIKE], UNLIKE)
+            for size, stages in results.items() for name, result in stages.items()
+            if result['checks'].get(UNLIKE)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10,20', help='blade lengths in mm, comma separated (default 10,20)')
+    parser.add_argument('--cellsize', type=float, default=0.02, help='DEM cell size in mm (default 0.02)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage; the best time counts (default 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--qgis', action='store_true', help='also run both algorithms end to end in QGIS')
+    parser.add_argument('--baseline', help='baseline JSON to compare with')
+    parser.add_argument('--save-baseline', help='write the results as a baseline JSON')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown (default 0.25, 25%%)')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='slowdowns smaller than this never fail (default 0.05 s)')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='relative tolerance of check values')
+    args = parser.parse_args(argv)
+
+    print('{} {}, Python {}, NumPy {}'.format(platform.system(), platform.machine(), platform.python_version(),
+                                              np.__version__))
+    results = {}
+    for length in [float(size) for size in args.sizes.split(',')]:
+        size = '{:g}mm@{:g}'.format(length, args.cellsize)
+        start = time.perf_counter()
+        data = synthetic.specimen(length, 0.3 * length, args.cellsize, points=int(10000 * length),
+                                  surface_points=int(1000 * length), seed=args.seed)
+        print('{}: {} x {} cells, {} projected points, generated in {:.2f} s'.format(
+            size, data['grid'].ncols, data['grid'].nrows, len(data['projected']), time.perf_counter() - start))
+        stages = array_stages(data)
+        if args.qgis:
+            try:
+                import qgis.core  # noqa: F401
+            except ImportError:
+                print('  QGIS is not importable; end-to-end runs skipped')
+            else:
+                stages += qgis_stages(data, tempfile.mkdtemp(prefix='lithic_benchmark_'))
+        results[size] = time_stages(stages, args.repeat)
+
+    failures = disagreements(results)
+    for failure in failures:
+        print('MISMATCH ' + failure)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Baseline written to {}'.format(args.save_baseline))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_seconds, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if not regressions:
+            print('No regressions against {}'.format(args.baseline))
+        failures += regressions
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Synthetic microblades for the benchmarks: DEMs, perimeter, platform, projected points and surface points.
+
+A specimen is a blade of `length` x `width` mm with pointed ends, lying along the y axis with its proximal end up.  The
+dorsal surface has a central arris and the ventral surface is a shallow dome, both at `cellsize` resolution and
+falling to Z=0 at the original edge.  Wear removes a band of varying width along both edges: the worn surfaces have no
+data there and the perimeter line follows the worn edge.  The projected points scatter around the original edge, where
+EdgeFromProjection04 should find it again.  Everything is generated from a seed, so runs are repeatable.
+"""
+import os
+import sys
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+if os.path.dirname(HERE) not in sys.path:
+    sys.path.insert(0, os.path.dirname(HERE))
+import lithic_arrays
+
+
+def outline(length, width, wear=0.0, vertices=400, seed=0):
+    """
+    Closed blade outline: half width w(y) = width / 2 * sin(pi * t) ** 0.6 along t = y / length, pulled in by a wear
+    band that varies along the edge (at most `wear` mm).
+    """
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, vertices // 2 + 1)
+    half = width / 2 * np.sin(np.pi * t) ** 0.6
+    phase = rng.uniform(0, 2 * np.pi, 2)
+    band = wear * (0.5 + 0.5 * np.sin(2 * np.pi * 3 * t[None, :] + phase[:, None])) * np.sin(np.pi * t) ** 0.5
+    right = np.column_stack([np.maximum(half - band[0], 0), t * length])
+    left = np.column_stack([-np.maximum(half - band[1], 0), t * length])[::-1]
+    return lithic_arrays.close_ring(np.vstack([right[:-1], left[:-1]]))
+
+
+def specimen(length=20.0, width=6.0, cellsize=0.02, thickness=1.5, wear=0.3, points=200000, surface_points=20000,
+             seed=0):
+    """One synthetic microblade as arrays (see the module docstring)."""
+    rng = np.random.default_rng(seed)
+    edge = outline(length, width, 0.0, seed=seed)
+    perimeter = outline(length, width, wear, seed=seed)
+    margin = 1.0
+    grid = lithic_arrays.Grid.fit_nodes(-width / 2 - margin, -margin, width / 2 + margin, length + margin, cellsize)
+
+    # Heights above Z=0 at the original edge: a ridge (arris) on the dorsal face, a dome on the ventral one.
+    x, y = np.meshgrid(grid.x_centres(), grid.y_centres())
+    t = np.clip(y / length, 0, 1)
+    half = np.maximum(width / 2 * np.sin(np.pi * t) ** 0.6, 1e-9)
+    across = np.clip(1 - np.abs(x) / half, 0, None)
+    inside_edge = lithic_arrays.rasterize_polygons([edge], grid)
+    dorsal = thickness * across ** 0.8 * np.sin(np.pi * t) ** 0.3
+    dorsal += rng.normal(0, thickness * 0.002, grid.shape)
+    ventral = thickness * 0.3 * across ** 2 * np.sin(np.pi * t) ** 0.3
+    worn = lithic_arrays.rasterize_polygons([perimeter], grid)
+    dorsal_worn = np.where(worn & inside_edge, dorsal, np.nan)
+    ventral_worn = np.where(worn & inside_edge, ventral, np.nan)
+
+    # Projected points scatter around the original edge, denser than anywhere else.
+    along = rng.integers(0, len(edge) - 1, points)
+    fraction = rng.random(points)[:, None]
+    projected = edge[along] + fraction * (edge[along + 1] - edge[along]) + rng.normal(0, 0.08, (points, 2))
+
+    # Surface points for TrendSurface: a sample of the dorsal surface with its heights.
+    rows, cols = np.nonzero(np.isfinite(dorsal_worn))
+    pick = rng.choice(len(rows), min(surface_points, len(rows)), replace=False)
+    surface_xy = np.column_stack([grid.x_centres()[cols[pick]], grid.y_centres()[rows[pick]]])
+
+    platform = np.array([[-width / 4, length - 1.0], [width / 4, length - 1.0], [width / 4, length + margin],
+                         [-width / 4, length + margin], [-width / 4, length - 1.0]])
+    return {
+        'grid': grid,
+        'dorsal': dorsal_worn,
+        'ventral': ventral_worn,
+        'dorsal reconstruction': np.where(inside_edge, dorsal, np.nan),
+        'ventral reconstruction': np.where(inside_edge, ventral, np.nan),
+        'edge': edge,
+        'perimeter': perimeter,
+        'platform': platform,
+        'projected': projected,
+        'surface xy': surface_xy,
+        'surface z': dorsal_worn[rows[pick], cols[pick]],
+    }
+
+
+def write_specimen(data, folder):
+    """
+    Write a specimen as the inputs of the QGIS algorithms (GeoTIFFs and shapefiles, needs GDAL).  Returns the
+    parameters for EdgeFromProjection04 and TrendSurface.
+    """
+    from osgeo import ogr
+    import lithic_io
+
+    os.makedirs(folder, exist_ok=True)
+    paths = {}
+    for name in ['dorsal', 'ventral', 'dorsal reconstruction', 'ventral reconstruction']:
+        paths[name] = lithic_io.write_raster(os.path.join(folder, name.replace(' ', '_') + '.tif'), data['grid'],
+                                             data[name])
+
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+
+    def write(name, geometry_type, geometries, fields=None):
+        path = os.path.join(folder, name + '.shp')
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        source = driver.CreateDataSource(path)
+        layer = source.CreateLayer(name, None, geometry_type)
+        for field in fields or {}:
+            layer.CreateField(ogr.FieldDefn(field, ogr.OFTReal))
+        definition = layer.GetLayerDefn()
+        for index, wkt in enumerate(geometries):
+            feature = ogr.Feature(definition)
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+            for field, values in (fields or {}).items():
+                feature.SetField(field, float(values[index]))
+            layer.CreateFeature(feature)
+        source = None
+        return path
+
+    def coords(xy):
+        return ', '.join('{} {}'.format(x, y) for x, y in xy)
+
+    paths['perimeter'] = write('perimeter', ogr.wkbLineString, ['LINESTRING ({})'.format(coords(data['perimeter']))])
+    paths['platform'] = write('platform', ogr.wkbPolygon, ['POLYGON (({}))'.format(coords(data['platform']))])
+    paths['projected'] = write('projected', ogr.wkbPoint, ['POINT ({} {})'.format(x, y) for x, y in data['projected']])
+    paths['surface'] = write('surface', ogr.wkbPoint, ['POINT ({} {})'.format(x, y) for x, y in data['surface xy']],
+                             {'Z': data['surface z']})
+    edge = {
+        'lithicsurface': paths['dorsal'],
+        'wornventralsurface': paths['ventral'],
+        'perimeter': paths['perimeter'],
+        'platformspolygon': paths['platform'],
+        'projectedpoints': paths['projected'],
+        'DorsalReconstruction': os.path.join(folder, 'out_dorsal_reconstruction.tif'),
+        'VentralReconstruction': os.path.join(folder, 'out_ventral_reconstruction.tif'),
+    }
+    trend = {
+        'perimeter': paths['perimeter'],
+        'points': paths['surface'],
+        'zfield': 'Z',
+        'Idw': os.path.join(folder, 'out_idw.tif'),
+        'Trend': os.path.join(folder, 'out_trend.tif'),
+    }
+    return edge, trend
@@ -1,11 +1,28 @@
 from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
-from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterNumber
 from qgis.core import QgsProcessingParameterRasterLayer
 from qgis.core import QgsProcessingParameterVectorLayer
 from qgis.core import QgsProcessingParameterRasterDestination
-import processing
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterBoolean
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingParameterString
+from qgis.core import QgsProcessingException
+
+import os
+import re
+import sys
+# The lithic_* helper modules live next to the scripts.
+_here = os.path.dirname(os.path.abspath(__file__))
+if _here not in sys.path:
+    sys.path.insert(0, _here)
+from lithic_cache import StepCache
+from lithic_pipeline import ModelGraph, Ref
+from lithic_profile import StepProfiler
+import lithic_edge
+
+FACES = ['Dorsal', 'Ventral']
 
 
 class EdgeFromProjection04(QgsProcessingAlgorithm):
@@ -17,15 +34,29 @@ class EdgeFromProjection04(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterVectorLayer('platformspolygon', 'Platform(s) [polygon]', types=[QgsProcessing.TypeVectorPolygon], defaultValue=None))
         self.addParameter(QgsProcessingParameterVectorLayer('projectedpoints', 'Projected points', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
         self.addParameter(QgsProcessingParameterRasterLayer('wornventralsurface', 'Worn ventral surface', defaultValue=None))
-        self.addParameter(QgsProcessingParameterRasterDestination('DorsalReconstruction', 'DORSAL RECONSTRUCTION', createByDefault=True, defaultValue=None))
-        self.addParameter(QgsProcessingParameterRasterDestination('VentralReconstruction', 'VENTRAL RECONSTRUCTION', createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterEnum('engine', 'Engine', options=['SAGA/GDAL child algorithms', 'In-process (NumPy)'], allowMultiple=False, defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('reconstruction', 'Reconstruction', options=['TIN from pixel points (gdal:gridlinear)', 'Raster infill'], allowMultiple=False, defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('footprint', 'Output footprint', options=['Concave hull (alpha shapes)', 'Raster mask'], allowMultiple=False, defaultValue=0))
+        self.addParameter(QgsProcessingParameterBoolean('progressive', 'Progressive raster infill: quick coarse preview, then the full resolution infill', defaultValue=False))
+        self.addParameter(QgsProcessingParameterNumber('tilesize', 'Raster infill tile size (cells, 0 for whole rasters)', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('threads', 'Concurrent child algorithms', type=QgsProcessingParameterNumber.Integer, minValue=1, maxValue=16, defaultValue=1))
+        self.addParameter(QgsProcessingParameterString('sweep', 'Scar length sweep (mm, comma separated; empty for a single run)', optional=True, defaultValue=''))
+        self.addParameter(QgsProcessingParameterEnum('sweepoutput', 'Sweep output', options=['Multi-band stack', 'One raster per scar length'], allowMultiple=False, defaultValue=0))
+        self.addParameter(QgsProcessingParameterBoolean('cache', 'Reuse cached intermediate results', defaultValue=False))
+        self.addParameter(QgsProcessingParameterBoolean('memory', 'Keep intermediate results in memory', defaultValue=False))
+        self.addParameter(QgsProcessingParameterBoolean('profile', 'Profile child algorithms', defaultValue=False))
+        self.addParameter(QgsProcessingParameterRasterDestination('DorsalReconstruction', 'DORSAL RECONSTRUCTION', optional=True, createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('VentralReconstruction', 'VENTRAL RECONSTRUCTION', optional=True, createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('DorsalPreview', 'DORSAL PREVIEW', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('VentralPreview', 'VENTRAL PREVIEW', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFileDestination('PROFILE', 'PROFILE REPORT', fileFilter='JSON files (*.json)', optional=True, createByDefault=False, defaultValue=None))
 
     def processAlgorithm(self, parameters, context, model_feedback):
-        # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
-        # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(42, model_feedback)
-        results = {}
-        outputs = {}
+        # The model is built as a dependency graph rather than run line by line, so independent steps (the DORSAL and
+        # VENTRAL branches after Difference SAMPLE v PROJECTED) can run concurrently.  The graph turns child algorithm
+        # progress into overall progress for the model.  In memory mode only the model's destinations touch the disk.
+        graph = ModelGraph(memory=self.parameterAsBoolean(parameters, 'memory', context))
+        engine = self.parameterAsEnum(parameters, 'engine', context)
 
         # Translate (convert format) DUMMY VENTRAL
         # This is to change the name of the input layer to the default layer name 'OUTPUT'.  QGIS scripts involving Refactor Fields and Field Calculator need predictable layer names.
@@ -38,24 +69,7 @@ class EdgeFromProjection04(QgsProcessingAlgorithm):
             'TARGET_CRS': None,
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['TranslateConvertFormatDummyVentral'] = processing.run('gdal:translate', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
-
-        # Centroids
-        # Creates the PERIM centroid for hub lines.
-        alg_params = {
-            'ALL_PARTS': False,
-            'INPUT': parameters['perimeter'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Centroids'] = processing.run('native:centroids', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
+        graph.add('TranslateConvertFormatDummyVentral', 'gdal:translate', alg_params)
 
         # Convert lines to polygons PERIM
         # Converts the perimeter line to a polygon so it can merge with the cluster-based perimeter polygon
@@ -63,45 +77,7 @@ class EdgeFromProjection04(QgsProcessingAlgorithm):
             'LINES': parameters['perimeter'],
             'POLYGONS': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['ConvertLinesToPolygonsPerim'] = processing.run('saga:convertlinestopolygons', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(3)
-        if feedback.isCanceled():
-            return {}
-
-        # Heatmap (Kernel Density Estimation)
-        # Quantify density of extrapolated points
-        alg_params = {
-            'DECAY': 0,
-            'INPUT': parameters['projectedpoints'],
-            'KERNEL': 0,
-            'OUTPUT_VALUE': 0,
-            'PIXEL_SIZE': 0.1,
-            'RADIUS': 0.5,
-            'RADIUS_FIELD': None,
-            'WEIGHT_FIELD': None,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['HeatmapKernelDensityEstimation'] = processing.run('qgis:heatmapkerneldensityestimation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(4)
-        if feedback.isCanceled():
-            return {}
-
-        # Points along geometry PERIM
-        # Creates points along the perimeter for sections not recorded by the cluster-generated points (i.e. proximal/distal ends)
-        alg_params = {
-            'DISTANCE': 0.2,
-            'END_OFFSET': 0,
-            'INPUT': parameters['perimeter'],
-            'START_OFFSET': 0,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['PointsAlongGeometryPerim'] = processing.run('qgis:pointsalonglines', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(5)
-        if feedback.isCanceled():
-            return {}
+        graph.add('ConvertLinesToPolygonsPerim', 'saga:convertlinestopolygons', alg_params)
 
         # Translate DUMMY DEM
         # Changes DEM name, as above
@@ -114,339 +90,428 @@ class EdgeFromProjection04(QgsProcessingAlgorithm):
             'TARGET_CRS': 'ProjectCrs',
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['TranslateDummyDem'] = processing.run('gdal:translate', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(6)
-        if feedback.isCanceled():
-            return {}
-
-        # Local minima and maxima
-        # Finds the peak densities in the heatmap
-        alg_params = {
-            'GRID': outputs['HeatmapKernelDensityEstimation']['OUTPUT'],
-            'MAXIMA': QgsProcessing.TEMPORARY_OUTPUT,
-            'MINIMA': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['LocalMinimaAndMaxima'] = processing.run('saga:localminimaandmaxima', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(7)
-        if feedback.isCanceled():
-            return {}
-
-        # Extract by expression
-        # Extracts density peaks that are above the mean density value.
-        alg_params = {
-            'EXPRESSION': '\"Z\"  > mean(\"Z\")',
-            'INPUT': outputs['LocalMinimaAndMaxima']['MAXIMA'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ExtractByExpression'] = processing.run('native:extractbyexpression', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(8)
-        if feedback.isCanceled():
-            return {}
-
-        # Field calculator DUMMY ID
-        # Adds a dummy ID column to the density points layer for hub line generation
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'ID',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '1',
-            'INPUT': outputs['ExtractByExpression']['OUTPUT'],
-            'NEW_FIELD': True,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FieldCalculatorDummyId'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(9)
-        if feedback.isCanceled():
-            return {}
-
-        # Join by lines (hub lines)
-        # Connects centroid to density points by hub lines.  
-        alg_params = {
-            'ANTIMERIDIAN_SPLIT': False,
-            'GEODESIC': False,
-            'GEODESIC_DISTANCE': 1000,
-            'HUBS': outputs['Centroids']['OUTPUT'],
-            'HUB_FIELD': 'local_idx',
-            'HUB_FIELDS': None,
-            'SPOKES': outputs['FieldCalculatorDummyId']['OUTPUT'],
-            'SPOKE_FIELD': 'ID',
-            'SPOKE_FIELDS': None,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['JoinByLinesHubLines'] = processing.run('native:hublines', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(10)
-        if feedback.isCanceled():
-            return {}
-
-        # Field calculator AZIMUTH
-        # Gives points azimuth value so the edge line is drawn in the correct order.
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'AZIMUTH',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': 'azimuth(start_point($geometry),end_point($geometry))',
-            'INPUT': outputs['JoinByLinesHubLines']['OUTPUT'],
-            'NEW_FIELD': True,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FieldCalculatorAzimuth'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(11)
-        if feedback.isCanceled():
-            return {}
-
-        # Extract vertices
-        alg_params = {
-            'INPUT': outputs['FieldCalculatorAzimuth']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ExtractVertices'] = processing.run('native:extractvertices', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(12)
-        if feedback.isCanceled():
-            return {}
-
-        # Extract by location
-        # Extracts aximuth line vertices where they patch the density points.
-        alg_params = {
-            'INPUT': outputs['ExtractVertices']['OUTPUT'],
-            'INTERSECT': outputs['ExtractByExpression']['OUTPUT'],
-            'PREDICATE': 0,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ExtractByLocation'] = processing.run('native:extractbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(13)
-        if feedback.isCanceled():
-            return {}
-
-        # Field calculator DUMMY Z
-        # Adds 0 Z value to ordered density points.
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'Z',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '0',
-            'INPUT': outputs['ExtractByLocation']['OUTPUT'],
-            'NEW_FIELD': False,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FieldCalculatorDummyZ'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(14)
-        if feedback.isCanceled():
-            return {}
-
-        # Points to path
-        # Draws edge line along the density points, in azimuth order.
-        alg_params = {
-            'DATE_FORMAT': '',
-            'GROUP_FIELD': None,
-            'INPUT': outputs['FieldCalculatorDummyZ']['OUTPUT'],
-            'ORDER_FIELD': 'AZIMUTH',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['PointsToPath'] = processing.run('qgis:pointstopath', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(15)
-        if feedback.isCanceled():
-            return {}
-
-        # Explode lines
-        # I forget why this happens, but it's needed.
-        alg_params = {
-            'INPUT': outputs['PointsToPath']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ExplodeLines'] = processing.run('native:explodelines', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(16)
-        if feedback.isCanceled():
-            return {}
-
-        # Convert lines to polygons NEWEDGE
-        # Creates a polygon from the newly drawn edge line.
-        alg_params = {
-            'LINES': outputs['PointsToPath']['OUTPUT'],
-            'POLYGONS': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ConvertLinesToPolygonsNewedge'] = processing.run('saga:convertlinestopolygons', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(17)
-        if feedback.isCanceled():
-            return {}
-
-        # Extract by expression DROP CROSSLINES
-        # This relates to the Explode Lines, but it was a while ago.
-        alg_params = {
-            'EXPRESSION': '$length < maximum($length)',
-            'INPUT': outputs['ExplodeLines']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ExtractByExpressionDropCrosslines'] = processing.run('native:extractbyexpression', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(18)
-        if feedback.isCanceled():
-            return {}
-
-        # Difference PERIM PTS
-        # Isolates points generated along the worn perimeter that fall outside the new perimeter polygon.
-        alg_params = {
-            'INPUT': outputs['PointsAlongGeometryPerim']['OUTPUT'],
-            'OVERLAY': outputs['ConvertLinesToPolygonsNewedge']['POLYGONS'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['DifferencePerimPts'] = processing.run('native:difference', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(19)
-        if feedback.isCanceled():
-            return {}
-
-        # Points along geometry
-        # Create points along the new edge lines
-        alg_params = {
-            'DISTANCE': 0.2,
-            'END_OFFSET': 0,
-            'INPUT': outputs['ExtractByExpressionDropCrosslines']['OUTPUT'],
-            'START_OFFSET': 0,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['PointsAlongGeometry'] = processing.run('qgis:pointsalonglines', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(20)
-        if feedback.isCanceled():
-            return {}
-
-        # Field calculator DUMMY Z
-        # Adds dummy Z value for interpolation.  I feel like it might be redundant, but IF IT AIN'T BROKE...
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'Z',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '0',
-            'INPUT': outputs['PointsAlongGeometry']['OUTPUT'],
-            'NEW_FIELD': False,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FieldCalculatorDummyZ'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(21)
-        if feedback.isCanceled():
-            return {}
-
-        # Field calculator PERIM PTS
-        # Adds another dummy Z value.
-        alg_params = {
-            'FIELD_LENGTH': 10,
-            'FIELD_NAME': 'Z',
-            'FIELD_PRECISION': 3,
-            'FIELD_TYPE': 0,
-            'FORMULA': '0',
-            'INPUT': outputs['DifferencePerimPts']['OUTPUT'],
-            'NEW_FIELD': True,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FieldCalculatorPerimPts'] = processing.run('qgis:fieldcalculator', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(22)
-        if feedback.isCanceled():
-            return {}
-
-        # Difference PLATFORMS
-        # Polygons that mark striking platform and/or distal edge cut out Z=0 points
-        alg_params = {
-            'INPUT': outputs['FieldCalculatorDummyZ']['OUTPUT'],
-            'OVERLAY': parameters['platformspolygon'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['DifferencePlatforms'] = processing.run('native:difference', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(23)
-        if feedback.isCanceled():
-            return {}
+        graph.add('TranslateDummyDem', 'gdal:translate', alg_params)
+
+        # Density peaks and edge line
+        # The in-process engine replaces the heatmap, local maxima and above-the-mean filter with one stage on arrays, and
+        # the hub line / azimuth chain that orders the peaks into the edge line with another.  The child algorithm chain
+        # is in the else branch.
+        if engine == 1:
+            alg_params = {
+                'INPUT': parameters['projectedpoints'],
+                'PIXEL_SIZE': 0.1,
+                'RADIUS': 0.5,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT,
+                'PEAKS': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add_stage('DensityPeaks', lithic_edge.density_peaks_stage, alg_params)
+
+            # Polar edge
+            # Orders the density peaks by azimuth around the perimeter centroid, draws the edge line and its polygon, and
+            # drops the crossline, all in one stage.
+            alg_params = {
+                'PEAKS': Ref('DensityPeaks', 'PEAKS'),
+                'PERIMETER': parameters['perimeter'],
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT,
+                'POLYGONS': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add_stage('PolarEdge', lithic_edge.polar_edge_stage, alg_params)
+            new_edge_polygon = Ref('PolarEdge', 'POLYGONS')
+            edge_lines = Ref('PolarEdge', 'OUTPUT')
+        else:
+            # Centroids
+            # Creates the PERIM centroid for hub lines.
+            alg_params = {
+                'ALL_PARTS': False,
+                'INPUT': parameters['perimeter'],
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('Centroids', 'native:centroids', alg_params)
+
+            # Heatmap (Kernel Density Estimation)
+            # Quantify density of extrapolated points
+            alg_params = {
+                'DECAY': 0,
+                'INPUT': parameters['projectedpoints'],
+                'KERNEL': 0,
+                'OUTPUT_VALUE': 0,
+                'PIXEL_SIZE': 0.1,
+                'RADIUS': 0.5,
+                'RADIUS_FIELD': None,
+                'WEIGHT_FIELD': None,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('HeatmapKernelDensityEstimation', 'qgis:heatmapkerneldensityestimation', alg_params)
+
+            # Local minima and maxima
+            # Finds the peak densities in the heatmap
+            alg_params = {
+                'GRID': Ref('HeatmapKernelDensityEstimation', 'OUTPUT'),
+                'MAXIMA': QgsProcessing.TEMPORARY_OUTPUT,
+                'MINIMA': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('LocalMinimaAndMaxima', 'saga:localminimaandmaxima', alg_params)
+
+            # Extract by expression
+            # Extracts density peaks that are above the mean density value.
+            alg_params = {
+                'EXPRESSION': '\"Z\"  > mean(\"Z\")',
+                'INPUT': Ref('LocalMinimaAndMaxima', 'MAXIMA'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ExtractByExpression', 'native:extractbyexpression', alg_params)
+
+            # Field calculator DUMMY ID
+            # Adds a dummy ID column to the density points layer for hub line generation
+            alg_params = {
+                'FIELD_LENGTH': 10,
+                'FIELD_NAME': 'ID',
+                'FIELD_PRECISION': 3,
+                'FIELD_TYPE': 0,
+                'FORMULA': '1',
+                'INPUT': Ref('ExtractByExpression', 'OUTPUT'),
+                'NEW_FIELD': True,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('FieldCalculatorDummyId', 'qgis:fieldcalculator', alg_params)
+
+            # Join by lines (hub lines)
+            # Connects centroid to density points by hub lines.  
+            alg_params = {
+                'ANTIMERIDIAN_SPLIT': False,
+                'GEODESIC': False,
+                'GEODESIC_DISTANCE': 1000,
+                'HUBS': Ref('Centroids', 'OUTPUT'),
+                'HUB_FIELD': 'local_idx',
+                'HUB_FIELDS': None,
+                'SPOKES': Ref('FieldCalculatorDummyId', 'OUTPUT'),
+                'SPOKE_FIELD': 'ID',
+                'SPOKE_FIELDS': None,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('JoinByLinesHubLines', 'native:hublines', alg_params)
+
+            # Field calculator AZIMUTH
+            # Gives points azimuth value so the edge line is drawn in the correct order.
+            alg_params = {
+                'FIELD_LENGTH': 10,
+                'FIELD_NAME': 'AZIMUTH',
+                'FIELD_PRECISION': 3,
+                'FIELD_TYPE': 0,
+                'FORMULA': 'azimuth(start_point($geometry),end_point($geometry))',
+                'INPUT': Ref('JoinByLinesHubLines', 'OUTPUT'),
+                'NEW_FIELD': True,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('FieldCalculatorAzimuth', 'qgis:fieldcalculator', alg_params)
+
+            # Extract vertices
+            alg_params = {
+                'INPUT': Ref('FieldCalculatorAzimuth', 'OUTPUT'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ExtractVertices', 'native:extractvertices', alg_params)
+
+            # Extract by location
+            # Extracts aximuth line vertices where they patch the density points.
+            alg_params = {
+                'INPUT': Ref('ExtractVertices', 'OUTPUT'),
+                'INTERSECT': Ref('ExtractByExpression', 'OUTPUT'),
+                'PREDICATE': 0,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ExtractByLocation', 'native:extractbylocation', alg_params)
+
+            # Field calculator DUMMY Z
+            # Adds 0 Z value to ordered density points.
+            alg_params = {
+                'FIELD_LENGTH': 10,
+                'FIELD_NAME': 'Z',
+                'FIELD_PRECISION': 3,
+                'FIELD_TYPE': 0,
+                'FORMULA': '0',
+                'INPUT': Ref('ExtractByLocation', 'OUTPUT'),
+                'NEW_FIELD': False,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('FieldCalculatorDummyZOrdered', 'qgis:fieldcalculator', alg_params)
+
+            # Points to path
+            # Draws edge line along the density points, in azimuth order.
+            alg_params = {
+                'DATE_FORMAT': '',
+                'GROUP_FIELD': None,
+                'INPUT': Ref('FieldCalculatorDummyZOrdered', 'OUTPUT'),
+                'ORDER_FIELD': 'AZIMUTH',
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('PointsToPath', 'qgis:pointstopath', alg_params)
+
+            # Explode lines
+            # I forget why this happens, but it's needed.
+            alg_params = {
+                'INPUT': Ref('PointsToPath', 'OUTPUT'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ExplodeLines', 'native:explodelines', alg_params)
+
+            # Convert lines to polygons NEWEDGE
+            # Creates a polygon from the newly drawn edge line.
+            alg_params = {
+                'LINES': Ref('PointsToPath', 'OUTPUT'),
+                'POLYGONS': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ConvertLinesToPolygonsNewedge', 'saga:convertlinestopolygons', alg_params)
+
+            # Extract by expression DROP CROSSLINES
+            # This relates to the Explode Lines, but it was a while ago.
+            alg_params = {
+                'EXPRESSION': '$length < maximum($length)',
+                'INPUT': Ref('ExplodeLines', 'OUTPUT'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ExtractByExpressionDropCrosslines', 'native:extractbyexpression', alg_params)
+            new_edge_polygon = Ref('ConvertLinesToPolygonsNewedge', 'POLYGONS')
+            edge_lines = Ref('ExtractByExpressionDropCrosslines', 'OUTPUT')
+
+        # Edge points
+        # The in-process engine makes the Z=0 points along the new edge and the perimeter and tests them against the
+        # new edge, platform and perimeter polygons in one stage, each polygon prepared once, instead of building a
+        # point layer per difference, field calculator and refactor.  The child algorithm chain is in the else branch.
+        if engine == 1:
+            alg_params = {
+                'EDGE': edge_lines,
+                'NEW_EDGE': new_edge_polygon,
+                'PERIMETER': parameters['perimeter'],
+                'PLATFORMS': parameters['platformspolygon'],
+                'SPACING': 0.2,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT,
+                'PERIMETER_POINTS': QgsProcessing.TEMPORARY_OUTPUT,
+                'OUTSIDE_PLATFORMS': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add_stage('EdgePoints', lithic_edge.edge_points_stage, alg_params)
+            points = {
+                'Edge': Ref('EdgePoints', 'OUTPUT'),
+                'PerimPts': Ref('EdgePoints', 'PERIMETER_POINTS'),
+                'Platforms': Ref('EdgePoints', 'OUTSIDE_PLATFORMS')
+            }
+        else:
+            # Points along geometry PERIM
+            # Creates points along the perimeter for sections not recorded by the cluster-generated points (i.e. proximal/distal ends)
+            alg_params = {
+                'DISTANCE': 0.2,
+                'END_OFFSET': 0,
+                'INPUT': parameters['perimeter'],
+                'START_OFFSET': 0,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('PointsAlongGeometryPerim', 'qgis:pointsalonglines', alg_params)
+
+            # Difference PERIM PTS
+            # Isolates points generated along the worn perimeter that fall outside the new perimeter polygon.
+            alg_params = {
+                'INPUT': Ref('PointsAlongGeometryPerim', 'OUTPUT'),
+                'OVERLAY': new_edge_polygon,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('DifferencePerimPts', 'native:difference', alg_params)
+
+            # Points along geometry
+            # Create points along the new edge lines
+            alg_params = {
+                'DISTANCE': 0.2,
+                'END_OFFSET': 0,
+                'INPUT': edge_lines,
+                'START_OFFSET': 0,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('PointsAlongGeometry', 'qgis:pointsalonglines', alg_params)
+
+            # Field calculator DUMMY Z
+            # Adds dummy Z value for interpolation.  I feel like it might be redundant, but IF IT AIN'T BROKE...
+            alg_params = {
+                'FIELD_LENGTH': 10,
+                'FIELD_NAME': 'Z',
+                'FIELD_PRECISION': 3,
+                'FIELD_TYPE': 0,
+                'FORMULA': '0',
+                'INPUT': Ref('PointsAlongGeometry', 'OUTPUT'),
+                'NEW_FIELD': False,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('FieldCalculatorDummyZ', 'qgis:fieldcalculator', alg_params)
+
+            # Field calculator PERIM PTS
+            # Adds another dummy Z value.
+            alg_params = {
+                'FIELD_LENGTH': 10,
+                'FIELD_NAME': 'Z',
+                'FIELD_PRECISION': 3,
+                'FIELD_TYPE': 0,
+                'FORMULA': '0',
+                'INPUT': Ref('DifferencePerimPts', 'OUTPUT'),
+                'NEW_FIELD': True,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('FieldCalculatorPerimPts', 'qgis:fieldcalculator', alg_params)
+
+            # Difference PLATFORMS
+            # Polygons that mark striking platform and/or distal edge cut out Z=0 points
+            alg_params = {
+                'INPUT': Ref('FieldCalculatorDummyZ', 'OUTPUT'),
+                'OVERLAY': parameters['platformspolygon'],
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('DifferencePlatforms', 'native:difference', alg_params)
+
+            # Difference PTS OUTSIDE PERIM
+            alg_params = {
+                'INPUT': Ref('DifferencePlatforms', 'OUTPUT'),
+                'OVERLAY': Ref('ConvertLinesToPolygonsPerim', 'POLYGONS'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('DifferencePtsOutsidePerim', 'native:difference', alg_params)
+
+            # Refactor fields PERIM PTS
+            alg_params = {
+                'FIELDS_MAPPING': [{'expression': '"Z"', 'length': 10, 'name': 'Z', 'precision': 3, 'type': 6}],
+                'INPUT': Ref('FieldCalculatorPerimPts', 'OUTPUT'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('RefactorFieldsPerimPts', 'qgis:refactorfields', alg_params)
+
+            # Refactor fields EDGE
+            alg_params = {
+                'FIELDS_MAPPING': [{'expression': '"Z"', 'length': 10, 'name': 'Z', 'precision': 3, 'type': 6}],
+                'INPUT': Ref('DifferencePtsOutsidePerim', 'OUTPUT'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('RefactorFieldsEdge', 'qgis:refactorfields', alg_params)
+            points = {
+                'Edge': Ref('RefactorFieldsEdge', 'OUTPUT'),
+                'PerimPts': Ref('RefactorFieldsPerimPts', 'OUTPUT'),
+                'Platforms': Ref('DifferencePlatforms', 'OUTPUT')
+            }
+
+        # Buffer and everything downstream of it depend on the expected flake scar length.  A sweep adds that part of the
+        # model once per length next to the shared upstream steps, so the lengths are reconstructed concurrently.
+        lengths = self.sweepLengths(parameters, context)
+        # Only the faces whose reconstruction is requested become model results; the graph skips every step that feeds
+        # no result, down to the translate of the unused surface.
+        requested = self.requestedFaces(parameters, context)
+        progressive = self.parameterAsBoolean(parameters, 'progressive', context)
+        if progressive and self.parameterAsEnum(parameters, 'reconstruction', context) != 1:
+            raise QgsProcessingException('Progressive mode previews a raster infill; choose the Raster infill reconstruction')
+        # The previews are model results whenever they are made, so their steps run: those not asked for go to temporary
+        # files, whose paths are logged as soon as they are written.
+        previews = {face: self.parameterAsOutputLayer(parameters, face + 'Preview', context) for face in FACES}
+        previews = {face: preview for face, preview in previews.items() if preview or (progressive and face in requested)}
+        if not lengths:
+            destinations = {face: self.parameterAsOutputLayer(parameters, face + 'Reconstruction', context) or QgsProcessing.TEMPORARY_OUTPUT for face in FACES}
+            results = {face: face + 'Reconstruction' if face in requested else None for face in FACES}
+            for face, preview in previews.items():
+                destinations[face + 'Preview'] = preview or QgsProcessing.TEMPORARY_OUTPUT
+                results[face + 'Preview'] = face + 'Preview'
+            self.addReconstruction(graph, parameters, context, parameters['expectedflakescarlengthmm'], '', destinations, results, points)
+            return self.runGraph(graph, parameters, context, model_feedback)
+
+        stack = self.parameterAsEnum(parameters, 'sweepoutput', context) == 0
+        labels = ['{:g}mm'.format(length) for length in lengths]
+        final = []
+        for length, label in zip(lengths, labels):
+            destinations = {}
+            results = {}
+            for face in FACES:
+                if stack or face not in requested:
+                    destinations[face] = QgsProcessing.TEMPORARY_OUTPUT
+                    results[face] = None
+                else:
+                    stem, extension = os.path.splitext(self.parameterAsOutputLayer(parameters, face + 'Reconstruction', context))
+                    destinations[face] = '{}_{}{}'.format(stem, label, extension or '.tif')
+                    results[face] = '{}Reconstruction_{}'.format(face, label)
+            for face, preview in previews.items():
+                if preview:
+                    stem, extension = os.path.splitext(preview)
+                    preview = '{}_{}{}'.format(stem, label, extension or '.tif')
+                destinations[face + 'Preview'] = preview or QgsProcessing.TEMPORARY_OUTPUT
+                results[face + 'Preview'] = '{}Preview_{}'.format(face, label)
+            final.append(self.addReconstruction(graph, parameters, context, length, '_' + label, destinations, results, points))
+
+        # Stack SWEEP
+        # One band per scar length, in sweep order, on the union of the per-length extents.
+        if stack:
+            for face in requested:
+                alg_params = {
+                    'INPUTS': [Ref(steps[face].name, 'OUTPUT') for steps in final],
+                    'LABELS': ['scar length {}'.format(label) for label in labels],
+                    'OUTPUT': self.parameterAsOutputLayer(parameters, face + 'Reconstruction', context)
+                }
+                graph.add_stage('Stack' + face, lithic_edge.stack_stage, alg_params, result=face + 'Reconstruction')
+        return self.runGraph(graph, parameters, context, model_feedback)
+
+    def requestedFaces(self, parameters, context):
+        faces = [face for face in FACES if self.parameterAsOutputLayer(parameters, face + 'Reconstruction', context)]
+        # A progressive run can ask for the previews alone.
+        previews = [face for face in FACES if self.parameterAsOutputLayer(parameters, face + 'Preview', context)]
+        if not faces and not previews:
+            raise QgsProcessingException('Neither the dorsal nor the ventral reconstruction was requested')
+        return faces
+
+    def sweepLengths(self, parameters, context):
+        text = self.parameterAsString(parameters, 'sweep', context).strip()
+        if not text:
+            return []
+        try:
+            lengths = [float(value) for value in re.split(r'[\s,;]+', text) if value]
+        except ValueError:
+            raise QgsProcessingException('Scar length sweep must be a list of numbers, got "{}"'.format(text))
+        if any(length < 0 or length > 25 for length in lengths):
+            raise QgsProcessingException('Scar lengths must be between 0 and 25 mm')
+        # Repeated lengths would give repeated step names.
+        return sorted(set(lengths), key=lengths.index)
+
+    def addReconstruction(self, graph, parameters, context, length, suffix, destinations, results, points):
+        """
+        Add the steps that depend on the expected flake scar length: buffer, sample mask, clips and reconstruction.
+
+        Step names get `suffix`, so the steps can be added once per length of a sweep.  `destinations` and `results` map
+        'Dorsal' and 'Ventral' to the output file and the model result name (None for an intermediate) of each face,
+        and 'DorsalPreview' and 'VentralPreview' likewise for the progressive mode's previews, where a face has one.
+        `points` holds the Z=0 point layers: 'Edge' and 'PerimPts' for the reconstruction and 'Platforms', the edge
+        points outside the platforms, for the buffer.  Returns the final step of each face.
+        """
+        engine = self.parameterAsEnum(parameters, 'engine', context)
+        footprint = self.parameterAsEnum(parameters, 'footprint', context)
 
         # Buffer
         alg_params = {
             'DISSOLVE': True,
-            'DISTANCE': parameters['expectedflakescarlengthmm'],
+            'DISTANCE': length,
             'END_CAP_STYLE': 0,
-            'INPUT': outputs['DifferencePlatforms']['OUTPUT'],
+            'INPUT': points['Platforms'],
             'JOIN_STYLE': 0,
             'MITER_LIMIT': 2,
             'SEGMENTS': 5,
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['Buffer'] = processing.run('native:buffer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(24)
-        if feedback.isCanceled():
-            return {}
-
-        # Difference PTS OUTSIDE PERIM
-        alg_params = {
-            'INPUT': outputs['DifferencePlatforms']['OUTPUT'],
-            'OVERLAY': outputs['ConvertLinesToPolygonsPerim']['POLYGONS'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['DifferencePtsOutsidePerim'] = processing.run('native:difference', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(25)
-        if feedback.isCanceled():
-            return {}
+        graph.add('Buffer' + suffix, 'native:buffer', alg_params)
 
         # Difference SAMPLE v PROJECTED
         alg_params = {
-            'INPUT': outputs['ConvertLinesToPolygonsPerim']['POLYGONS'],
-            'OVERLAY': outputs['Buffer']['OUTPUT'],
+            'INPUT': Ref('ConvertLinesToPolygonsPerim', 'POLYGONS'),
+            'OVERLAY': Ref('Buffer' + suffix, 'OUTPUT'),
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['DifferenceSampleVProjected'] = processing.run('native:difference', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(26)
-        if feedback.isCanceled():
-            return {}
-
-        # Refactor fields PERIM PTS
-        alg_params = {
-            'FIELDS_MAPPING': [{'expression': '"Z"', 'length': 10, 'name': 'Z', 'precision': 3, 'type': 6}],
-            'INPUT': outputs['FieldCalculatorPerimPts']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['RefactorFieldsPerimPts'] = processing.run('qgis:refactorfields', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(27)
-        if feedback.isCanceled():
-            return {}
-
-        # Refactor fields EDGE
-        alg_params = {
-            'FIELDS_MAPPING': [{'expression': '"Z"', 'length': 10, 'name': 'Z', 'precision': 3, 'type': 6}],
-            'INPUT': outputs['DifferencePtsOutsidePerim']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['RefactorFieldsEdge'] = processing.run('qgis:refactorfields', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(28)
-        if feedback.isCanceled():
-            return {}
+        graph.add('DifferenceSampleVProjected' + suffix, 'native:difference', alg_params)
 
         # Clip raster by mask layer DORSAL
         alg_params = {
             'ALPHA_BAND': False,
             'CROP_TO_CUTLINE': True,
             'DATA_TYPE': 0,
-            'INPUT': outputs['TranslateDummyDem']['OUTPUT'],
+            'INPUT': Ref('TranslateDummyDem', 'OUTPUT'),
             'KEEP_RESOLUTION': False,
-            'MASK': outputs['DifferenceSampleVProjected']['OUTPUT'],
+            'MASK': Ref('DifferenceSampleVProjected' + suffix, 'OUTPUT'),
             'MULTITHREADING': False,
             'NODATA': None,
             'OPTIONS': '',
@@ -454,20 +519,16 @@ class EdgeFromProjection04(QgsProcessingAlgorithm):
             'TARGET_EXTENT_CRS': None,
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['ClipRasterByMaskLayerDorsal'] = processing.run('gdal:cliprasterbymasklayer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(29)
-        if feedback.isCanceled():
-            return {}
+        graph.add('ClipRasterByMaskLayerDorsal' + suffix, 'gdal:cliprasterbymasklayer', alg_params)
 
         # Clip raster by mask layer VENTRAL
         alg_params = {
             'ALPHA_BAND': False,
             'CROP_TO_CUTLINE': True,
             'DATA_TYPE': 0,
-            'INPUT': outputs['TranslateConvertFormatDummyVentral']['OUTPUT'],
+            'INPUT': Ref('TranslateConvertFormatDummyVentral', 'OUTPUT'),
             'KEEP_RESOLUTION': False,
-            'MASK': outputs['DifferenceSampleVProjected']['OUTPUT'],
+            'MASK': Ref('DifferenceSampleVProjected' + suffix, 'OUTPUT'),
             'MULTITHREADING': False,
             'NODATA': None,
             'OPTIONS': '',
@@ -475,187 +536,216 @@ class EdgeFromProjection04(QgsProcessingAlgorithm):
             'TARGET_EXTENT_CRS': None,
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['ClipRasterByMaskLayerVentral'] = processing.run('gdal:cliprasterbymasklayer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(30)
-        if feedback.isCanceled():
-            return {}
+        graph.add('ClipRasterByMaskLayerVentral' + suffix, 'gdal:cliprasterbymasklayer', alg_params)
+
+        # Raster infill / in-process TIN
+        # Raster infill keeps the clipped DEM as it is and only interpolates the removed band between the surface and the
+        # Z=0 edge points, instead of exploding every remaining pixel into a point and re-triangulating the whole surface.
+        # The in-process engine's TIN triangulates the same merged point set as the steps below, but once, and uses that
+        # triangulation for both the linear interpolation and the alpha hull.
+        reconstruction = self.parameterAsEnum(parameters, 'reconstruction', context)
+        progressive = self.parameterAsBoolean(parameters, 'progressive', context)
+        if reconstruction == 1 or engine == 1:
+            steps = {}
+            for face in FACES:
+                if progressive:
+                    # Preview
+                    # Raster infill on a downsampled DEM pyramid, at about the heatmap's resolution and ready in about
+                    # a second.  The full resolution infill below does not use it and fills the whole surface anew.
+                    alg_params = {
+                        'ALPHA': 0.275,
+                        'EDGE': [points['Edge'], points['PerimPts']],
+                        'HULL': ['alpha', 'mask'][footprint],
+                        'SURFACE': Ref('ClipRasterByMaskLayer' + face + suffix, 'OUTPUT'),
+                        'OUTPUT': destinations.get(face + 'Preview', QgsProcessing.TEMPORARY_OUTPUT)
+                    }
+                    graph.add_stage('Preview' + face + suffix, lithic_edge.preview_stage, alg_params, result=results.get(face + 'Preview'))
+                alg_params = {
+                    'ALPHA': 0.275,
+                    'EDGE': [points['Edge'], points['PerimPts']],
+                    'HULL': ['alpha', 'mask'][footprint],
+                    'SURFACE': Ref('ClipRasterByMaskLayer' + face + suffix, 'OUTPUT'),
+                    'TILE': self.parameterAsInt(parameters, 'tilesize', context),
+                    'OUTPUT': destinations[face]
+                }
+                if reconstruction == 1:
+                    steps[face] = graph.add_stage('Infill' + face + suffix, lithic_edge.infill_stage, alg_params, result=results[face])
+                else:
+                    steps[face] = graph.add_stage('Tin' + face + suffix, lithic_edge.tin_stage, alg_params, result=results[face])
+            return steps
 
         # Raster values to points VENTRAL
         alg_params = {
-            'GRIDS': outputs['ClipRasterByMaskLayerVentral']['OUTPUT'],
+            'GRIDS': Ref('ClipRasterByMaskLayerVentral' + suffix, 'OUTPUT'),
             'NODATA': True,
             'POLYGONS': None,
             'TYPE': 0,
             'SHAPES': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['RasterValuesToPointsVentral'] = processing.run('saga:rastervaluestopoints', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(31)
-        if feedback.isCanceled():
-            return {}
+        graph.add('RasterValuesToPointsVentral' + suffix, 'saga:rastervaluestopoints', alg_params)
 
         # Raster values to points DORSAL
         alg_params = {
-            'GRIDS': outputs['ClipRasterByMaskLayerDorsal']['OUTPUT'],
+            'GRIDS': Ref('ClipRasterByMaskLayerDorsal' + suffix, 'OUTPUT'),
             'NODATA': True,
             'POLYGONS': None,
             'TYPE': 0,
             'SHAPES': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['RasterValuesToPointsDorsal'] = processing.run('saga:rastervaluestopoints', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(32)
-        if feedback.isCanceled():
-            return {}
+        graph.add('RasterValuesToPointsDorsal' + suffix, 'saga:rastervaluestopoints', alg_params)
 
         # Refactor fields DORSAL
         alg_params = {
             'FIELDS_MAPPING': [{'expression': '"OUTPUT"', 'length': 18, 'name': 'Z', 'precision': 10, 'type': 6}],
-            'INPUT': outputs['RasterValuesToPointsDorsal']['SHAPES'],
+            'INPUT': Ref('RasterValuesToPointsDorsal' + suffix, 'SHAPES'),
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['RefactorFieldsDorsal'] = processing.run('qgis:refactorfields', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(33)
-        if feedback.isCanceled():
-            return {}
+        graph.add('RefactorFieldsDorsal' + suffix, 'qgis:refactorfields', alg_params)
 
         # Refactor fields VENTRAL
         alg_params = {
             'FIELDS_MAPPING': [{'expression': '"OUTPUT"', 'length': 18, 'name': 'Z', 'precision': 10, 'type': 6}],
-            'INPUT': outputs['RasterValuesToPointsVentral']['SHAPES'],
+            'INPUT': Ref('RasterValuesToPointsVentral' + suffix, 'SHAPES'),
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['RefactorFieldsVentral'] = processing.run('qgis:refactorfields', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(34)
-        if feedback.isCanceled():
-            return {}
+        graph.add('RefactorFieldsVentral' + suffix, 'qgis:refactorfields', alg_params)
 
         # Merge vector layers VENTRAL
         alg_params = {
             'CRS': None,
-            'LAYERS': [outputs['RefactorFieldsEdge']['OUTPUT'],outputs['RefactorFieldsPerimPts']['OUTPUT'],outputs['RefactorFieldsVentral']['OUTPUT']],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['MergeVectorLayersVentral'] = processing.run('native:mergevectorlayers', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(35)
-        if feedback.isCanceled():
-            return {}
-
-        # Concave hull (alpha shapes) VENTRAL
-        alg_params = {
-            'ALPHA': 0.275,
-            'HOLES': False,
-            'INPUT': outputs['MergeVectorLayersVentral']['OUTPUT'],
-            'NO_MULTIGEOMETRY': False,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ConcaveHullAlphaShapesVentral'] = processing.run('qgis:concavehull', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(36)
-        if feedback.isCanceled():
-            return {}
+            'LAYERS': [points['Edge'],points['PerimPts'],Ref('RefactorFieldsVentral' + suffix, 'OUTPUT')],
+            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+        }
+        graph.add('MergeVectorLayersVentral' + suffix, 'native:mergevectorlayers', alg_params)
+
+        # Footprint VENTRAL
+        # With the raster mask footprint, the output outline is the alpha hull rasterized from the triangulation of the
+        # known cells bordering the no-data band and the edge points, instead of an alpha hull over every pixel point.
+        if footprint == 1:
+            alg_params = {
+                'ALPHA': 0.275,
+                'EDGE': [points['Edge'], points['PerimPts']],
+                'SURFACE': Ref('ClipRasterByMaskLayerVentral' + suffix, 'OUTPUT'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add_stage('FootprintVentral' + suffix, lithic_edge.footprint_stage, alg_params)
+            hull_ventral = Ref('FootprintVentral' + suffix, 'OUTPUT')
+        else:
+            # Concave hull (alpha shapes) VENTRAL
+            alg_params = {
+                'ALPHA': 0.275,
+                'HOLES': False,
+                'INPUT': Ref('MergeVectorLayersVentral' + suffix, 'OUTPUT'),
+                'NO_MULTIGEOMETRY': False,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ConcaveHullAlphaShapesVentral' + suffix, 'qgis:concavehull', alg_params)
+            hull_ventral = Ref('ConcaveHullAlphaShapesVentral' + suffix, 'OUTPUT')
 
         # Merge vector layers DORSAL
         alg_params = {
             'CRS': None,
-            'LAYERS': [outputs['RefactorFieldsDorsal']['OUTPUT'],outputs['RefactorFieldsEdge']['OUTPUT'],outputs['RefactorFieldsPerimPts']['OUTPUT']],
+            'LAYERS': [Ref('RefactorFieldsDorsal' + suffix, 'OUTPUT'),points['Edge'],points['PerimPts']],
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['MergeVectorLayersDorsal'] = processing.run('native:mergevectorlayers', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(37)
-        if feedback.isCanceled():
-            return {}
+        graph.add('MergeVectorLayersDorsal' + suffix, 'native:mergevectorlayers', alg_params)
 
         # Grid (Linear) DORSAL
         alg_params = {
             'DATA_TYPE': 5,
-            'INPUT': outputs['MergeVectorLayersDorsal']['OUTPUT'],
+            'INPUT': Ref('MergeVectorLayersDorsal' + suffix, 'OUTPUT'),
             'NODATA': 0,
             'OPTIONS': '',
             'RADIUS': -1,
             'Z_FIELD': 'Z',
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['GridLinearDorsal'] = processing.run('gdal:gridlinear', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(38)
-        if feedback.isCanceled():
-            return {}
-
-        # Concave hull (alpha shapes) DORSAL
-        alg_params = {
-            'ALPHA': 0.275,
-            'HOLES': False,
-            'INPUT': outputs['MergeVectorLayersDorsal']['OUTPUT'],
-            'NO_MULTIGEOMETRY': False,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ConcaveHullAlphaShapesDorsal'] = processing.run('qgis:concavehull', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(39)
-        if feedback.isCanceled():
-            return {}
+        graph.add('GridLinearDorsal' + suffix, 'gdal:gridlinear', alg_params)
+
+        # Footprint DORSAL
+        # With the raster mask footprint, the output outline is the alpha hull rasterized from the triangulation of the
+        # known cells bordering the no-data band and the edge points, instead of an alpha hull over every pixel point.
+        if footprint == 1:
+            alg_params = {
+                'ALPHA': 0.275,
+                'EDGE': [points['Edge'], points['PerimPts']],
+                'SURFACE': Ref('ClipRasterByMaskLayerDorsal' + suffix, 'OUTPUT'),
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add_stage('FootprintDorsal' + suffix, lithic_edge.footprint_stage, alg_params)
+            hull_dorsal = Ref('FootprintDorsal' + suffix, 'OUTPUT')
+        else:
+            # Concave hull (alpha shapes) DORSAL
+            alg_params = {
+                'ALPHA': 0.275,
+                'HOLES': False,
+                'INPUT': Ref('MergeVectorLayersDorsal' + suffix, 'OUTPUT'),
+                'NO_MULTIGEOMETRY': False,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            graph.add('ConcaveHullAlphaShapesDorsal' + suffix, 'qgis:concavehull', alg_params)
+            hull_dorsal = Ref('ConcaveHullAlphaShapesDorsal' + suffix, 'OUTPUT')
 
         # Grid (Linear) VENTRAL
         alg_params = {
             'DATA_TYPE': 5,
-            'INPUT': outputs['MergeVectorLayersVentral']['OUTPUT'],
+            'INPUT': Ref('MergeVectorLayersVentral' + suffix, 'OUTPUT'),
             'NODATA': 0,
             'OPTIONS': '',
             'RADIUS': -1,
             'Z_FIELD': 'Z',
             'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
         }
-        outputs['GridLinearVentral'] = processing.run('gdal:gridlinear', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(40)
-        if feedback.isCanceled():
-            return {}
+        graph.add('GridLinearVentral' + suffix, 'gdal:gridlinear', alg_params)
 
         # Clip raster by mask layer VENTRAL OUTPUT
         alg_params = {
             'ALPHA_BAND': False,
             'CROP_TO_CUTLINE': True,
             'DATA_TYPE': 0,
-            'INPUT': outputs['GridLinearVentral']['OUTPUT'],
+            'INPUT': Ref('GridLinearVentral' + suffix, 'OUTPUT'),
             'KEEP_RESOLUTION': False,
-            'MASK': outputs['ConcaveHullAlphaShapesVentral']['OUTPUT'],
+            'MASK': hull_ventral,
             'MULTITHREADING': False,
             'NODATA': None,
             'OPTIONS': '',
             'TARGET_EXTENT': None,
             'TARGET_EXTENT_CRS': None,
-            'OUTPUT': parameters['VentralReconstruction']
+            'OUTPUT': destinations['Ventral']
         }
-        outputs['ClipRasterByMaskLayerVentralOutput'] = processing.run('gdal:cliprasterbymasklayer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['VentralReconstruction'] = outputs['ClipRasterByMaskLayerVentralOutput']['OUTPUT']
-
-        feedback.setCurrentStep(41)
-        if feedback.isCanceled():
-            return {}
+        ventral = graph.add('ClipRasterByMaskLayerVentralOutput' + suffix, 'gdal:cliprasterbymasklayer', alg_params, result=results['Ventral'])
 
         # Clip raster by mask layer DORSAL OUTPUT
         alg_params = {
             'ALPHA_BAND': False,
             'CROP_TO_CUTLINE': True,
             'DATA_TYPE': 0,
-            'INPUT': outputs['GridLinearDorsal']['OUTPUT'],
+            'INPUT': Ref('GridLinearDorsal' + suffix, 'OUTPUT'),
             'KEEP_RESOLUTION': False,
-            'MASK': outputs['ConcaveHullAlphaShapesDorsal']['OUTPUT'],
+            'MASK': hull_dorsal,
             'MULTITHREADING': False,
             'NODATA': None,
             'OPTIONS': '',
             'TARGET_EXTENT': None,
             'TARGET_EXTENT_CRS': None,
-            'OUTPUT': parameters['DorsalReconstruction']
-        }
-        outputs['ClipRasterByMaskLayerDorsalOutput'] = processing.run('gdal:cliprasterbymasklayer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['DorsalReconstruction'] = outputs['ClipRasterByMaskLayerDorsalOutput']['OUTPUT']
+            'OUTPUT': destinations['Dorsal']
+        }
+        dorsal = graph.add('ClipRasterByMaskLayerDorsalOutput' + suffix, 'gdal:cliprasterbymasklayer', alg_params, result=results['Dorsal'])
+        return {'Dorsal': dorsal, 'Ventral': ventral}
+
+
+    def runGraph(self, graph, parameters, context, model_feedback):
+        # Intermediate results can be kept in a persistent cache keyed by input contents and step parameters, so that
+        # steps unaffected by a changed parameter are not recomputed on the next run.
+        cache = StepCache() if self.parameterAsBoolean(parameters, 'cache', context) else None
+        # Profiling measures every child algorithm (time, memory, data sizes); a report file implies it.
+        report = self.parameterAsFileOutput(parameters, 'PROFILE', context)
+        profile = report or self.parameterAsBoolean(parameters, 'profile', context)
+        profiler = StepProfiler(self.name()) if profile else None
+        threads = self.parameterAsInt(parameters, 'threads', context)
+        results = graph.run(context, model_feedback, threads, cache, profiler)
+        if profiler is not None and report:
+            results['PROFILE'] = profiler.write(report)
         return results
 
     def name(self):
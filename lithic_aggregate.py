@@ -0,0 +1,384 @@
+"""
+Grouped aggregation of wear profile tables: the wear.agg table of GIS_wear_MarkDownGH.Rmd in one vectorized pass.
+
+    python lithic_aggregate.py MB_all_wear.csv wear_agg.csv
+    python lithic_aggregate.py MB_all_wear.store wear_agg.csv
+
+Rows are grouped by src and position once.  Sums and counts come from bincount, and a single sort per measure gives
+both the median and the maximum of every group, so the cost is O(n log n) in the number of profile rows, however many
+blades there are, instead of one aggregate() and one merge() per statistic.
+"""
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+import lithic_store
+
+VOLUMES = ['volume', 'volume D', 'volume V']
+INDICES = ['index', 'index D', 'index V']
+STATS = ['sum', 'mean', 'median', 'max']
+# Short names the Rmd gives its index statistics.
+SUFFIXES = {'mean': 'mn', 'median': 'mdn', 'max': 'max'}
+# Stroke distance of one experimental set, in cm.
+CSD_PER_SET = 500
+
+
+def group_keys(table, keys):
+    """Group number of every row, and the key values of each group (sorted, as R's merge leaves them)."""
+    codes = []
+    levels = []
+    for key in keys:
+        values = np.asarray(table[key])
+        # Fixed-width strings sort in C; object arrays would compare Python strings.
+        level, code = np.unique(values.astype(str) if values.dtype == object else values, return_inverse=True)
+        levels.append(level)
+        codes.append(code.astype(np.int64))
+    combined = np.zeros(len(codes[0]), dtype=np.int64)
+    for code, level in zip(codes, levels):
+        combined = combined * len(level) + code
+    groups, inverse = np.unique(combined, return_inverse=True)
+    values = {}
+    for key, level in zip(reversed(keys), reversed(levels)):
+        values[key] = level[groups % len(level)]
+        groups = groups // len(level)
+    return inverse, {key: values[key] for key in keys}
+
+
+def sorted_by_group(group, values, ngroups):
+    """
+    Finite values sorted by group and by value within each group, with the number of values in each group.  Group g's
+    values are ordered[start[g]:start[g] + count[g]].
+    """
+    values = np.asarray(values, dtype=np.float64)
+    keep = np.isfinite(values)
+    group, values = group[keep], values[keep]
+    # Sort by value, then stably by group: each group's values end up contiguous and in order (faster than lexsort).
+    order = np.argsort(values)
+    order = order[np.argsort(group[order], kind='stable')]
+    return values[order], np.bincount(group, minlength=ngroups)
+
+
+def _order_stats(ordered, count):
+    start = np.concatenate([[0], np.cumsum(count)[:-1]]).astype(np.int64)
+    present = count > 0
+    median = np.full(len(count), np.nan)
+    maximum = np.full(len(count), np.nan)
+    low = start[present] + (count[present] - 1) // 2
+    high = start[present] + count[present] // 2
+    median[present] = (ordered[low] + ordered[high]) / 2
+    maximum[present] = ordered[start[present] + count[present] - 1]
+    return median, maximum
+
+
+def group_stats(group, values, ngroups, stats=STATS):
+    """sum, mean, median and max of `values` per group, skipping NaN (R's na.omit)."""
+    ordered, count = sorted_by_group(group, values, ngroups)
+    start = np.concatenate([[0], np.cumsum(count)[:-1]]).astype(np.int64)
+    total = np.add.reduceat(ordered, start[count > 0]) if len(ordered) else np.empty(0)
+    out = {'sum': np.zeros(ngroups)}
+    out['sum'][count > 0] = total
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out['mean'] = out['sum'] / count
+    out['median'], out['max'] = _order_stats(ordered, count)
+    return {stat: out[stat] for stat in stats}
+
+
+def aggregate(table, keys=('src', 'position'), measures=VOLUMES + INDICES, stats=STATS):
+    """Every statistic of every measure per group, as columns '<measure> <stat>' next to the key columns."""
+    group, result = group_keys(table, list(keys))
+    ngroups = len(result[keys[0]])
+    for measure in measures:
+        for stat, values in group_stats(group, table[measure], ngroups, stats).items():
+            result['{} {}'.format(measure, stat)] = values
+    return result
+
+
+def _blades(table):
+    """Blade (src) names with their mb and set; every row of a src has the same mb and set."""
+    blades, first = np.unique(np.asarray(table['src']).astype(str), return_index=True)
+    return blades, np.asarray(table['mb'], dtype=object)[first], np.asarray(table['set'])[first]
+
+
+def wear_agg(table):
+    """
+    The Rmd's wear.agg: volume sums and index mean, median and max per src and position, with set, MB, vol.sum,
+    vol.pct and CSD.
+
+    Columns are named as in the Rmd.  Its 'sharp' column is dropped: sharpness data was stripped from the table and
+    wear.agg.sharp is never defined.  set and MB are taken from the table's set and mb columns rather than parsed out
+    of src, so set 3 and later sets stay distinct.  The volume mean, median and max and index sums are kept as
+    '<measure> <stat>' columns after the Rmd's.
+    """
+    return _wear_agg(aggregate(table), *_blades(table))
+
+
+def _wear_agg(stats, blades, mbs, sets):
+    result = {'src': stats['src'], 'position': stats['position']}
+    for measure in VOLUMES:
+        result[measure] = stats[measure + ' sum']
+    for stat in ['mean', 'median', 'max']:
+        for measure in INDICES:
+            result['{} {}'.format(measure, SUFFIXES[stat])] = stats['{} {}'.format(measure, stat)]
+
+    blade = np.searchsorted(blades, result['src'])
+    result['set'] = sets[blade]
+    result['MB'] = mbs[blade]
+    vol_sum = np.bincount(blade, result['volume'], minlength=len(blades))[blade]
+    result['vol.sum'] = vol_sum
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result['vol.pct'] = np.floor(result['volume'] / vol_sum * 100 * 100) / 100
+    result['CSD'] = result['set'] * CSD_PER_SET
+
+    for measure in VOLUMES:
+        for stat in ['mean', 'median', 'max']:
+            result['{} {}'.format(measure, SUFFIXES[stat])] = stats['{} {}'.format(measure, stat)]
+    for measure in INDICES:
+        result[measure + ' sum'] = stats[measure + ' sum']
+    return result
+
+
+def progression(mbs, sets, volumes):
+    """
+    The Rmd's wear.agg.blade: total wear volume per microblade and set, with a zero-wear set 0 row for every
+    microblade and the cumulative stroke distance (CSD) of each set.  Takes the mb, set and volume of each blade, or of
+    each row of a wear_agg table.
+    """
+    mb_set = {}
+    for mb, number, volume in zip(mbs, sets, volumes):
+        mb_set[(mb, 0)] = 0.0
+        mb_set[(mb, number)] = mb_set.get((mb, number), 0.0) + volume
+    keys = sorted(mb_set)
+    return {
+        'MB': np.array([mb for mb, _ in keys], dtype=object),
+        'set': np.array([number for _, number in keys]),
+        'volume': np.array([mb_set[key] for key in keys]),
+        'CSD': np.array([number * CSD_PER_SET for _, number in keys]),
+    }
+
+
+class _Group:
+    """
+    Partial aggregate of one (src, position) group: per measure, a count, sum and all values in sorted order, and the
+    median and maximum they give, kept up to date as values are merged in.
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.count = np.array([len(v) for v in values])
+        self.sum = np.array([v.sum() for v in values])
+        self._update()
+
+    def _update(self):
+        self.median, self.max = _order_stats(np.concatenate(self.values), self.count)
+
+    def merge(self, values):
+        # Both sides are sorted, so a stable merge sort of the concatenation is a linear merge.
+        self.values = [np.sort(np.concatenate([old, new]), kind='stable') for old, new in zip(self.values, values)]
+        self.count += [len(v) for v in values]
+        self.sum += [v.sum() for v in values]
+        self._update()
+
+
+class WearAggregate:
+    """
+    wear.agg kept as mergeable partial aggregates, so new profile rows only touch the groups and blades they fall in.
+
+    Each (src, position) group keeps, per measure, its count, sum and its values in sorted order, which give exact
+    medians and maxima after any number of merges, and its statistics, which only change when rows of the group come
+    in; each blade keeps its mb, set and total volume.  add() costs time in proportion to the new rows plus the groups
+    they touch, not the whole table, and table() and progression() take time in proportion to the groups and blades,
+    without the profile rows.
+
+    Rows are added under a source key, such as a CSV file or a store partition, and the aggregate remembers how many
+    rows of each source it has: adding a source again only adds the rows appended to it since, so rows are never
+    counted twice.
+    """
+
+    MEASURES = VOLUMES + INDICES
+
+    def __init__(self):
+        self.groups = {}
+        self.blades = {}
+        # Source key -> number of its rows added so far.
+        self.sources = {}
+
+    def add(self, table, source=None):
+        """
+        Fold a table of profile rows into the aggregates.  With a `source` key, the rows already added from that source
+        (the first ones, as sources only grow by appending) are skipped.  Returns the (src, position) groups it
+        touched.
+        """
+        if source is not None:
+            done = self.sources.get(source, 0)
+            self.sources[source] = max(done, len(table['src']))
+            if done:
+                table = {key: values[done:] for key, values in table.items()}
+        if not len(table['src']):
+            return []
+        group, keys = group_keys(table, ['src', 'position'])
+        ngroups = len(keys['src'])
+        split = []
+        for measure in self.MEASURES:
+            ordered, count = sorted_by_group(group, table[measure], ngroups)
+            split.append(np.split(ordered, np.cumsum(count)[:-1]))
+        touched = list(zip(keys['src'].tolist(), keys['position'].tolist()))
+        for index, key in enumerate(touched):
+            values = [parts[index] for parts in split]
+            if key in self.groups:
+                self.groups[key].merge(values)
+            else:
+                self.groups[key] = _Group(values)
+
+        blades, mbs, sets = _blades(table)
+        blade = np.searchsorted(blades, np.asarray(table['src']).astype(str))
+        volumes = np.bincount(blade, np.nan_to_num(np.asarray(table['volume'], dtype=np.float64)),
+                              minlength=len(blades))
+        for src, mb, number, volume in zip(blades.tolist(), mbs, sets.tolist(), volumes):
+            if src in self.blades:
+                self.blades[src]['volume'] += volume
+            else:
+                self.blades[src] = {'mb': mb, 'set': number, 'volume': volume}
+        return touched
+
+    def merge(self, other):
+        """
+        Fold another WearAggregate (say, one built on another machine) into this one.  Raises ValueError if both have
+        rows of the same source, which would then be counted twice.
+        """
+        shared = sorted(set(self.sources) & set(other.sources))
+        if shared:
+            raise ValueError('Both aggregates have rows of {}'.format(', '.join(shared)))
+        self.sources.update(other.sources)
+        for key, group in other.groups.items():
+            if key in self.groups:
+                self.groups[key].merge(group.values)
+            else:
+                self.groups[key] = _Group(list(group.values))
+        for src, blade in other.blades.items():
+            if src in self.blades:
+                self.blades[src]['volume'] += blade['volume']
+            else:
+                self.blades[src] = dict(blade)
+
+    def _stats(self):
+        keys = sorted(self.groups)
+        stats = {'src': np.array([src for src, _ in keys]), 'position': np.array([position for _, position in keys])}
+        groups = [self.groups[key] for key in keys]
+        for index, measure in enumerate(self.MEASURES):
+            count = np.array([group.count[index] for group in groups], dtype=np.int64)
+            total = np.array([group.sum[index] for group in groups])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total / count
+            stats.update({measure + ' sum': total, measure + ' mean': mean,
+                          measure + ' median': np.array([group.median[index] for group in groups]),
+                          measure + ' max': np.array([group.max[index] for group in groups])})
+        return stats
+
+    def _blade_arrays(self):
+        blades = sorted(self.blades)
+        return (np.array(blades), np.array([self.blades[src]['mb'] for src in blades], dtype=object),
+                np.array([self.blades[src]['set'] for src in blades]))
+
+    def table(self):
+        """The same table wear_agg gives for all the rows added so far."""
+        return _wear_agg(self._stats(), *self._blade_arrays())
+
+    def progression(self):
+        """progression() from the per-blade totals."""
+        blades, mbs, sets = self._blade_arrays()
+        return progression(mbs, sets, [self.blades[src]['volume'] for src in blades])
+
+    def save(self, path):
+        """Write the partial aggregates to a .npz file."""
+        keys = sorted(self.groups)
+        arrays = {
+            'src': np.array([src for src, _ in keys]),
+            'position': np.array([position for _, position in keys]),
+        }
+        for index in range(len(self.MEASURES)):
+            parts = [self.groups[key].values[index] for key in keys]
+            arrays['values{}'.format(index)] = np.concatenate(parts) if parts else np.empty(0)
+            arrays['count{}'.format(index)] = np.array([len(part) for part in parts], dtype=np.int64)
+        blades, mbs, sets = self._blade_arrays()
+        arrays.update(blade=blades, blade_mb=mbs.astype(str), blade_set=sets,
+                      blade_volume=np.array([self.blades[src]['volume'] for src in blades]))
+        sources = sorted(self.sources)
+        arrays.update(source=np.array(sources, dtype=str),
+                      source_rows=np.array([self.sources[source] for source in sources], dtype=np.int64))
+        staging = path + '.tmp.npz'
+        np.savez_compressed(staging, **arrays)
+        os.replace(staging, path)
+
+    @classmethod
+    def load(cls, path):
+        aggregate = cls()
+        with np.load(path) as arrays:
+            splits = []
+            for index in range(len(cls.MEASURES)):
+                count = arrays['count{}'.format(index)]
+                splits.append(np.split(arrays['values{}'.format(index)], np.cumsum(count)[:-1]))
+            for index, key in enumerate(zip(arrays['src'].tolist(), arrays['position'].tolist())):
+                aggregate.groups[key] = _Group([parts[index] for parts in splits])
+            for src, mb, number, volume in zip(arrays['blade'].tolist(), arrays['blade_mb'].tolist(),
+                                               arrays['blade_set'].tolist(), arrays['blade_volume'].tolist()):
+                aggregate.blades[src] = {'mb': mb, 'set': number, 'volume': volume}
+            if 'source' in arrays:
+                aggregate.sources = dict(zip(arrays['source'].tolist(), arrays['source_rows'].tolist()))
+        return aggregate
+
+
+def load(path):
+    """A wear profile table from a CSV file or a lithic_store folder."""
+    if os.path.isdir(path):
+        return lithic_store.WearStore(path).load()
+    return lithic_store.read_csv(path)
+
+
+def write_csv(table, path):
+    columns = list(table)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(columns)
+        for row in zip(*(table[column] for column in columns)):
+            writer.writerow([value.item() if isinstance(value, np.generic) else value for value in row])
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('source', help='wear profile CSV or lithic_store folder')
+    parser.add_argument('output', help='aggregated table (CSV)')
+    parser.add_argument('--state', help='partial aggregates (.npz) to update with the source rows instead of '
+                                        'aggregating the source alone')
+    parser.add_argument('--progression', help='also write total wear per microblade and set (CSV)')
+    args = parser.parse_args(argv)
+    if args.state:
+        state = WearAggregate.load(args.state) if os.path.exists(args.state) else WearAggregate()
+        touched = []
+        if os.path.isdir(args.source):
+            # One source per partition: the store only ever appends rows to the end of a partition.
+            store = lithic_store.WearStore(args.source)
+            for partition in store.partitions:
+                source = '{}/mb={}/set={}'.format(os.path.abspath(args.source), partition['mb'], partition['set'])
+                touched += state.add(store.load(partition['mb'], partition['set']), source)
+        else:
+            touched = state.add(lithic_store.read_csv(args.source), os.path.abspath(args.source))
+        state.save(args.state)
+        print('{} groups updated'.format(len(touched)))
+        result = state.table()
+        blades = state.progression() if args.progression else None
+    else:
+        result = wear_agg(load(args.source))
+        blades = progression(result['MB'], result['set'], result['volume']) if args.progression else None
+    write_csv(result, args.output)
+    print('{} groups written to {}'.format(len(result['src']), args.output))
+    if blades is not None:
+        write_csv(blades, args.progression)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
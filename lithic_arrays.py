@@ -0,0 +1,1172 @@
+"""
+NumPy versions of the raster and vector steps used by the lithic analysis scripts.
+
+Nothing in here knows about QGIS.  Lines and polygon rings are (n, 2) coordinate
+arrays, point layers are an (n, 2) array plus a value array, and a raster is a
+Grid plus a 2D array of values with NaN for no data.  The scripts convert their
+layers with lithic_layers and write the final rasters with lithic_io.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.signal import fftconvolve
+from scipy.spatial import ConvexHull, Delaunay, cKDTree
+
+
+class Grid:
+    """
+    A north-up raster grid with square cells.
+
+    (xmin, ymax) is the outer corner of the top-left cell, as in a GDAL geotransform.
+    """
+
+    def __init__(self, xmin, ymax, cellsize, ncols, nrows):
+        self.xmin = float(xmin)
+        self.ymax = float(ymax)
+        self.cellsize = float(cellsize)
+        self.ncols = int(ncols)
+        self.nrows = int(nrows)
+
+    @classmethod
+    def fit_nodes(cls, xmin, ymin, xmax, ymax, cellsize):
+        # SAGA "fit to nodes": the extent runs through the centres of the outer cells, anchored at (xmin, ymin).
+        ncols = int(np.floor((xmax - xmin) / cellsize + 1e-9)) + 1
+        nrows = int(np.floor((ymax - ymin) / cellsize + 1e-9)) + 1
+        return cls(xmin - cellsize / 2, ymin + (nrows - 0.5) * cellsize, cellsize, ncols, nrows)
+
+    @classmethod
+    def from_geotransform(cls, geotransform, ncols, nrows):
+        xmin, xres, xskew, ymax, yskew, yres = geotransform
+        if xskew or yskew or not np.isclose(xres, -yres):
+            raise ValueError('Only north-up rasters with square cells are supported')
+        return cls(xmin, ymax, xres, ncols, nrows)
+
+    @property
+    def shape(self):
+        return (self.nrows, self.ncols)
+
+    @property
+    def xmax(self):
+        return self.xmin + self.ncols * self.cellsize
+
+    @property
+    def ymin(self):
+        return self.ymax - self.nrows * self.cellsize
+
+    @property
+    def geotransform(self):
+        return (self.xmin, self.cellsize, 0.0, self.ymax, 0.0, -self.cellsize)
+
+    def x_centres(self):
+        return self.xmin + (np.arange(self.ncols) + 0.5) * self.cellsize
+
+    def y_centres(self):
+        return self.ymax - (np.arange(self.nrows) + 0.5) * self.cellsize
+
+    def centres(self):
+        """Cell centres as an (nrows * ncols, 2) array in row-major order."""
+        xx, yy = np.meshgrid(self.x_centres(), self.y_centres())
+        return np.column_stack([xx.ravel(), yy.ravel()])
+
+    def cell_index(self, xy):
+        """Row and column of the cell containing each point, and whether it falls inside the grid."""
+        cols = np.floor((xy[:, 0] - self.xmin) / self.cellsize).astype(int)
+        rows = np.floor((self.ymax - xy[:, 1]) / self.cellsize).astype(int)
+        inside = (rows >= 0) & (rows < self.nrows) & (cols >= 0) & (cols < self.ncols)
+        return rows, cols, inside
+
+    def sample(self, values, xy):
+        """Nearest-cell values at xy; NaN where a point falls outside the grid."""
+        rows, cols, inside = self.cell_index(xy)
+        out = np.full(len(xy), np.nan)
+        out[inside] = values[rows[inside], cols[inside]]
+        return out
+
+    def window(self, xmin, ymin, xmax, ymax):
+        """Row and column slices of the cells whose centres fall inside the given extent."""
+        col0 = max(int(np.ceil((xmin - self.xmin) / self.cellsize - 0.5)), 0)
+        col1 = min(int(np.floor((xmax - self.xmin) / self.cellsize - 0.5)) + 1, self.ncols)
+        row0 = max(int(np.ceil((self.ymax - ymax) / self.cellsize - 0.5)), 0)
+        row1 = min(int(np.floor((self.ymax - ymin) / self.cellsize - 0.5)) + 1, self.nrows)
+        return slice(row0, max(row1, row0)), slice(col0, max(col1, col0))
+
+    def subgrid(self, rows, cols):
+        return Grid(self.xmin + cols.start * self.cellsize, self.ymax - rows.start * self.cellsize,
+                    self.cellsize, cols.stop - cols.start, rows.stop - rows.start)
+
+
+def bounds(arrays):
+    """(xmin, ymin, xmax, ymax) of a list of coordinate arrays."""
+    xy = np.vstack(arrays)
+    return (xy[:, 0].min(), xy[:, 1].min(), xy[:, 0].max(), xy[:, 1].max())
+
+
+def close_ring(line):
+    """Close a line into a polygon ring (saga:convertlinestopolygons)."""
+    if np.array_equal(line[0], line[-1]):
+        return line
+    return np.vstack([line, line[:1]])
+
+
+def densify_line(line, spacing):
+    """
+    Line vertices plus extra points every `spacing` along each segment.
+
+    Equivalent to saga:convertlinestopoints with "insert additional points" ticked.
+    """
+    points = [line[:1]]
+    for start, end in zip(line[:-1], line[1:]):
+        length = np.hypot(*(end - start))
+        steps = np.arange(spacing, length, spacing) / length if length > 0 else np.empty(0)
+        points.append(start + steps[:, None] * (end - start))
+        points.append(end[None, :])
+    return np.vstack(points)
+
+
+def points_along(line, spacing):
+    """
+    Points every `spacing` along a line from its start, the end included when the length is a multiple of `spacing`.
+
+    Equivalent to qgis:pointsalonglines with no start or end offset.
+    """
+    distance = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(line, axis=0).T))])
+    stations = np.arange(0.0, distance[-1] + spacing * 1e-9, spacing)
+    return np.column_stack([np.interp(stations, distance, line[:, 0]), np.interp(stations, distance, line[:, 1])])
+
+
+def line_centroid(lines):
+    """Length-weighted centroid of the lines, as native:centroids gives for line features."""
+    starts = np.vstack([line[:-1] for line in lines])
+    ends = np.vstack([line[1:] for line in lines])
+    lengths = np.hypot(*(ends - starts).T)
+    if lengths.sum() == 0:
+        return starts.mean(axis=0)
+    return ((starts + ends) / 2 * lengths[:, None]).sum(axis=0) / lengths.sum()
+
+
+def azimuth(origin, xy):
+    """Azimuth of each point seen from origin, in radians clockwise from north (the QGIS azimuth() function)."""
+    return np.mod(np.arctan2(xy[:, 0] - origin[0], xy[:, 1] - origin[1]), 2 * np.pi)
+
+
+def polar_edge(peaks, centre):
+    """
+    Edge line through the peaks in azimuth order around the centre, and its segments without the crossline.
+
+    Hub lines, azimuth, points to path, explode lines and the '$length < maximum($length)' filter in one pass.  The
+    longest segment, normally where the path jumps across a gap in the ring of peaks, is dropped along with any of
+    equal length.
+    """
+    path = peaks[np.argsort(azimuth(centre, peaks), kind='stable')]
+    if len(path) < 2:
+        return path, []
+    lengths = np.hypot(*np.diff(path, axis=0).T)
+    segments = [path[i:i + 2] for i in np.nonzero(lengths < lengths.max())[0]]
+    return path, segments
+
+
+def _edges(rings):
+    xy0 = np.vstack([ring[:-1] for ring in rings])
+    xy1 = np.vstack([ring[1:] for ring in rings])
+    return xy0[:, 0], xy0[:, 1], xy1[:, 0], xy1[:, 1]
+
+
+def rasterize_polygons(rings, grid):
+    """Boolean mask of the cells whose centres fall inside the rings (even-odd rule)."""
+    x0, y0, x1, y1 = _edges(rings)
+    xs = grid.x_centres()
+    mask = np.zeros(grid.shape, dtype=bool)
+    rows, _ = grid.window(*bounds(rings))
+    for row in range(rows.start, rows.stop):
+        y = grid.ymax - (row + 0.5) * grid.cellsize
+        crossing = (y0 <= y) != (y1 <= y)
+        if not crossing.any():
+            continue
+        xc = x0[crossing] + (y - y0[crossing]) * (x1[crossing] - x0[crossing]) / (y1[crossing] - y0[crossing])
+        xc.sort()
+        mask[row] = np.searchsorted(xc, xs) % 2 == 1
+    return mask
+
+
+def clip_to_polygons(grid, values, rings):
+    """Crop a raster to the extent of the rings and blank the cells outside them (saga:cliprasterwithpolygon)."""
+    rows, cols = grid.window(*bounds(rings))
+    subgrid = grid.subgrid(rows, cols)
+    inside = rasterize_polygons(rings, subgrid)
+    return subgrid, np.where(inside, values[rows, cols], np.nan)
+
+
+class PolygonIndex:
+    """
+    Polygons prepared once for point-in-polygon tests of many points, as native:difference and extract by location
+    make on point layers.
+
+    `polygons` is a list of polygons, each a list of closed rings (exterior first, then holes; even-odd rule).  Each
+    polygon keeps its bounding box, which rules most points out at once, and its edges sorted into horizontal slabs,
+    so a point is only tested against the edges of its slab instead of every edge of the polygon.
+    """
+
+    def __init__(self, polygons):
+        self.polygons = [self._prepare(rings) for rings in polygons if len(rings)]
+
+    @staticmethod
+    def _prepare(rings):
+        x0, y0, x1, y1 = _edges(rings)
+        xmin, ymin, xmax, ymax = bounds(rings)
+        count = max(int(np.sqrt(len(x0))), 1)
+        height = max(ymax - ymin, 1e-12) / count
+        low = np.clip(((np.minimum(y0, y1) - ymin) // height).astype(int), 0, count - 1)
+        high = np.clip(((np.maximum(y0, y1) - ymin) // height).astype(int), 0, count - 1)
+        # Every edge goes into each slab it spans: slab -> edges as offsets into one array.
+        spans = high - low + 1
+        edges = np.repeat(np.arange(len(x0)), spans)
+        slabs = np.repeat(low - np.cumsum(spans) + spans, spans) + np.arange(spans.sum())
+        order = np.argsort(slabs, kind='stable')
+        starts = np.searchsorted(slabs[order], np.arange(count + 1))
+        return (xmin, ymin, xmax, ymax), height, count, starts, edges[order], (x0, y0, x1, y1)
+
+    def contains(self, xy):
+        """Whether each point of `xy` falls inside any of the polygons, as a boolean mask."""
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        inside = np.zeros(len(xy), dtype=bool)
+        for (xmin, ymin, xmax, ymax), height, count, starts, edges, (x0, y0, x1, y1) in self.polygons:
+            candidates = np.flatnonzero(~inside & (xy[:, 0] >= xmin) & (xy[:, 0] <= xmax) & (xy[:, 1] >= ymin) &
+                                        (xy[:, 1] <= ymax))
+            slab = np.clip(((xy[candidates, 1] - ymin) // height).astype(int), 0, count - 1)
+            for number in np.unique(slab):
+                points = candidates[slab == number]
+                near = edges[starts[number]:starts[number + 1]]
+                x, y = xy[points, :1], xy[points, 1:]
+                crossing = (y0[near] <= y) != (y1[near] <= y)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    xc = x0[near] + (y - y0[near]) * (x1[near] - x0[near]) / (y1[near] - y0[near])
+                inside[points] = np.count_nonzero(crossing & (xc > x), axis=1) % 2 == 1
+        return inside
+
+
+def kernel_density(xy, radius=0.5, pixel_size=0.1):
+    """
+    Quartic kernel density of the points, as raw values (qgis:heatmapkerneldensityestimation, KERNEL 0, OUTPUT_VALUE 0).
+
+    The grid covers the points plus the radius, laid out the way QGIS lays out its heatmap.  Points are binned to
+    their pixel and the binned counts are convolved with the sampled kernel by FFT, so the cost depends on the grid
+    size rather than on the number of points times the kernel footprint.
+    """
+    xmin, ymin, xmax, ymax = bounds([xy])
+    xmin, ymin, xmax, ymax = xmin - radius, ymin - radius, xmax + radius, ymax + radius
+    ncols = int(np.ceil((xmax - xmin) / pixel_size)) + 1
+    nrows = int(np.ceil((ymax - ymin) / pixel_size)) + 1
+    extra_x = ncols * pixel_size - (xmax - xmin)
+    extra_y = nrows * pixel_size - (ymax - ymin)
+    grid = Grid(xmin - extra_x / 2, ymax + extra_y / 2, pixel_size, ncols, nrows)
+
+    rows, cols, inside = grid.cell_index(xy)
+    counts = np.bincount(rows[inside] * ncols + cols[inside], minlength=nrows * ncols).reshape(grid.shape)
+
+    reach = int(np.ceil(radius / pixel_size))
+    offsets = np.arange(-reach, reach + 1) * pixel_size
+    d2 = (offsets[None, :] ** 2 + offsets[:, None] ** 2) / radius ** 2
+    kernel = np.where(d2 <= 1, 15.0 / 16.0 * (1 - d2) ** 2, 0.0)
+    density = fftconvolve(counts.astype(float), kernel, mode='same')
+    # FFT round-off leaves tiny non-zero values in empty areas, which would show up as spurious peaks.
+    density[density < density.max() * 1e-9] = 0
+    return grid, density
+
+
+def local_maxima(values):
+    """Cells strictly higher than all eight neighbours (saga:localminimaandmaxima, MAXIMA)."""
+    footprint = np.ones((3, 3), dtype=bool)
+    footprint[1, 1] = False
+    filled = np.where(np.isfinite(values), values, -np.inf)
+    neighbours = ndimage.maximum_filter(filled, footprint=footprint, mode='constant', cval=-np.inf)
+    return filled > neighbours
+
+
+def density_peaks(xy, radius=0.5, pixel_size=0.1):
+    """
+    Density peaks of the projected points that are above the mean peak density.
+
+    Heatmap, local maxima and the '"Z" > mean("Z")' extraction in one pass.  Returns the peak coordinates (pixel
+    centres) and their densities.
+    """
+    grid, density = kernel_density(xy, radius, pixel_size)
+    rows, cols = np.nonzero(local_maxima(density) & (density > 0))
+    z = density[rows, cols]
+    above = z > z.mean() if len(z) else np.zeros(0, dtype=bool)
+    peaks = np.column_stack([grid.x_centres()[cols[above]], grid.y_centres()[rows[above]]])
+    return peaks, z[above]
+
+
+def _extension(grid, xmin, ymin, xmax, ymax):
+    left = max(int(np.ceil((grid.xmin - xmin) / grid.cellsize)), 0)
+    right = max(int(np.ceil((xmax - grid.xmax) / grid.cellsize)), 0)
+    top = max(int(np.ceil((ymax - grid.ymax) / grid.cellsize)), 0)
+    bottom = max(int(np.ceil((grid.ymin - ymin) / grid.cellsize)), 0)
+    extended = Grid(grid.xmin - left * grid.cellsize, grid.ymax + top * grid.cellsize, grid.cellsize,
+                    grid.ncols + left + right, grid.nrows + top + bottom)
+    return extended, ((top, bottom), (left, right))
+
+
+def extend_grid(grid, values, xmin, ymin, xmax, ymax):
+    """Pad a raster with no data so that it covers the given extent as well as its own."""
+    extended, padding = _extension(grid, xmin, ymin, xmax, ymax)
+    return extended, np.pad(values, padding, constant_values=np.nan)
+
+
+def resample_nearest(source, values, grid, fill=np.nan):
+    """Values of a `source` raster at the cell centres of `grid` (nearest cell), `fill` outside the source."""
+    cols = np.floor((grid.x_centres() - source.xmin) / source.cellsize).astype(int)
+    rows = np.floor((source.ymax - grid.y_centres()) / source.cellsize).astype(int)
+    valid_cols = (cols >= 0) & (cols < source.ncols)
+    valid_rows = (rows >= 0) & (rows < source.nrows)
+    out = np.full(grid.shape, fill, dtype=values.dtype)
+    out[np.ix_(valid_rows, valid_cols)] = values[np.ix_(rows[valid_rows], cols[valid_cols])]
+    return out
+
+
+def downsample(grid, values, factor=2):
+    """
+    Mean of each `factor` x `factor` block of cells, one level of a DEM pyramid.
+
+    A coarse cell has data when more than half of its cells do, so the outline of the surface keeps its place.  The
+    coarse grid shares the top-left corner; blocks past the right and bottom edges are partial.
+    """
+    nrows, ncols = -(-grid.nrows // factor), -(-grid.ncols // factor)
+    padded = np.full((nrows * factor, ncols * factor), np.nan)
+    padded[:grid.nrows, :grid.ncols] = values
+    blocks = padded.reshape(nrows, factor, ncols, factor)
+    known = np.isfinite(blocks)
+    count = known.sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(known, blocks, 0.0).sum(axis=(1, 3)) / count
+    mean[2 * count <= factor * factor] = np.nan
+    return Grid(grid.xmin, grid.ymax, grid.cellsize * factor, ncols, nrows), mean
+
+
+# Cell size a preview is computed at (map units, mm for the lithics DEMs): the resolution of the edge heatmap.
+PREVIEW_CELLSIZE = 0.1
+# Most cells of the level a preview is computed on, about a second of infill, whatever the cell size.
+PREVIEW_CELLS = 250000
+
+
+def pyramid(grid, values, cellsize=PREVIEW_CELLSIZE, max_cells=PREVIEW_CELLS):
+    """
+    The raster and coarser copies of it at half the resolution each: at least one, then on while the cell size stays
+    within `cellsize` or the level has more than `max_cells` cells.
+    """
+    levels = [(grid, values)]
+    while min(grid.shape) > 1 and (len(levels) == 1 or 2 * grid.cellsize <= cellsize or
+                                   grid.nrows * grid.ncols > max_cells):
+        grid, values = downsample(grid, values)
+        levels.append((grid, values))
+    return levels
+
+
+def near_points(grid, xy, distance, factor=8):
+    """
+    Cells of `grid` that may lie within `distance` of a point in `xy`: a superset found with a distance transform on a
+    grid `factor` times coarser, grown by the coarse cell diagonal, so its cost grows with the raster size over
+    factor ** 2.  Points beyond the grid count too.
+    """
+    cellsize = grid.cellsize * factor
+    pad = int(np.ceil(distance / cellsize)) + 1
+    coarse = Grid(grid.xmin - pad * cellsize, grid.ymax + pad * cellsize, cellsize,
+                  -(-grid.ncols // factor) + 2 * pad, -(-grid.nrows // factor) + 2 * pad)
+    seeds = np.zeros(coarse.shape, dtype=bool)
+    rows, cols, inside = coarse.cell_index(xy)
+    seeds[rows[inside], cols[inside]] = True
+    if not seeds.any():
+        return np.zeros(grid.shape, dtype=bool)
+    near = ndimage.distance_transform_edt(~seeds) * cellsize <= distance + np.sqrt(2) * cellsize
+    return resample_nearest(coarse, near, grid, False)
+
+
+def tiles(grid, size, halo=0):
+    """
+    Split a grid into square tiles of `size` cells, for block-wise processing of rasters too large for memory.
+
+    Yields (rows, cols, outer_rows, outer_cols): the slices of each tile, and of the tile grown by `halo` cells on each
+    side (clamped to the grid) for operations that look at neighbouring cells.
+    """
+    for row0 in range(0, grid.nrows, size):
+        for col0 in range(0, grid.ncols, size):
+            rows = slice(row0, min(row0 + size, grid.nrows))
+            cols = slice(col0, min(col0 + size, grid.ncols))
+            outer_rows = slice(max(row0 - halo, 0), min(rows.stop + halo, grid.nrows))
+            outer_cols = slice(max(col0 - halo, 0), min(cols.stop + halo, grid.ncols))
+            yield rows, cols, outer_rows, outer_cols
+
+
+class Triangulation:
+    """
+    Delaunay triangulation of a point set with heights, built once and shared.
+
+    The same triangles serve the linear interpolation (gdal:gridlinear) and the alpha hull (qgis:concavehull), so a
+    merged point set is triangulated once instead of once per tool.
+    """
+
+    def __init__(self, points, heights):
+        self.points = np.asarray(points, dtype=float)
+        self.heights = np.asarray(heights, dtype=float)
+        self.delaunay = Delaunay(self.points)
+        corners = self.points[self.delaunay.simplices]
+        self.longest = np.max(np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2), axis=1)
+        # Qhull keeps flat triangles of (nearly) collinear points on the hull, which GEOS's triangulation in
+        # qgis:concavehull does not make; they do not count towards the longest edge.
+        b, c = corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+        self.sliver = np.abs(b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0]) <= 1e-6 * self.longest ** 2
+        self._hull = None
+
+    def alpha_triangles(self, alpha):
+        """
+        Triangles qgis:concavehull keeps: longest edge no longer than alpha times the longest edge of all triangles.
+        """
+        reference = self.longest[~self.sliver]
+        if not len(reference):
+            return np.zeros(len(self.longest), dtype=bool)
+        return self.longest <= alpha * reference.max()
+
+    def in_hull(self, xy):
+        """Whether each point falls inside the convex hull of the triangulation (or on it)."""
+        if self._hull is None:
+            vertices = self.points[ConvexHull(self.points).vertices]
+            centre = vertices.mean(axis=0)
+            angles = np.arctan2(*(vertices - centre).T[::-1])
+            order = np.argsort(angles)
+            self._hull = centre, angles[order], vertices[order]
+        centre, angles, vertices = self._hull
+        # The hull edge each point looks at from the centre, found by bisection on the angles of the vertices.
+        start = (np.searchsorted(angles, np.arctan2(*(xy - centre).T[::-1])) - 1) % len(vertices)
+        a, b = vertices[start], vertices[(start + 1) % len(vertices)]
+        cross = (b[:, 0] - a[:, 0]) * (xy[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (xy[:, 0] - a[:, 0])
+        return cross >= -1e-9 * max(np.abs(self.points).max(), 1.0) ** 2
+
+    def locate(self, xy):
+        """Index of the triangle each point falls in, -1 outside the triangulation."""
+        # Qhull's point location falls back to a search of every simplex for points outside the hull, so those are
+        # ruled out first.
+        simplex = np.full(len(xy), -1)
+        hull = self.in_hull(xy)
+        simplex[hull] = self.delaunay.find_simplex(xy[hull])
+        return simplex
+
+    def circumcircles(self):
+        """Centre and radius of the circumcircle of each triangle (infinite for a flat one)."""
+        a, b, c = (self.points[self.delaunay.simplices[:, i]] for i in range(3))
+        b, c = b - a, c - a
+        b2, c2 = (b ** 2).sum(axis=1), (c ** 2).sum(axis=1)
+        d = 2 * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset = np.column_stack([c[:, 1] * b2 - b[:, 1] * c2, b[:, 0] * c2 - c[:, 0] * b2]) / d[:, None]
+        radius = np.hypot(*offset.T)
+        flat = ~np.isfinite(radius)
+        offset[flat] = 0.0
+        radius[flat] = np.inf
+        return a + offset, radius
+
+    def fill_holes(self, triangles):
+        """
+        `triangles` plus the holes in their union, as qgis:concavehull with HOLES False: the groups of other triangles,
+        joined by shared edges, that do not reach the outside of the triangulation.
+        """
+        neighbours = self.delaunay.neighbors
+        other = ~triangles
+        index = np.repeat(np.arange(len(other)), 3)
+        link = other[index] & (neighbours.ravel() >= 0)
+        link[link] = other[neighbours.ravel()[link]]
+        graph = coo_matrix((np.ones(link.sum()), (index[link], neighbours.ravel()[link])), shape=(len(other),) * 2)
+        _, group = connected_components(graph, directed=False)
+        reaches_outside = np.zeros(group.max() + 1, dtype=bool)
+        reaches_outside[group[other & (neighbours < 0).any(axis=1)]] = True
+        return triangles | (other & ~reaches_outside[group])
+
+    def interpolate(self, xy, triangles=None):
+        """Linear interpolation at xy by vectorized barycentric lookup; NaN outside the (given) triangles."""
+        simplex = self.locate(xy)
+        inside = simplex >= 0
+        if triangles is not None:
+            inside[inside] = triangles[simplex[inside]]
+        simplex = simplex[inside]
+        transform = self.delaunay.transform[simplex]
+        weights = np.einsum('nij,nj->ni', transform[:, :2], xy[inside] - transform[:, 2])
+        weights = np.column_stack([weights, 1 - weights.sum(axis=1)])
+        out = np.full(len(xy), np.nan)
+        out[inside] = (self.heights[self.delaunay.simplices[simplex]] * weights).sum(axis=1)
+        return out
+
+    def grid(self, grid, triangles=None, mask=None):
+        """Interpolate at the cell centres of a grid (only where `mask` is True, if given)."""
+        rows, cols = np.nonzero(np.ones(grid.shape, dtype=bool) if mask is None else mask)
+        values = np.full(grid.shape, np.nan)
+        values[rows, cols] = self.interpolate(np.column_stack([grid.x_centres()[cols], grid.y_centres()[rows]]),
+                                              triangles)
+        return values
+
+
+def _border_cells(grid, values):
+    """Centres and values of the known cells bordering no data (or the edge of the grid)."""
+    known = np.isfinite(values)
+    border = known & ~ndimage.binary_erosion(known, border_value=0)
+    rows, cols = np.nonzero(border)
+    return np.column_stack([grid.x_centres()[cols], grid.y_centres()[rows]]), values[rows, cols]
+
+
+def _band_triangulation(border_xy, border_z, xy, z):
+    """
+    Triangulation of the known cells bordering the no-data band plus the edge points.  Every pixel is triangulated by
+    the QGIS chain; the inside of the known surface only adds triangles there of at most a cell diagonal, which
+    _hull_triangles accounts for without building them.
+    """
+    points = np.vstack([border_xy, xy])
+    if len(points) < 3:
+        return None
+    return Triangulation(points, np.concatenate([border_z, z]))
+
+
+def _in_full_triangulation(tri, blocks):
+    """
+    Which triangles of a band triangulation are also triangles of the triangulation of every known cell and edge
+    point: those whose circumcircle holds no known cell.  `blocks` yields (grid, values) tiles of the surface, so the
+    known cells are searched one tile at a time.  Also returns the number of known cells.
+    """
+    centres, radii = tri.circumcircles()
+    full = np.isfinite(radii)
+    count = 0
+    for block, values in blocks:
+        rows, cols = np.nonzero(np.isfinite(values))
+        count += len(rows)
+        # Circles reaching the tile; a circle through known cells, as the vertices are, does not hold them.
+        dx = np.maximum(np.maximum(block.xmin - centres[:, 0], centres[:, 0] - block.xmax), 0)
+        dy = np.maximum(np.maximum(block.ymin - centres[:, 1], centres[:, 1] - block.ymax), 0)
+        reach = full & (np.hypot(dx, dy) < radii)
+        if not len(rows) or not reach.any():
+            continue
+        tree = cKDTree(np.column_stack([block.x_centres()[cols], block.y_centres()[rows]]))
+        distance, _ = tree.query(centres[reach])
+        full[reach] = distance >= radii[reach] * (1 - 1e-7)
+    return full, count
+
+
+def _hull_triangles(tri, blocks, cellsize, border_count, alpha):
+    """
+    Triangles of a band triangulation inside the qgis:concavehull polygon of every known cell and edge point.
+
+    The threshold is alpha times the longest edge of all triangles of that point set.  Triangles that are not part of
+    it span the known surface, which the full triangulation covers with triangles of at most a cell diagonal, so they
+    are kept; holes are filled as with HOLES False.  Returns the hull triangles and the (triangles, longest edge)
+    groups of hull triangles that unknown cells can fall in: the short ones and those filling holes.
+    """
+    full, count = _in_full_triangulation(tri, blocks)
+    longest = np.append(tri.longest[full & ~tri.sliver], np.sqrt(2) * cellsize if count > border_count else 0.0)
+    threshold = alpha * longest.max()
+    short = full & (tri.longest <= threshold)
+    hull = tri.fill_holes(short | ~full)
+    holes = hull & full & ~short
+    return hull, [(short, threshold), (holes, tri.longest[holes].max(initial=0.0))]
+
+
+def _hull_cells(grid, candidates, tri, hull, groups):
+    """
+    Rows, columns and centres of the `candidates` cells that fall in the hull triangles.
+
+    A cell in a triangle lies within its longest edge of each corner, so only the cells near_points finds around the
+    corners of each group of _hull_triangles are located.
+    """
+    near = np.zeros(grid.shape, dtype=bool)
+    for triangles, reach in groups:
+        if triangles.any():
+            near |= near_points(grid, tri.points[np.unique(tri.delaunay.simplices[triangles])], reach)
+    rows, cols = np.nonzero(candidates & near)
+    cells = np.column_stack([grid.x_centres()[cols], grid.y_centres()[rows]])
+    simplex = tri.locate(cells)
+    inside = simplex >= 0
+    inside[inside] = hull[simplex[inside]]
+    return rows[inside], cols[inside], cells[inside]
+
+
+def _with_edge_extent(grid, values, xy):
+    return extend_grid(grid, values, *bounds([xy, np.array([[grid.xmin, grid.ymin], [grid.xmax, grid.ymax]])]))
+
+
+def _blocks(grid, values, tile=1024):
+    for rows, cols, _, _ in tiles(grid, tile):
+        yield grid.subgrid(rows, cols), values[rows, cols]
+
+
+def _band_hull(grid, values, xy, z, alpha):
+    """The band triangulation of a surface and its edge points with _hull_triangles, or Nones for too few points."""
+    border_xy, border_z = _border_cells(grid, values)
+    tri = _band_triangulation(border_xy, border_z, xy, z)
+    if tri is None:
+        return None, None, None
+    return (tri,) + _hull_triangles(tri, _blocks(grid, values), grid.cellsize, len(border_z), alpha)
+
+
+def mask_hull(grid, known, tri, hull, groups):
+    """
+    Raster counterpart of the qgis:concavehull polygon of every known cell and edge point: the known cells plus the
+    unknown cells whose centres fall in the hull triangles of _band_hull, which are the cells the final clip of the
+    QGIS chain keeps.  Only the border cells and edge points are triangulated, so cost grows with the raster size and
+    the length of the border, not with the number of pixels triangulated.
+    """
+    mask = known.copy()
+    if tri is not None:
+        rows, cols, _ = _hull_cells(grid, ~known, tri, hull, groups)
+        mask[rows, cols] = True
+    return mask
+
+
+def footprint(grid, values, xy, z, alpha=0.275):
+    """
+    Raster footprint of the reconstruction: mask_hull of the surface and edge points.
+
+    Returns the (possibly extended) grid and the boolean footprint.
+    """
+    grid, values = _with_edge_extent(grid, values, xy)
+    return grid, mask_hull(grid, np.isfinite(values), *_band_hull(grid, values, xy, z, alpha))
+
+
+def infill(grid, values, xy, z, alpha=0.275, hull='alpha'):
+    """
+    Fill the no-data band between a clipped surface and the Z=0 edge points.
+
+    Known cells keep their values.  Only the cells bordering the no-data band are triangulated together with the edge
+    points, and the unknown cells covered by that triangulation are filled by linear interpolation.  The fill is
+    limited to the qgis:concavehull polygon of every known cell and edge point (_hull_triangles), so it does not
+    bridge concavities of the edge and fills holes as the QGIS chain does.  With hull 'alpha' the cells are picked by
+    the hull triangles they fall in; with hull 'mask' by the footprint raster, mask_hull, which covers the same cells.
+    Returns the (possibly extended) grid and the filled values.
+    """
+    grid, values = _with_edge_extent(grid, values, xy)
+    known = np.isfinite(values)
+    tri, triangles, groups = _band_hull(grid, values, xy, z, alpha)
+    if tri is None:
+        return grid, values
+    filled = values.copy()
+    if hull == 'mask':
+        rows, cols = np.nonzero(~known & mask_hull(grid, known, tri, triangles, groups))
+        filled[rows, cols] = tri.interpolate(np.column_stack([grid.x_centres()[cols], grid.y_centres()[rows]]))
+    else:
+        rows, cols, cells = _hull_cells(grid, ~known, tri, triangles, groups)
+        filled[rows, cols] = tri.interpolate(cells, triangles)
+    return grid, filled
+
+
+def infill_tiles(read, grid, xy, z, alpha=0.275, tile=1024):
+    """
+    infill with the alpha hull, one tile at a time, for surfaces too large to hold in memory.
+
+    `read(block)` returns the surface values on a Grid aligned with `grid` (NaN beyond the surface).  A first pass over
+    tiles with a one-cell halo collects the border cells; their triangulation with the edge points is small.  A second
+    pass checks it against the known cells for the hull.  Returns the extended output grid, as infill's, and a
+    generator of (rows, cols, values) tiles of the filled surface.  Peak memory is a few tiles plus the border cells,
+    whatever the size of the surface.
+    """
+    grid, _ = _extension(grid, *bounds([xy, np.array([[grid.xmin, grid.ymin], [grid.xmax, grid.ymax]])]))
+    border_xy = []
+    border_z = []
+    border_cells = []
+    for rows, cols, outer_rows, outer_cols in tiles(grid, tile, halo=1):
+        outer = grid.subgrid(outer_rows, outer_cols)
+        block_xy, block_z = _border_cells(outer, read(outer))
+        # Keep the border cells of the tile itself; the halo only supplies their neighbours.
+        block_rows, block_cols, _ = grid.cell_index(block_xy)
+        own = ((block_rows >= rows.start) & (block_rows < rows.stop) &
+               (block_cols >= cols.start) & (block_cols < cols.stop))
+        border_xy.append(block_xy[own])
+        border_z.append(block_z[own])
+        border_cells.append(block_rows[own] * grid.ncols + block_cols[own])
+    # Row-major order, as infill sees them: the Delaunay split of a grid's co-circular cells depends on point order.
+    order = np.argsort(np.concatenate(border_cells), kind='stable')
+    border_z = np.concatenate(border_z)[order]
+    tri = _band_triangulation(np.vstack(border_xy)[order], border_z, xy, z)
+    if tri is not None:
+        blocks = (grid.subgrid(rows, cols) for rows, cols, _, _ in tiles(grid, tile))
+        triangles, groups = _hull_triangles(tri, ((block, read(block)) for block in blocks), grid.cellsize,
+                                            len(border_z), alpha)
+
+    def filled_tiles():
+        for rows, cols, _, _ in tiles(grid, tile):
+            block = grid.subgrid(rows, cols)
+            values = read(block)
+            if tri is not None:
+                cell_rows, cell_cols, cells = _hull_cells(block, ~np.isfinite(values), tri, triangles, groups)
+                values = values.copy()
+                values[cell_rows, cell_cols] = tri.interpolate(cells, triangles)
+            yield rows, cols, values
+
+    return grid, filled_tiles()
+
+
+def tin_reconstruction(grid, values, xy, z, alpha=0.275, hull='alpha'):
+    """
+    Linear TIN reconstruction over every known cell and edge point, clipped to its hull.
+
+    The in-process counterpart of raster values to points, merge, gdal:gridlinear, qgis:concavehull (HOLES False) and
+    the final clip, with one triangulation shared by the interpolation and the hull.  The result is on the surface's
+    own grid, extended to the edge points and cropped to the hull.
+    """
+    grid, values = _with_edge_extent(grid, values, xy)
+    known = np.isfinite(values)
+    rows, cols = np.nonzero(known)
+    points = np.vstack([np.column_stack([grid.x_centres()[cols], grid.y_centres()[rows]]), xy])
+    tri = Triangulation(points, np.concatenate([values[rows, cols], z]))
+    if hull == 'mask':
+        surface = tri.grid(grid, mask=mask_hull(grid, known, *_band_hull(grid, values, xy, z, alpha)))
+    else:
+        triangles = tri.fill_holes(tri.alpha_triangles(alpha))
+        surface = tri.grid(grid, triangles)
+        # Known cells are corners of the hull triangles, but point location may put them in a dropped neighbour.
+        corners = np.unique(tri.delaunay.simplices[triangles])
+        corners = corners[corners < len(rows)]
+        surface[rows[corners], cols[corners]] = values[rows[corners], cols[corners]]
+    rows, cols = np.nonzero(np.isfinite(surface))
+    if not len(rows):
+        return grid, surface
+    window = slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1)
+    return grid.subgrid(*window), surface[window]
+
+
+class IdwInterpolator:
+    """
+    Inverse distance weighting with SAGA's semantics (saga:inversedistanceweightedinterpolation).
+
+    Each estimate uses the `max_points` nearest points within `radius`, weighted by distance ** -power; a target that
+    coincides with a point takes that point's value, and without any points every estimate is NaN (no data).  The
+    KD-tree is built once, targets are queried in blocks with vectorized weights, and blocks are spread over `workers`
+    threads (cKDTree queries and the NumPy work release the GIL).
+    """
+
+    def __init__(self, xy, z, power=1.5, max_points=20, radius=1000.0, block=65536, workers=None):
+        self.tree = cKDTree(np.asarray(xy, dtype=float).reshape(-1, 2))
+        self.z = np.asarray(z, dtype=float)
+        self.power = power
+        self.k = min(max_points, len(self.z))
+        # SAGA includes points at exactly the search radius; cKDTree's bound is exclusive.
+        self.radius = np.nextafter(radius, np.inf)
+        self.block = block
+        self.workers = workers or os.cpu_count() or 1
+
+    def _estimate(self, targets):
+        if not self.k:
+            return np.full(len(targets), np.nan)
+        dist, idx = self.tree.query(targets, k=self.k, distance_upper_bound=self.radius)
+        if self.k == 1:
+            dist, idx = dist[:, None], idx[:, None]
+        found = np.isfinite(dist)
+        zn = np.where(found, self.z[np.minimum(idx, len(self.z) - 1)], 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(found, dist ** -self.power, 0.0)
+            estimate = (weights * zn).sum(axis=1) / weights.sum(axis=1)
+        exact = dist[:, 0] == 0
+        estimate[exact] = zn[exact, 0]
+        return estimate
+
+    def _map(self, function, blocks):
+        if self.workers == 1 or len(blocks) == 1:
+            return [function(block) for block in blocks]
+        with ThreadPoolExecutor(self.workers) as pool:
+            return list(pool.map(function, blocks))
+
+    def __call__(self, targets):
+        """Estimates at an (n, 2) array of coordinates."""
+        targets = np.asarray(targets, dtype=float)
+        blocks = [targets[start:start + self.block] for start in range(0, len(targets), self.block)] or [targets]
+        return np.concatenate(self._map(self._estimate, blocks))
+
+    def grid(self, grid):
+        """Estimates at every cell centre of a Grid, without building the full list of cell centres up front."""
+        xs = grid.x_centres()
+        rows_per_block = max(1, self.block // max(grid.ncols, 1))
+
+        def estimate_rows(row0):
+            ys = grid.ymax - (np.arange(row0, min(row0 + rows_per_block, grid.nrows)) + 0.5) * grid.cellsize
+            xx, yy = np.meshgrid(xs, ys)
+            return self._estimate(np.column_stack([xx.ravel(), yy.ravel()])).reshape(len(ys), grid.ncols)
+
+        return np.vstack(self._map(estimate_rows, list(range(0, grid.nrows, rows_per_block))))
+
+
+class _Level:
+    """
+    One level of the multigrid hierarchy: a five-point operator A u = D u - (weighted sum of the four neighbours),
+    with D and the weights zero off the free cells.  Wx joins each cell to its right neighbour, Wy to the one below.
+    """
+
+    def __init__(self, diagonal, wx, wy):
+        self.diagonal = diagonal
+        self.wx = wx
+        self.wy = wy
+        self.free = diagonal > 0
+        self.inverse = np.where(self.free, 1 / np.where(self.free, diagonal, 1), 0.0)
+        self.coarse = None
+        self.factor = None
+
+    def apply(self, u):
+        out = self.diagonal * u
+        out[:, :-1] -= self.wx * u[:, 1:]
+        out[:, 1:] -= self.wx * u[:, :-1]
+        out[:-1, :] -= self.wy * u[1:, :]
+        out[1:, :] -= self.wy * u[:-1, :]
+        return out
+
+    def _pad(self, array, nrows, ncols):
+        out = np.zeros((nrows, ncols))
+        out[:array.shape[0], :array.shape[1]] = array
+        return out
+
+    def restrict(self, r):
+        nrows, ncols = (self.diagonal.shape[0] + 1) // 2, (self.diagonal.shape[1] + 1) // 2
+        return self._pad(r, 2 * nrows, 2 * ncols).reshape(nrows, 2, ncols, 2).sum(axis=(1, 3))
+
+    def prolong(self, e):
+        nrows, ncols = self.diagonal.shape
+        return np.repeat(np.repeat(e, 2, axis=0), 2, axis=1)[:nrows, :ncols] * self.free
+
+    def coarsen(self):
+        """
+        The Galerkin operator R A P for piecewise constant interpolation from 2 x 2 blocks: block sums of the
+        diagonals less the links inside each block, and the sums of the links between neighbouring blocks.
+        """
+        nrows, ncols = (self.diagonal.shape[0] + 1) // 2, (self.diagonal.shape[1] + 1) // 2
+        wx = self._pad(self.wx, 2 * nrows, 2 * ncols)
+        wy = self._pad(self.wy, 2 * nrows, 2 * ncols)
+        inner = wx[:, 0::2].reshape(nrows, 2, ncols).sum(axis=1) + wy[0::2, :].reshape(nrows, ncols, 2).sum(axis=2)
+        diagonal = self.restrict(self.diagonal) - 2 * inner
+        # Round-off must not leave empty blocks looking free.
+        diagonal[diagonal < 1e-9] = 0.0
+        return _Level(diagonal, wx[:, 1::2].reshape(nrows, 2, ncols).sum(axis=1)[:, :ncols - 1],
+                      wy[1::2, :].reshape(nrows, ncols, 2).sum(axis=2)[:nrows - 1, :])
+
+    def factorize(self):
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.linalg import splu
+        index = np.full(self.diagonal.shape, -1)
+        index[self.free] = np.arange(self.free.sum())
+        rows = [index[self.free]]
+        cols = [index[self.free]]
+        data = [self.diagonal[self.free]]
+        for weights, left, right in [(self.wx, index[:, :-1], index[:, 1:]), (self.wy, index[:-1, :], index[1:, :])]:
+            link = weights > 0
+            rows += [left[link], right[link]]
+            cols += [right[link], left[link]]
+            data += [-weights[link], -weights[link]]
+        size = len(rows[0])
+        matrix = coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), (size, size))
+        self.factor = splu(matrix.tocsc())
+
+    def solve(self, r):
+        e = np.zeros_like(r)
+        e[self.free] = self.factor.solve(r[self.free])
+        return e
+
+
+def _v_cycle(level, r, sweeps=1, omega=0.8, over=1.5):
+    """
+    One symmetric V-cycle for A e = r with damped Jacobi smoothing, so it can precondition conjugate gradients.  The
+    coarse correction is scaled by `over`, which makes up for piecewise constant interpolation being too flat.
+    """
+    if level.coarse is None:
+        return level.solve(r)
+    e = omega * level.inverse * r
+    for _ in range(sweeps - 1):
+        e += omega * level.inverse * (r - level.apply(e))
+    e += over * level.prolong(_v_cycle(level.coarse, level.restrict(r - level.apply(e)), sweeps, omega, over))
+    for _ in range(sweeps):
+        e += omega * level.inverse * (r - level.apply(e))
+    return e
+
+
+def harmonic_fill(grid, inside, xy, z, tolerance=1e-8, max_iterations=200, coarsest=4000):
+    """
+    Harmonic interpolation over the `inside` cells between boundary values z at xy (Laplace's equation).
+
+    The cells holding a boundary point take the mean of their points' values; the other inside cells are solved for
+    with the five-point Laplacian, by conjugate gradients preconditioned with an aggregation multigrid V-cycle, so the
+    cost grows with the number of inside cells only.  Neighbours that are neither inside nor on the boundary are left
+    out of the stencil (no flux across them).  Inside cells cut off from every boundary cell take the value of the
+    nearest one.  Returns the values, NaN off the inside and boundary cells.
+    """
+    rows, cols, on_grid = grid.cell_index(xy)
+    cell = rows[on_grid] * grid.ncols + cols[on_grid]
+    counts = np.bincount(cell, minlength=grid.nrows * grid.ncols).reshape(grid.shape)
+    fixed = counts > 0
+    values = np.zeros(grid.shape)
+    values[fixed] = (np.bincount(cell, z[on_grid], grid.nrows * grid.ncols).reshape(grid.shape)[fixed] /
+                     counts[fixed])
+    free = inside & ~fixed
+    domain = free | fixed
+
+    def neighbours(array):
+        padded = np.pad(array, 1)
+        return padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
+
+    degree = neighbours(domain.astype(float)) * free
+    links = neighbours(free.astype(float)) * free
+    # Free cells with no boundary cell anywhere in their component would make the system singular.
+    labels, count = ndimage.label(free)
+    anchored = np.zeros(count + 1, dtype=bool)
+    anchored[np.unique(labels[free & (degree > links)])] = True
+    stranded = free & ~anchored[labels]
+    if stranded.any():
+        _, (near_rows, near_cols) = ndimage.distance_transform_edt(~fixed, return_indices=True)
+        values[stranded] = values[near_rows[stranded], near_cols[stranded]]
+        free &= ~stranded
+        fixed |= stranded
+        degree = neighbours((free | fixed).astype(float)) * free
+
+    out = np.where(fixed | free, values, np.nan)
+    if not free.any():
+        return out
+    level = top = _Level(degree, (free[:, :-1] & free[:, 1:]).astype(float), (free[:-1, :] & free[1:, :]).astype(float))
+    while level.free.sum() > coarsest and min(level.diagonal.shape) > 2:
+        level.coarse = level.coarsen()
+        level = level.coarse
+    level.factorize()
+
+    b = neighbours(np.where(fixed, values, 0.0)) * free
+    # Conjugate gradients from the mean boundary value.
+    u = np.where(free, values[fixed].mean(), 0.0)
+    r = b - top.apply(u)
+    z_ = _v_cycle(top, r)
+    p = z_.copy()
+    rz = np.sum(r * z_)
+    norm = np.sqrt(np.sum(b * b)) or 1.0
+    for _ in range(max_iterations):
+        if np.sqrt(np.sum(r * r)) <= tolerance * norm:
+            break
+        q = top.apply(p)
+        step = rz / np.sum(p * q)
+        u += step * p
+        r -= step * q
+        z_ = _v_cycle(top, r)
+        rz, previous = np.sum(r * z_), rz
+        p = z_ + (rz / previous) * p
+    out[free] = u[free]
+    return out
+
+
+TREND_METHODS = ('linear', 'harmonic')
+
+
+def trend_from_samples(rings, samples, values, cellsize, method='linear'):
+    """
+    Z0 "trend" surface between values sampled along the perimeter rings (one samples and values array per ring).
+
+    Only the cells inside the rings are computed.  'linear' interpolates on the Delaunay triangulation of the samples,
+    as griddata (and gdal:gridlinear) would, by vectorized barycentric lookup; 'harmonic' solves Laplace's equation
+    with the perimeter as the boundary (see harmonic_fill), which is smooth everywhere inside and never overshoots
+    the perimeter values.  The grid is fitted to the samples' extent; returns the grid and the values, NaN outside.
+    """
+    if method not in TREND_METHODS:
+        raise ValueError('Unknown trend method {!r}'.format(method))
+    xy = np.vstack(samples)
+    z = np.concatenate(values)
+    keep = np.isfinite(z)
+    grid = Grid.fit_nodes(*bounds([xy[keep]]), cellsize)
+    inside = rasterize_polygons(rings, grid)
+    if method == 'linear':
+        return grid, Triangulation(xy[keep], z[keep]).grid(grid, mask=inside)
+
+    # Boundary values every half cell along the rings, by linear interpolation along each ring between its samples.
+    boundary_xy = []
+    boundary_z = []
+    for ring, ring_samples, ring_values in zip(rings, samples, values):
+        known = np.isfinite(ring_values)
+        if not known.any():
+            continue
+        dense = densify_line(ring, cellsize / 2)
+        # densify_line keeps the ring's vertices, so distances along both point lists are distances along the ring.
+        along = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(ring_samples, axis=0).T))])
+        dense_along = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(dense, axis=0).T))])
+        boundary_xy.append(dense)
+        boundary_z.append(np.interp(dense_along, along[known], ring_values[known]))
+    return grid, harmonic_fill(grid, inside, np.vstack(boundary_xy), np.concatenate(boundary_z))
+
+
+def buffered_grid(rings, cellsize=0.05, buffer=0.1):
+    """The IDW raster's grid: the extent of the rings grown by the buffer distance, so the perimeter can sample it."""
+    xmin, ymin, xmax, ymax = bounds(rings)
+    return Grid.fit_nodes(xmin - buffer, ymin - buffer, xmax + buffer, ymax + buffer, cellsize)
+
+
+def perimeter_samples(rings, idw, grid, spacing=0.2):
+    """
+    The rings densified to `spacing` and the IDW estimates there, without building the IDW raster.
+
+    `idw` is an IdwInterpolator and `grid` the IDW raster's grid.  Each sample takes the estimate at the centre of its
+    cell, which is what sampling the whole raster gives, so only a few thousand targets are evaluated instead of every
+    cell.  Samples outside the grid are NaN.  Returns per-ring lists of samples and values.
+    """
+    samples = [densify_line(ring, spacing) for ring in rings]
+    values = []
+    for ring in samples:
+        rows, cols, inside = grid.cell_index(ring)
+        ring_values = np.full(len(ring), np.nan)
+        ring_values[inside] = idw(np.column_stack([grid.xmin + (cols[inside] + 0.5) * grid.cellsize,
+                                                   grid.ymax - (rows[inside] + 0.5) * grid.cellsize]))
+        values.append(ring_values)
+    return samples, values
+
+
+def trend_surface(perimeter, xy, z, cellsize=0.05, buffer=0.1, spacing=0.2, power=1.5, max_points=20, radius=1000.0,
+                  workers=None, method='linear', idw_raster=True):
+    """
+    Array version of the TrendSurface model.
+
+    perimeter is a list of lines, xy/z the surface points.  Returns (idw_grid, idw, trend_grid, trend),
+    both rasters clipped to the perimeter polygon.  `method` is the trend_from_samples method.  Without `idw_raster`
+    the IDW is only evaluated at the perimeter samples and idw_grid and idw are None.
+    """
+    rings = [close_ring(line) for line in perimeter]
+    grid = buffered_grid(rings, cellsize, buffer)
+    idw = IdwInterpolator(xy, z, power, max_points, radius, workers=workers)
+
+    # Sample the IDW surface along the perimeter and interpolate the Z0 "trend" surface between the samples.
+    if idw_raster:
+        surface = idw.grid(grid)
+        samples = [densify_line(ring, spacing) for ring in rings]
+        values = [grid.sample(surface, ring) for ring in samples]
+    else:
+        samples, values = perimeter_samples(rings, idw, grid, spacing)
+    trend_grid, trend = trend_from_samples(rings, samples, values, cellsize, method)
+
+    trend_grid, trend_clip = clip_to_polygons(trend_grid, trend, rings)
+    if not idw_raster:
+        return None, None, trend_grid, trend_clip
+    idw_grid, idw_clip = clip_to_polygons(grid, surface, rings)
+    return idw_grid, idw_clip, trend_grid, trend_clip
+
+
+def trend_surface_tiles(perimeter, xy, z, cellsize=0.05, buffer=0.1, spacing=0.2, power=1.5, max_points=20,
+                        radius=1000.0, workers=None, tile=1024, method='linear'):
+    """
+    trend_surface one tile at a time, for rasters too large to hold in memory.
+
+    Returns (idw_grid, idw_tiles, trend_grid, trend_tiles): the grids of trend_surface's clipped outputs and generators
+    of (rows, cols, values) tiles of them.  IDW estimates do not depend on neighbouring cells, so the IDW is evaluated
+    tile by tile on the clipped grid only, and the perimeter samples come from perimeter_samples; IDW tiles that are
+    never consumed are never evaluated.  Peak memory is a tile plus the points, except with the 'harmonic' trend
+    method, which solves the whole trend grid at once.
+    """
+    rings = [close_ring(line) for line in perimeter]
+    grid = buffered_grid(rings, cellsize, buffer)
+    idw = IdwInterpolator(xy, z, power, max_points, radius, workers=workers)
+
+    ring_samples, ring_values = perimeter_samples(rings, idw, grid, spacing)
+    samples = np.vstack(ring_samples)
+    values = np.concatenate(ring_values)
+    keep = np.isfinite(values)
+    trend_grid = Grid.fit_nodes(*bounds([samples[keep]]), cellsize)
+    if method == 'linear':
+        # Same Delaunay-based linear interpolation as griddata's, built once for all tiles.
+        estimate = Triangulation(samples[keep], values[keep]).interpolate
+    else:
+        harmonic_grid, harmonic = trend_from_samples(rings, ring_samples, ring_values, cellsize, method)
+
+        def estimate(xy):
+            return harmonic_grid.sample(harmonic, xy)
+
+    def clipped_tiles(grid, estimate):
+        for rows, cols, _, _ in tiles(grid, tile):
+            block = grid.subgrid(rows, cols)
+            inside = rasterize_polygons(rings, block)
+            block_values = np.full(block.shape, np.nan)
+            block_values[inside] = estimate(block.centres()[inside.ravel()])
+            yield rows, cols, block_values
+
+    idw_grid = grid.subgrid(*grid.window(*bounds(rings)))
+    trend_grid = trend_grid.subgrid(*trend_grid.window(*bounds(rings)))
+    return idw_grid, clipped_tiles(idw_grid, idw), trend_grid, clipped_tiles(trend_grid, estimate)
+
+
+WEAR_SIDES = ('left', 'right')
+WEAR_SECTIONS = ('distal', 'medial', 'proximal')
+
+
+def edge_positions(ring, proximal, spacing=0.01):
+    """
+    Split a closed perimeter at the ends of its long axis into a left and a right edge, measured from the distal end.
+
+    The long axis is the principal axis of the perimeter; its end nearer `proximal` (a point on the striking platform)
+    is the proximal end.  Left and right are as seen on the dorsal face with the proximal end up.  Returns the
+    perimeter densified to `spacing`, the side of each vertex (0 left, 1 right), its distance from the distal end
+    along its edge, and the length of both edges.
+    """
+    vertices = densify_line(close_ring(ring), spacing)
+    steps = np.hypot(*np.diff(vertices, axis=0).T)
+    vertices = vertices[:-1]
+    centre = vertices.mean(axis=0)
+    axis = np.linalg.eigh(np.cov((vertices - centre).T))[1][:, -1]
+    if np.dot(np.asarray(proximal, dtype=float) - centre, axis) < 0:
+        axis = -axis
+    along = (vertices - centre) @ axis
+    distal, tip = np.argmin(along), np.argmax(along)
+
+    # Distance around the ring from the distal end; up to the tip is one edge, the rest comes back along the other.
+    distance = np.mod(np.concatenate([[0.0], np.cumsum(steps[:-1])]) - np.sum(steps[:distal]), steps.sum())
+    forward = distance <= distance[tip]
+    position = np.where(forward, distance, steps.sum() - distance)
+    middle = vertices[np.argmin(np.abs(distance - distance[tip] / 2))] - centre
+    forward_side = 0 if axis[0] * middle[1] - axis[1] * middle[0] > 0 else 1
+    side = np.where(forward, forward_side, 1 - forward_side)
+    lengths = np.zeros(2)
+    lengths[forward_side] = distance[tip]
+    lengths[1 - forward_side] = steps.sum() - distance[tip]
+    return vertices, side, position, lengths
+
+
+def wear_profile(faces, ring, proximal, bin_size=0.1, sections=(0.25, 0.75)):
+    """
+    Missing volume along the left and right edges, in bins of `bin_size` from the distal end.
+
+    `faces` is a list of (grid, worn, reconstruction) per face, dorsal first, with both surfaces on the same grid as
+    heights above the Z=0 edge.  A cell's loss is the reconstructed height above the worn one, or all of it where the
+    worn surface has no data (worn off).  Each reconstructed cell goes to the bin of the nearest perimeter point, and
+    all bins are summed in one bincount per face.  Sections split each edge at the given fractions of its length.
+
+    These are measures of their own, not the volume and index columns of MB_all_wear.csv, whose definitions are not
+    known: its pooled volume is not the sum of the face volumes, and its face indices are not percentages of its face
+    volumes.  Returns a dict of arrays, one entry per non-empty bin: 'side' (0 left, 1 right), 'position' (upper end
+    of the bin, mm), 'section' (index into WEAR_SECTIONS), 'loss' (mm3, all faces together), 'loss pct' (the loss as a
+    percentage of the reconstructed volume, all faces pooled), and per face, one column each, 'face loss' and
+    'face loss pct'.
+    """
+    vertices, vertex_side, vertex_position, lengths = edge_positions(ring, proximal, bin_size / 10)
+    tree = cKDTree(vertices)
+    nbins = int(np.ceil(lengths.max() / bin_size)) + 1
+    loss = np.zeros((len(faces), 2 * nbins))
+    volume = np.zeros((len(faces), 2 * nbins))
+    cells = np.zeros(2 * nbins)
+    for face, (grid, worn, reconstruction) in enumerate(faces):
+        rows, cols = np.nonzero(np.isfinite(reconstruction))
+        _, nearest = tree.query(np.column_stack([grid.x_centres()[cols], grid.y_centres()[rows]]))
+        bins = np.minimum((vertex_position[nearest] / bin_size).astype(int), nbins - 1)
+        key = vertex_side[nearest] * nbins + bins
+        height = np.maximum(reconstruction[rows, cols], 0.0)
+        lost = np.clip(height - np.nan_to_num(worn[rows, cols], nan=0.0), 0.0, None)
+        area = grid.cellsize ** 2
+        loss[face] = np.bincount(key, lost * area, 2 * nbins)
+        volume[face] = np.bincount(key, height * area, 2 * nbins)
+        cells += np.bincount(key, minlength=2 * nbins)
+
+    present = np.nonzero(cells)[0]
+    side = present // nbins
+    position = (present % nbins + 1) * bin_size
+    fraction = (position - bin_size / 2) / lengths[side]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        face_percent = np.nan_to_num(100 * loss[:, present] / volume[:, present])
+        percent = np.nan_to_num(100 * loss[:, present].sum(axis=0) / volume[:, present].sum(axis=0))
+    return {
+        'side': side,
+        'position': np.round(position, 6),
+        'section': np.searchsorted(sections, fraction, side='right'),
+        'loss': loss[:, present].sum(axis=0),
+        'loss pct': percent,
+        'face loss': loss[:, present].T,
+        'face loss pct': face_percent.T,
+    }
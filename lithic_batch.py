@@ -0,0 +1,320 @@
+"""
+Batch driver: run EdgeFromProjection04 and TrendSurface over a whole collection.
+
+    python lithic_batch.py manifest.json --workers 8 --retries 1 --summary summary.json
+
+The manifest is JSON.  Paths are relative to the manifest file.
+
+    {
+        "output": "reconstructions",
+        "defaults": {"expectedflakescarlengthmm": 0.8},
+        "specimens": [
+            {
+                "id": "MB11-2",
+                "lithicsurface": "MB11-2/dorsal.tif",
+                "wornventralsurface": "MB11-2/ventral.tif",
+                "perimeter": "MB11-2/perimeter.shp",
+                "platformspolygon": "MB11-2/platforms.shp",
+                "projectedpoints": "MB11-2/projected.shp",
+                "parameters": {"expectedflakescarlengthmm": 1.2},
+                "trend": [
+                    {"side": "dorsal", "points": "MB11-2/dorsal_pts.shp", "zfield": "Z"},
+                    {"side": "ventral", "points": "MB11-2/ventral_pts.shp", "zfield": "Z"}
+                ]
+            }
+        ]
+    }
+
+Each specimen gives one EdgeFromProjection04 job (when its edge inputs are listed) and one TrendSurface job per
+"trend" entry.  Jobs run in a pool of spawned processes, each with its own headless QGIS, and write into their own
+output folders; their intermediate files go to a temporary folder of their own that is removed when they finish.  A
+job that fails, or whose worker dies while running it, is retried on a fresh pool.  Job names (the specimen id, plus
+the trend side) must be unique.
+"""
+import argparse
+import atexit
+import collections
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+if HERE not in sys.path:
+    sys.path.insert(0, HERE)
+
+# Algorithm class -> script file.  The scripts are not importable by name (one has spaces), so they are loaded by path.
+SCRIPTS = {
+    'TrendSurface': 'Flake_Flattener_001.py',
+    'EdgeFromProjection04': 'edge from projection 04.py',
+    'WearProfile': 'Wear_Profile_001.py',
+}
+PROVIDER_ID = 'lithics'
+
+EDGE_INPUTS = ['lithicsurface', 'wornventralsurface', 'perimeter', 'platformspolygon', 'projectedpoints']
+
+
+def load_algorithm(class_name):
+    """A fresh instance of one of the script algorithms."""
+    path = os.path.join(HERE, SCRIPTS[class_name])
+    spec = importlib.util.spec_from_file_location(class_name.lower(), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)()
+
+
+def start_qgis():
+    """Start a headless QGIS with the processing framework, its GDAL/SAGA providers and the lithic algorithms."""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from qgis.core import QgsApplication, QgsProcessingProvider
+    from qgis.analysis import QgsNativeAlgorithms
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+
+    class LithicsProvider(QgsProcessingProvider):
+
+        def loadAlgorithms(self):
+            for class_name in SCRIPTS:
+                self.addAlgorithm(load_algorithm(class_name))
+
+        def id(self):
+            return PROVIDER_ID
+
+        def name(self):
+            return 'lithic analysis'
+
+    # Keep a reference on the application so the provider outlives this function.
+    app.lithics_provider = LithicsProvider()
+    QgsApplication.processingRegistry().addProvider(app.lithics_provider)
+    return app
+
+
+def algorithm_id(class_name):
+    return '{}:{}'.format(PROVIDER_ID, load_algorithm(class_name).name())
+
+
+def _path(base, value):
+    return value if os.path.isabs(value) else os.path.normpath(os.path.join(base, value))
+
+
+def build_jobs(manifest, base):
+    """Expand a manifest into a list of independent jobs."""
+    output = _path(base, manifest.get('output', 'output'))
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for specimen in manifest['specimens']:
+        name = specimen['id']
+        folder = os.path.join(output, name)
+        if all(key in specimen for key in EDGE_INPUTS):
+            parameters = dict(defaults)
+            parameters.update(specimen.get('parameters', {}))
+            parameters.update({key: _path(base, specimen[key]) for key in EDGE_INPUTS})
+            parameters['DorsalReconstruction'] = os.path.join(folder, 'dorsal_reconstruction.tif')
+            parameters['VentralReconstruction'] = os.path.join(folder, 'ventral_reconstruction.tif')
+            jobs.append({'name': '{} edge'.format(name), 'algorithm': 'EdgeFromProjection04',
+                         'parameters': parameters, 'folder': folder})
+        for trend in specimen.get('trend', []):
+            side = trend.get('side', 'surface')
+            parameters = {
+                'perimeter': _path(base, trend.get('perimeter', specimen['perimeter'])),
+                'points': _path(base, trend['points']),
+                'zfield': trend.get('zfield', 'Z'),
+                'Idw': os.path.join(folder, '{}_idw.tif'.format(side)),
+                'Trend': os.path.join(folder, '{}_trend.tif'.format(side)),
+            }
+            parameters.update(trend.get('parameters', {}))
+            jobs.append({'name': '{} trend {}'.format(name, side), 'algorithm': 'TrendSurface',
+                         'parameters': parameters, 'folder': folder})
+    return jobs
+
+
+_app = None
+_algorithm_ids = {}
+# Where a pool worker reports the jobs it starts and finishes, so the driver knows which jobs a dead worker was running.
+_started = None
+# The worker process's own temporary folder, which holds its jobs' temporary folders.
+_temp = None
+
+
+def _init_worker(started=None, temp_root=None):
+    """
+    Start QGIS in a worker process, with a temporary folder of its own in `temp_root` (the system temp folder by
+    default).  The folder is handed to QGIS through the environment, never through the processing settings, which are
+    saved in the user's profile and shared by every QGIS process.
+    """
+    global _app, _started, _temp
+    _temp = tempfile.mkdtemp(prefix='lithic_worker_', dir=temp_root)
+    atexit.register(shutil.rmtree, _temp, True)
+    # QGIS puts its default processing folder in QDir::tempPath(), which reads these; Python's tempfile has already
+    # read them.
+    for variable in ['TMPDIR', 'TEMP', 'TMP']:
+        os.environ[variable] = _temp
+    tempfile.tempdir = _temp
+    _app = start_qgis()
+    _started = started
+    for class_name in SCRIPTS:
+        _algorithm_ids[class_name] = algorithm_id(class_name)
+
+
+def _empty_folder(folder):
+    """Remove everything in `folder`, leaving the folder itself."""
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def run_job(job):
+    """
+    Run one job in a worker process started by _init_worker; raises on failure so the driver can retry it.
+
+    The job's intermediate files go to a temporary folder of its own in the process's temporary folder, which is
+    emptied afterwards.  QGIS 3.32 and later take the job's folder from the processing context; earlier versions write
+    to their default processing folder, which is inside the process's folder too unless the user's profile names a
+    processing temporary folder.
+    """
+    import processing
+    from qgis.core import QgsProcessingContext, QgsProcessingFeedback
+
+    if job.get('folder'):
+        os.makedirs(job['folder'], exist_ok=True)
+    # Per-job temporary folder, so concurrent jobs never share intermediate files.
+    temp = tempfile.mkdtemp(prefix='lithic_job_', dir=_temp)
+    if _started is not None:
+        _started.put(('start', job['name']))
+    try:
+        context = QgsProcessingContext()
+        if hasattr(context, 'setTemporaryFolder'):
+            context.setTemporaryFolder(temp)
+        feedback = QgsProcessingFeedback()
+        start = time.perf_counter()
+        result = processing.run(_algorithm_ids[job['algorithm']], job['parameters'], context=context,
+                                feedback=feedback)
+        # Memory layers and temporary outputs held by the context go before their folder does.
+        del context
+        return {
+            'outputs': {key: value for key, value in result.items() if isinstance(value, str)},
+            'seconds': time.perf_counter() - start,
+        }
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+        # The folders QGIS made in the process's folder stay (QGIS keeps writing to them), their contents go.
+        for name in os.listdir(_temp):
+            if os.path.isdir(os.path.join(_temp, name)):
+                _empty_folder(os.path.join(_temp, name))
+        if _started is not None:
+            _started.put(('end', job['name']))
+
+
+def _running(started, running):
+    """Update the set of jobs started and not finished from the pool workers' reports."""
+    while not started.empty():
+        event, name = started.get()
+        if event == 'start':
+            running.add(name)
+        else:
+            running.discard(name)
+
+
+def run_batch(jobs, workers=None, retries=1, log=print):
+    """Run the jobs across a process pool.  Returns one summary record per job."""
+    names = collections.Counter(job['name'] for job in jobs)
+    duplicates = sorted(name for name, count in names.items() if count > 1)
+    if duplicates:
+        # Records are kept by name, and jobs of the same name would write the same output files.
+        raise ValueError('Duplicate job names: {}'.format(', '.join(duplicates)))
+    workers = workers or os.cpu_count() or 1
+    records = {job['name']: {'job': job['name'], 'status': 'pending', 'attempts': 0} for job in jobs}
+    pending = list(jobs)
+    done = 0
+    spawn = multiprocessing.get_context('spawn')
+    while pending:
+        failed = []
+        started = spawn.SimpleQueue()
+        running = set()
+        broken = None
+        with ProcessPoolExecutor(min(workers, len(pending)), mp_context=spawn, initializer=_init_worker,
+                                 initargs=(started,)) as pool:
+            futures = {pool.submit(run_job, job): job for job in pending}
+            for future in as_completed(futures):
+                job = futures[future]
+                record = records[job['name']]
+                _running(started, running)
+                try:
+                    record.update(future.result(), status='ok')
+                    record.pop('error', None)
+                except BrokenProcessPool as e:
+                    # Every job still queued fails with the pool; only the jobs a worker was running when it died are
+                    # charged an attempt.  If none was (the worker died starting up), all of them are, so a pool that
+                    # cannot start does not retry forever.
+                    if broken is None:
+                        broken = set(running)
+                    if broken and job['name'] not in broken:
+                        failed.append(job)
+                        continue
+                    record.update(status='failed', error='worker died: {}'.format(e))
+                except Exception as e:
+                    record.update(status='failed', error=str(e))
+                record['attempts'] += 1
+                if record['status'] == 'ok':
+                    done += 1
+                    log('[{}/{}] {} ok in {:.1f} s'.format(done, len(jobs), job['name'], record['seconds']))
+                elif record['attempts'] <= retries:
+                    log('{} failed (attempt {}), will retry: {}'.format(job['name'], record['attempts'],
+                                                                        record['error']))
+                    failed.append(job)
+                else:
+                    done += 1
+                    log('[{}/{}] {} FAILED: {}'.format(done, len(jobs), job['name'], record['error']))
+        pending = failed
+    return [records[job['name']] for job in jobs]
+
+
+def summarize(records):
+    ok = [r for r in records if r['status'] == 'ok']
+    lines = ['{} of {} jobs succeeded'.format(len(ok), len(records))]
+    if ok:
+        lines.append('total job time {:.1f} s, slowest {} ({:.1f} s)'.format(
+            sum(r['seconds'] for r in ok), *max(((r['job'], r['seconds']) for r in ok), key=lambda item: item[1])))
+    lines.extend('  failed: {} ({})'.format(r['job'], r['error']) for r in records if r['status'] != 'ok')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('manifest')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--retries', type=int, default=1, help='extra attempts for a failed job')
+    parser.add_argument('--summary', help='write the per-job summary to this JSON file')
+    args = parser.parse_args(argv)
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    jobs = build_jobs(manifest, os.path.dirname(os.path.abspath(args.manifest)))
+    start = time.perf_counter()
+    records = run_batch(jobs, args.workers, args.retries)
+    print(summarize(records))
+    print('wall time {:.1f} s'.format(time.perf_counter() - start))
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(records, f, indent=2)
+    return 0 if all(r['status'] == 'ok' for r in records) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
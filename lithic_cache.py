@@ -0,0 +1,250 @@
+"""
+Persistent, content-addressed cache of model step outputs.
+
+A step's key is a hash of its algorithm and parameters, where inputs read from disk contribute a hash of their
+content and outputs of other steps contribute those steps' keys.  A key therefore changes whenever anything upstream
+changes, and stays the same across runs and QGIS sessions otherwise.  Layers not backed by a file (memory and
+database layers) have no content to hash, so steps reading them, and the steps downstream, are never cached.  Entries
+are folders holding copies of the output files; the least recently used entries are evicted once the cache grows past
+its size cap.  Outputs that only reference other files, such as VRTs, are stored with the content hashes of the files
+they reference and only reused while those files are unchanged.  The project CRS ('ProjectCrs') and CRS objects
+contribute their WKT.
+
+The cache lives in LITHICS_CACHE_DIR (default: lithics_cache in the QGIS settings folder) and is capped at
+LITHICS_CACHE_MB megabytes (default 2048).
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import xml.etree.ElementTree as ElementTree
+
+# Bump when the way a step computes its outputs changes without its parameters changing.
+CACHE_VERSION = 1
+MANIFEST = 'manifest.json'
+# Formats whose files reference their source data instead of holding it.
+REFERENCE_EXTENSIONS = ('.vrt',)
+
+
+class Uncacheable(Exception):
+    """A parameter value whose content cannot be hashed, such as a memory or database layer."""
+
+
+def default_folder():
+    folder = os.environ.get('LITHICS_CACHE_DIR')
+    if folder:
+        return folder
+    from qgis.core import QgsApplication
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), 'lithics_cache')
+
+
+def _file_set(path):
+    """A file plus its sidecars (.dbf/.shx/.prj of a shapefile, .aux.xml of a raster, .sdat of an SGRID...)."""
+    stem = os.path.splitext(path)[0]
+    return sorted(set(glob.glob(glob.escape(stem) + '.*')) | {path})
+
+
+def _source_path(value, context):
+    """The file behind a parameter value, or None if it is not a layer.  Raises Uncacheable for other layers."""
+    from qgis.core import QgsMapLayer, QgsProcessingUtils
+    if isinstance(value, str) and os.path.isfile(value.split('|')[0]):
+        return value.split('|')[0]
+    layer = value if isinstance(value, QgsMapLayer) else None
+    if layer is None and isinstance(value, str) and context is not None:
+        layer = QgsProcessingUtils.mapLayerFromString(value, context)
+    if layer is not None and layer.providerType() in ('ogr', 'gdal'):
+        path = layer.source().split('|')[0]
+        if os.path.isfile(path):
+            return path
+    if layer is not None:
+        raise Uncacheable('{} ({} layer)'.format(layer.name(), layer.providerType()))
+    return None
+
+
+def _vrt_sources(path):
+    """The VRT's parsed XML and, for each SourceFilename element, the element and the absolute path it names."""
+    tree = ElementTree.parse(path)
+    sources = []
+    for element in tree.iter('SourceFilename'):
+        source = element.text or ''
+        if element.get('relativeToVRT') == '1':
+            source = os.path.join(os.path.dirname(os.path.abspath(path)), source)
+        sources.append((element, os.path.abspath(source)))
+    return tree, sources
+
+
+def _current(memo):
+    """Whether a file hash memo still describes its file."""
+    path, size, mtime = memo.rsplit('|', 2)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_size == int(size) and stat.st_mtime_ns == int(mtime)
+
+
+class StepCache:
+
+    def __init__(self, folder=None, max_bytes=None):
+        self.folder = folder or default_folder()
+        if max_bytes is None:
+            max_bytes = float(os.environ.get('LITHICS_CACHE_MB', 2048)) * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+        self._hashes_path = os.path.join(self.folder, 'file_hashes.json')
+        try:
+            with open(self._hashes_path) as f:
+                self._hashes = json.load(f)
+        except (IOError, ValueError):
+            self._hashes = {}
+
+    def file_hash(self, path):
+        """Content hash of a file and its sidecars, remembered by path, size and modification time."""
+        digest = hashlib.sha256()
+        for member in _file_set(path):
+            stat = os.stat(member)
+            memo = '{}|{}|{}'.format(os.path.abspath(member), stat.st_size, stat.st_mtime_ns)
+            if memo not in self._hashes:
+                member_digest = hashlib.sha256()
+                with open(member, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        member_digest.update(chunk)
+                self._hashes[memo] = member_digest.hexdigest()
+            digest.update(os.path.basename(member).encode())
+            digest.update(self._hashes[memo].encode())
+        return digest.hexdigest()
+
+    def fingerprint(self, value, context):
+        """
+        A JSON-able stand-in for a root parameter value: file contents for files and layers, the WKT for CRSs (the
+        project CRS included), repr otherwise.  Raises Uncacheable for layers not backed by a file.
+        """
+        if isinstance(value, (list, tuple)):
+            return [self.fingerprint(item, context) for item in value]
+        if isinstance(value, dict):
+            return {key: self.fingerprint(item, context) for key, item in sorted(value.items())}
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        from qgis.core import QgsCoordinateReferenceSystem
+        if isinstance(value, QgsCoordinateReferenceSystem):
+            return {'crs': value.toWkt()}
+        if value == 'ProjectCrs':
+            project = context.project() if context is not None else None
+            return {'crs': project.crs().toWkt() if project is not None else ''}
+        path = _source_path(value, context)
+        if path:
+            return {'file': self.file_hash(path)}
+        return repr(value)
+
+    def key(self, algorithm, params):
+        text = json.dumps({'version': CACHE_VERSION, 'algorithm': algorithm, 'params': params}, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key):
+        """Outputs of a cached step, or None."""
+        entry = os.path.join(self.folder, key)
+        manifest = os.path.join(entry, MANIFEST)
+        try:
+            with open(manifest) as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            return None
+        outputs = {}
+        for name, value in stored.items():
+            if isinstance(value, dict) and 'file' in value:
+                # A reference to other files is only good while they are the files it was made from.
+                for source, digest in value.get('sources', {}).items():
+                    if not os.path.isfile(source) or self.file_hash(source) != digest:
+                        return None
+                value = os.path.join(entry, value['file'])
+                if not os.path.exists(value):
+                    return None
+            outputs[name] = value
+        # Touch the manifest: its modification time is the entry's last use for LRU eviction.
+        os.utime(manifest)
+        return outputs
+
+    def put(self, key, outputs):
+        """
+        Store a step's outputs.  Only outputs that are files or plain values can be cached; a step with memory layers
+        or arrays among its outputs is left out.  A reference to other files (REFERENCE_EXTENSIONS) is stored with
+        their paths made absolute and their content hashes, and is left out if they are not plain files.  Returns True
+        if stored.
+        """
+        stored = {}
+        files = []
+        references = {}
+        for name, value in outputs.items():
+            if isinstance(value, str) and value.lower().endswith(REFERENCE_EXTENSIONS) and os.path.isfile(value):
+                try:
+                    tree, sources = _vrt_sources(value)
+                except ElementTree.ParseError:
+                    return False
+                if not all(os.path.isfile(source) for _, source in sources):
+                    return False
+                for element, source in sources:
+                    element.text = source
+                    element.set('relativeToVRT', '0')
+                references[os.path.basename(value)] = tree
+                stored[name] = {'file': os.path.basename(value),
+                                'sources': {source: self.file_hash(source) for _, source in sources}}
+            elif isinstance(value, str) and os.path.isfile(value):
+                stored[name] = {'file': os.path.basename(value)}
+                files.extend(_file_set(value))
+            elif value is None or isinstance(value, (bool, int, float)):
+                stored[name] = value
+            else:
+                return False
+        entry = os.path.join(self.folder, key)
+        if os.path.exists(entry):
+            return True
+        staging = tempfile.mkdtemp(prefix='.staging_', dir=self.folder)
+        try:
+            for path in set(files):
+                shutil.copy2(path, staging)
+            for name, tree in references.items():
+                tree.write(os.path.join(staging, name))
+            with open(os.path.join(staging, MANIFEST), 'w') as f:
+                json.dump(stored, f)
+            os.rename(staging, entry)
+        except OSError:
+            # Another run stored the same entry first, or the copy failed; either way there is nothing to keep.
+            shutil.rmtree(staging, ignore_errors=True)
+            return os.path.exists(entry)
+        self.evict()
+        return True
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its size cap."""
+        with self.lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.folder):
+                manifest = os.path.join(self.folder, name, MANIFEST)
+                if not os.path.isfile(manifest):
+                    continue
+                size = sum(os.path.getsize(os.path.join(self.folder, name, member))
+                           for member in os.listdir(os.path.join(self.folder, name)))
+                entries.append((os.path.getmtime(manifest), size, name))
+                total += size
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+                total -= size
+
+    def save(self):
+        """
+        Persist the file hash memo so unchanged inputs are not hashed again in the next session.  Memos of files that
+        have since changed or gone are dropped, so the memo does not grow with every file ever hashed.
+        """
+        with self.lock:
+            self._hashes = {memo: digest for memo, digest in self._hashes.items() if _current(memo)}
+            staging = self._hashes_path + '.tmp{}'.format(os.getpid())
+            with open(staging, 'w') as f:
+                json.dump(self._hashes, f)
+            os.replace(staging, self._hashes_path)
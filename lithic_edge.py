@@ -0,0 +1,201 @@
+"""
+In-process stages for EdgeFromProjection04.
+
+Each stage has the signature lithic_pipeline.Stage expects, function(params, context, feedback) -> outputs, so it can
+stand in for one or more child algorithms in the model graph.  The array work itself is in lithic_arrays.
+"""
+import numpy as np
+from qgis.core import QgsProcessingException
+
+import lithic_arrays
+import lithic_io
+import lithic_layers
+
+
+def _edge_points(layers, context):
+    xy = []
+    z = []
+    for layer in layers:
+        layer_xy, layer_z = lithic_layers.point_values(lithic_layers.as_layer(layer, context), 'Z')
+        xy.append(layer_xy)
+        z.append(layer_z)
+    return np.vstack(xy), np.concatenate(z)
+
+
+def _polygon_index(layer, context):
+    return lithic_arrays.PolygonIndex(lithic_layers.polygon_parts(lithic_layers.as_layer(layer, context)))
+
+
+def infill_stage(params, context, feedback):
+    """
+    Raster infill reconstruction of one surface.
+
+    SURFACE is the clipped DEM, EDGE the Z=0 edge point layers, ALPHA the concave hull threshold and HULL 'alpha' or
+    'mask' (see lithic_arrays.infill).  Replaces raster values to points, refactor fields, merge, concave hull,
+    gridlinear and the final clip.  With a TILE size, the alpha hull infill reads and writes the surface in tiles of
+    that many cells instead of holding it in memory.
+    """
+    xy, z = _edge_points(params['EDGE'], context)
+    tile = params.get('TILE', 0)
+    hull = params.get('HULL', 'alpha')
+    if tile and hull == 'alpha':
+        surface = lithic_io.RasterReader(params['SURFACE'])
+        grid, tiles = lithic_arrays.infill_tiles(surface, surface.grid, xy, z, params['ALPHA'], tile)
+        feedback.pushInfo('Filling {} x {} cells in tiles of {}'.format(grid.ncols, grid.nrows, tile))
+        return {'OUTPUT': lithic_io.write_tiles(params['OUTPUT'], grid, tiles, surface.crs_wkt)}
+    if tile:
+        # The mask hull fills holes, which needs the whole raster at once.
+        feedback.pushInfo('The raster mask footprint is computed on the whole surface; tile size ignored')
+    grid, values = lithic_io.read_raster(params['SURFACE'])
+    known = np.isfinite(values).sum()
+    grid, filled = lithic_arrays.infill(grid, values, xy, z, params['ALPHA'], hull)
+    feedback.pushInfo('Filled {} cells between {} surface cells and {} edge points'.format(
+        np.isfinite(filled).sum() - known, known, len(z)))
+    crs = lithic_io.raster_crs(params['SURFACE'])
+    return {'OUTPUT': lithic_io.write_raster(params['OUTPUT'], grid, filled, crs)}
+
+
+def preview_stage(params, context, feedback):
+    """
+    Quick raster infill of one surface on the coarsest level of its DEM pyramid at most CELLSIZE (see
+    lithic_arrays.pyramid).
+
+    Same parameters as infill_stage.  The preview is written as soon as it is ready.  The full resolution infill does
+    not start from it: alpha hulls depend on the resolution, so infill_stage fills the whole surface anew.
+    """
+    xy, z = _edge_points(params['EDGE'], context)
+    grid, values = lithic_io.read_raster(params['SURFACE'])
+    levels = lithic_arrays.pyramid(grid, values, params.get('CELLSIZE', lithic_arrays.PREVIEW_CELLSIZE))
+    coarse_grid, coarse = levels[-1]
+    coarse_grid, filled = lithic_arrays.infill(coarse_grid, coarse, xy, z, params['ALPHA'], params.get('HULL', 'alpha'))
+    path = lithic_io.write_raster(params['OUTPUT'], coarse_grid, filled, lithic_io.raster_crs(params['SURFACE']))
+    feedback.pushInfo('Preview at {:g} ({} x {} cells, 1/{} resolution) written to {}'.format(
+        coarse_grid.cellsize, coarse_grid.ncols, coarse_grid.nrows, 2 ** (len(levels) - 1), path))
+    return {'OUTPUT': path}
+
+
+def tin_stage(params, context, feedback):
+    """
+    Linear TIN reconstruction of one surface from every remaining pixel plus the edge points, triangulated once.
+
+    Same parameters as infill_stage.  Replaces raster values to points, refactor fields, merge, gridlinear, concave
+    hull and the final clip; the output is on the DEM grid rather than gdal_grid's default 256 x 256.
+    """
+    grid, values = lithic_io.read_raster(params['SURFACE'])
+    xy, z = _edge_points(params['EDGE'], context)
+    grid, surface = lithic_arrays.tin_reconstruction(grid, values, xy, z, params['ALPHA'], params.get('HULL', 'alpha'))
+    feedback.pushInfo('Triangulated {} surface cells and {} edge points'.format(np.isfinite(values).sum(), len(z)))
+    crs = lithic_io.raster_crs(params['SURFACE'])
+    return {'OUTPUT': lithic_io.write_raster(params['OUTPUT'], grid, surface, crs)}
+
+
+def footprint_stage(params, context, feedback):
+    """
+    Output footprint polygon of one surface, from the known-cell mask and the edge points.
+
+    Stands in for the concave hull (alpha shapes) of the merged pixel and edge points: SURFACE is the clipped DEM,
+    EDGE the Z=0 edge point layers and ALPHA the concave hull threshold.  OUTPUT is a polygon file for the final clip.
+    """
+    grid, values = lithic_io.read_raster(params['SURFACE'])
+    xy, z = _edge_points(params['EDGE'], context)
+    grid, mask = lithic_arrays.footprint(grid, values, xy, z, params['ALPHA'])
+    return {'OUTPUT': lithic_io.polygonize(params['OUTPUT'], grid, mask, lithic_io.raster_crs(params['SURFACE']))}
+
+
+footprint_stage.destinations = {'OUTPUT': ('vector', 'gpkg')}
+
+
+def density_peaks_stage(params, context, feedback):
+    """
+    Density peaks of the projected points above the mean peak density.
+
+    Replaces the heatmap, local minima and maxima, and extract by expression steps.  OUTPUT is a point file with the
+    density in "Z"; PEAKS holds the same peaks' coordinates as an (n, 2) .npy array.
+    """
+    layer = lithic_layers.as_layer(params['INPUT'], context)
+    xy, z = lithic_arrays.density_peaks(lithic_layers.point_coordinates(layer), params['RADIUS'], params['PIXEL_SIZE'])
+    feedback.pushInfo('{} density peaks above the mean'.format(len(z)))
+    np.save(params['PEAKS'], xy)
+    return {'OUTPUT': lithic_io.write_points(params['OUTPUT'], xy, {'Z': z}, layer.crs().toWkt(), 'peaks'),
+            'PEAKS': params['PEAKS']}
+
+
+density_peaks_stage.destinations = {'OUTPUT': ('vector', 'gpkg'), 'PEAKS': ('array', 'npy')}
+
+
+def polar_edge_stage(params, context, feedback):
+    """
+    Edge line from the density peaks (PEAKS, an (n, 2) .npy array) ordered by azimuth around the PERIMETER centroid.
+
+    Replaces centroids, the dummy ID, hub lines, azimuth, extract vertices, extract by location, dummy Z, points to
+    path, explode lines, convert lines to polygons NEWEDGE and the crossline filter.  OUTPUT is a line file of the
+    kept edge segments and POLYGONS the polygon closed by the edge line.
+    """
+    perimeter = lithic_layers.as_layer(params['PERIMETER'], context)
+    centre = lithic_arrays.line_centroid(lithic_layers.line_parts(perimeter))
+    line, segments = lithic_arrays.polar_edge(np.load(params['PEAKS']), centre)
+    if len(line) < 3:
+        raise QgsProcessingException('Only {} density peaks found; cannot draw an edge line'.format(len(line)))
+    feedback.pushInfo('Edge line through {} peaks, {} segments kept'.format(len(line), len(segments)))
+    crs = perimeter.crs().toWkt()
+    return {
+        'OUTPUT': lithic_io.write_lines(params['OUTPUT'], segments, crs, 'edge'),
+        'POLYGONS': lithic_io.write_polygons(params['POLYGONS'], [[lithic_arrays.close_ring(line)]], crs, 'new edge'),
+    }
+
+
+polar_edge_stage.destinations = {'OUTPUT': ('vector', 'gpkg'), 'POLYGONS': ('vector', 'gpkg')}
+
+
+def edge_points_stage(params, context, feedback):
+    """
+    Z=0 points every SPACING along the new edge lines (EDGE) and the worn PERIMETER, with the overlays the
+    reconstructions need.
+
+    NEW_EDGE is the polygon closed by the edge line and PLATFORMS the platform polygons.  Each polygon layer is
+    prepared once and the points are tested against it as boolean masks over the point arrays.  OUTPUT holds the edge
+    points outside the platforms and the perimeter polygon, PERIMETER_POINTS the perimeter points outside the new edge
+    polygon and OUTSIDE_PLATFORMS the edge points outside the platforms, each a point file with a "Z" field.  Replaces points along
+    geometry (twice), the three differences, the dummy Z field calculators and the two refactor fields steps.
+    """
+    edge = lithic_layers.as_layer(params['EDGE'], context)
+    perimeter = lithic_layers.as_layer(params['PERIMETER'], context)
+    spacing = params['SPACING']
+    edge_xy = np.vstack([lithic_arrays.points_along(line, spacing) for line in lithic_layers.line_parts(edge)] +
+                        [np.empty((0, 2))])
+    lines = lithic_layers.line_parts(perimeter)
+    perimeter_xy = np.vstack([lithic_arrays.points_along(line, spacing) for line in lines] + [np.empty((0, 2))])
+
+    new_edge = _polygon_index(params['NEW_EDGE'], context)
+    platforms = _polygon_index(params['PLATFORMS'], context)
+    # The perimeter polygon is the perimeter lines closed, as saga:convertlinestopolygons makes it.
+    worn = lithic_arrays.PolygonIndex([[lithic_arrays.close_ring(line)] for line in lines])
+    outside_platforms = ~platforms.contains(edge_xy)
+    outside_perimeter = outside_platforms & ~worn.contains(edge_xy)
+    perimeter_kept = ~new_edge.contains(perimeter_xy)
+    feedback.pushInfo('{} of {} edge points outside the platforms and the perimeter, {} of {} perimeter points outside '
+                      'the new edge'.format(outside_perimeter.sum(), len(edge_xy), perimeter_kept.sum(),
+                                            len(perimeter_xy)))
+
+    def write(key, xy, name):
+        return lithic_io.write_points(params[key], xy, {'Z': np.zeros(len(xy))}, perimeter.crs().toWkt(), name)
+
+    return {
+        'OUTPUT': write('OUTPUT', edge_xy[outside_perimeter], 'edge points'),
+        'PERIMETER_POINTS': write('PERIMETER_POINTS', perimeter_xy[perimeter_kept], 'perimeter points'),
+        'OUTSIDE_PLATFORMS': write('OUTSIDE_PLATFORMS', edge_xy[outside_platforms], 'edge points outside platforms'),
+    }
+
+
+edge_points_stage.destinations = {'OUTPUT': ('vector', 'gpkg'), 'PERIMETER_POINTS': ('vector', 'gpkg'),
+                                  'OUTSIDE_PLATFORMS': ('vector', 'gpkg')}
+
+
+def stack_stage(params, context, feedback):
+    """
+    Stack single-band rasters (INPUTS) into the bands of one GeoTIFF (OUTPUT), described by LABELS.
+
+    Used for the scar length sweep, whose per-length reconstructions have different extents.
+    """
+    feedback.pushInfo('Stacking {} rasters into {}'.format(len(params['INPUTS']), params['OUTPUT']))
+    return {'OUTPUT': lithic_io.write_stack(params['OUTPUT'], params['INPUTS'], params.get('LABELS'))}
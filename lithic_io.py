@@ -0,0 +1,242 @@
+"""
+GDAL raster input/output for the array versions of the lithic models.
+"""
+import numpy as np
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+
+from lithic_arrays import Grid
+
+# SAGA's default no-data value, so the in-process rasters look like the ones the models have always produced.
+NODATA = -99999.0
+
+
+def read_raster(source, band=1):
+    """Read one band as (Grid, float64 array) with no-data cells set to NaN."""
+    dataset = gdal.Open(source)
+    if dataset is None:
+        raise IOError('Could not open raster {}'.format(source))
+    raster_band = dataset.GetRasterBand(band)
+    values = raster_band.ReadAsArray().astype(np.float64)
+    nodata = raster_band.GetNoDataValue()
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    grid = Grid.from_geotransform(dataset.GetGeoTransform(), dataset.RasterXSize, dataset.RasterYSize)
+    return grid, values
+
+
+def raster_crs(source):
+    dataset = gdal.Open(source)
+    return dataset.GetProjection() if dataset is not None else ''
+
+
+def raster_bounds(source):
+    """(xmin, ymin, xmax, ymax) of a raster."""
+    dataset = gdal.Open(source)
+    if dataset is None:
+        raise IOError('Could not open raster {}'.format(source))
+    xmin, xres, _, ymax, _, yres = dataset.GetGeoTransform()
+    return (xmin, ymax + yres * dataset.RasterYSize, xmin + xres * dataset.RasterXSize, ymax)
+
+
+def read_raster_on(source, grid):
+    """
+    Read the first band resampled onto `grid` (nearest neighbour), with NaN for no data and beyond the raster.  For rasters
+    on another grid, such as gdal:gridlinear's default 256 x 256 cells.
+    """
+    dataset = gdal.Open(source)
+    if dataset is None:
+        raise IOError('Could not open raster {}'.format(source))
+    warped = gdal.Warp('', dataset, format='MEM', outputBounds=(grid.xmin, grid.ymin, grid.xmax, grid.ymax),
+                       width=grid.ncols, height=grid.nrows, resampleAlg='near', dstNodata=NODATA,
+                       outputType=gdal.GDT_Float64)
+    values = warped.GetRasterBand(1).ReadAsArray()
+    values[values == NODATA] = np.nan
+    return values
+
+
+def write_raster(path, grid, values, crs_wkt='', nodata=NODATA):
+    """Write a single-band Float32 GeoTIFF; NaN cells are written as no data."""
+    dataset = gdal.GetDriverByName('GTiff').Create(path, grid.ncols, grid.nrows, 1, gdal.GDT_Float32,
+                                                   ['COMPRESS=LZW', 'TILED=YES'])
+    if dataset is None:
+        raise IOError('Could not create raster {}'.format(path))
+    dataset.SetGeoTransform(grid.geotransform)
+    if crs_wkt:
+        dataset.SetProjection(crs_wkt)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(np.where(np.isfinite(values), values, nodata).astype(np.float32))
+    band.FlushCache()
+    dataset = None
+    return path
+
+
+class RasterReader:
+    """
+    Block-wise reads from one band of a raster, so that only the blocks being processed are in memory.
+
+    Blocks are requested as Grids aligned with the raster's cells, which may extend past it (see
+    lithic_arrays.infill_tiles).
+    """
+
+    def __init__(self, source, band=1):
+        self.dataset = gdal.Open(source)
+        if self.dataset is None:
+            raise IOError('Could not open raster {}'.format(source))
+        self.band = self.dataset.GetRasterBand(band)
+        self.nodata = self.band.GetNoDataValue()
+        self.grid = Grid.from_geotransform(self.dataset.GetGeoTransform(), self.dataset.RasterXSize,
+                                           self.dataset.RasterYSize)
+        self.crs_wkt = self.dataset.GetProjection()
+
+    def __call__(self, block):
+        """float64 values on `block`, NaN for no data and beyond the raster."""
+        row0 = int(round((self.grid.ymax - block.ymax) / self.grid.cellsize))
+        col0 = int(round((block.xmin - self.grid.xmin) / self.grid.cellsize))
+        rows = slice(max(row0, 0), min(row0 + block.nrows, self.grid.nrows))
+        cols = slice(max(col0, 0), min(col0 + block.ncols, self.grid.ncols))
+        values = np.full(block.shape, np.nan)
+        if rows.stop > rows.start and cols.stop > cols.start:
+            read = self.band.ReadAsArray(cols.start, rows.start, cols.stop - cols.start,
+                                         rows.stop - rows.start).astype(np.float64)
+            if self.nodata is not None:
+                read[read == self.nodata] = np.nan
+            values[rows.start - row0:rows.stop - row0, cols.start - col0:cols.stop - col0] = read
+        return values
+
+
+def write_tiles(path, grid, tiles, crs_wkt='', nodata=NODATA):
+    """
+    Stream (rows, cols, values) tiles into a single-band Float32 GeoTIFF, so the whole raster is never in memory.
+    Cells no tile covers are no data.
+    """
+    dataset = gdal.GetDriverByName('GTiff').Create(path, grid.ncols, grid.nrows, 1, gdal.GDT_Float32,
+                                                   ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER'])
+    if dataset is None:
+        raise IOError('Could not create raster {}'.format(path))
+    dataset.SetGeoTransform(grid.geotransform)
+    if crs_wkt:
+        dataset.SetProjection(crs_wkt)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.Fill(nodata)
+    for rows, cols, values in tiles:
+        band.WriteArray(np.where(np.isfinite(values), values, nodata).astype(np.float32), cols.start, rows.start)
+    band.FlushCache()
+    dataset = None
+    return path
+
+
+def write_stack(path, sources, descriptions=None, crs_wkt=''):
+    """
+    Write rasters as the bands of one Float32 GeoTIFF, on the union of their extents at the finest of their cell sizes.
+    Sources on another grid are resampled to it (nearest neighbour); cells a source does not cover are no data.
+    """
+    datasets = []
+    for source in sources:
+        datasets.append(gdal.Open(source))
+        if datasets[-1] is None:
+            raise IOError('Could not open raster {}'.format(source))
+    xmin, ymin, xmax, ymax, cellsize = np.inf, np.inf, -np.inf, -np.inf, np.inf
+    for dataset in datasets:
+        x0, xres, _, y0, _, yres = dataset.GetGeoTransform()
+        xmin = min(xmin, x0)
+        xmax = max(xmax, x0 + xres * dataset.RasterXSize)
+        ymax = max(ymax, y0)
+        ymin = min(ymin, y0 + yres * dataset.RasterYSize)
+        cellsize = min(cellsize, xres, -yres)
+    grid = Grid(xmin, ymax, cellsize, np.ceil((xmax - xmin) / cellsize - 1e-9), np.ceil((ymax - ymin) / cellsize - 1e-9))
+
+    stack = gdal.GetDriverByName('GTiff').Create(path, grid.ncols, grid.nrows, len(datasets), gdal.GDT_Float32,
+                                                 ['COMPRESS=LZW', 'TILED=YES', 'INTERLEAVE=BAND'])
+    if stack is None:
+        raise IOError('Could not create raster {}'.format(path))
+    stack.SetGeoTransform(grid.geotransform)
+    stack.SetProjection(crs_wkt or datasets[0].GetProjection())
+    for index, dataset in enumerate(datasets):
+        warped = gdal.Warp('', dataset, format='MEM', outputBounds=(grid.xmin, grid.ymin, grid.xmax, grid.ymax),
+                           width=grid.ncols, height=grid.nrows, resampleAlg='near', dstNodata=NODATA,
+                           outputType=gdal.GDT_Float32)
+        band = stack.GetRasterBand(index + 1)
+        band.SetNoDataValue(NODATA)
+        band.WriteArray(warped.GetRasterBand(1).ReadAsArray())
+        if descriptions:
+            band.SetDescription(descriptions[index])
+    stack = None
+    return path
+
+
+def _write_features(path, name, geometry_type, geometries, fields, crs_wkt):
+    """Write OGR geometries with double attributes (name -> (n,) array) to a vector file (GeoPackage by default)."""
+    driver = ogr.GetDriverByName('ESRI Shapefile' if path.lower().endswith('.shp') else 'GPKG')
+    vector = driver.CreateDataSource(path)
+    if vector is None:
+        raise IOError('Could not create {}'.format(path))
+    srs = osr.SpatialReference(crs_wkt) if crs_wkt else None
+    layer = vector.CreateLayer(name, srs, geometry_type)
+    for field in fields:
+        layer.CreateField(ogr.FieldDefn(field, ogr.OFTReal))
+    definition = layer.GetLayerDefn()
+    columns = [np.asarray(values, dtype=float) for values in fields.values()]
+    layer.StartTransaction()
+    for index, geometry in enumerate(geometries):
+        feature = ogr.Feature(definition)
+        feature.SetGeometry(geometry)
+        for field, column in zip(fields, columns):
+            feature.SetField(field, float(column[index]))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    vector = None
+    return path
+
+
+def _geometry(xy, geometry_type):
+    geometry = ogr.Geometry(geometry_type)
+    for x, y in xy:
+        geometry.AddPoint_2D(float(x), float(y))
+    return geometry
+
+
+def write_points(path, xy, fields=None, crs_wkt='', name='points'):
+    """Write points (an (n, 2) array) with one double attribute per entry of `fields` (name -> (n,) array)."""
+    points = []
+    for x, y in np.asarray(xy, dtype=float).reshape(-1, 2):
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(float(x), float(y))
+        points.append(point)
+    return _write_features(path, name, ogr.wkbPoint, points, fields or {}, crs_wkt)
+
+
+def write_lines(path, lines, crs_wkt='', name='lines'):
+    """Write one line feature per (n, 2) array."""
+    return _write_features(path, name, ogr.wkbLineString, [_geometry(line, ogr.wkbLineString) for line in lines], {},
+                           crs_wkt)
+
+
+def write_polygons(path, polygons, crs_wkt='', name='polygons'):
+    """Write one polygon feature per list of closed rings (exterior first)."""
+    geometries = []
+    for rings in polygons:
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        for ring in rings:
+            polygon.AddGeometry(_geometry(ring, ogr.wkbLinearRing))
+        geometries.append(polygon)
+    return _write_features(path, name, ogr.wkbPolygon, geometries, {}, crs_wkt)
+
+
+def polygonize(path, grid, mask, crs_wkt=''):
+    """Write the True cells of a mask as polygons to a vector file (format from the extension, GeoPackage by default)."""
+    raster = gdal.GetDriverByName('MEM').Create('', grid.ncols, grid.nrows, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform(grid.geotransform)
+    band = raster.GetRasterBand(1)
+    band.WriteArray(mask.astype(np.uint8))
+    driver = ogr.GetDriverByName('ESRI Shapefile' if path.lower().endswith('.shp') else 'GPKG')
+    vector = driver.CreateDataSource(path)
+    srs = osr.SpatialReference(crs_wkt) if crs_wkt else None
+    layer = vector.CreateLayer('footprint', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+    gdal.Polygonize(band, band, layer, 0)
+    vector = None
+    return path
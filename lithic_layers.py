@@ -0,0 +1,75 @@
+"""
+Conversion between QGIS vector layers and the coordinate arrays used by lithic_arrays.
+"""
+import numpy as np
+from qgis.core import QgsFeatureRequest
+from qgis.core import QgsMapLayer
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingUtils
+
+
+def as_layer(value, context):
+    """A layer object for a child algorithm output, which may be a layer, a layer id or a file path."""
+    if isinstance(value, QgsMapLayer):
+        return value
+    layer = QgsProcessingUtils.mapLayerFromString(value, context)
+    if layer is None:
+        raise QgsProcessingException('Could not load layer {}'.format(value))
+    return layer
+
+
+def line_parts(layer):
+    """Every line part of the layer as an (n, 2) array."""
+    lines = []
+    for feature in layer.getFeatures():
+        geometry = feature.geometry()
+        if geometry.isEmpty():
+            continue
+        parts = geometry.asMultiPolyline() if geometry.isMultipart() else [geometry.asPolyline()]
+        lines.extend(np.array([(p.x(), p.y()) for p in part]) for part in parts if len(part) > 1)
+    return lines
+
+
+def polygon_parts(layer):
+    """Every polygon part of the layer as a list of closed (n, 2) ring arrays, exterior first."""
+    polygons = []
+    for feature in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+        geometry = feature.geometry()
+        if geometry.isEmpty():
+            continue
+        parts = geometry.asMultiPolygon() if geometry.isMultipart() else [geometry.asPolygon()]
+        polygons.extend([np.array([(p.x(), p.y()) for p in ring]) for ring in part if len(ring) > 2]
+                        for part in parts)
+    return [rings for rings in polygons if rings]
+
+
+def point_coordinates(layer):
+    """Point coordinates of the layer as an (n, 2) array."""
+    xy = []
+    for feature in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+        geometry = feature.geometry()
+        if geometry.isEmpty():
+            continue
+        points = geometry.asMultiPoint() if geometry.isMultipart() else [geometry.asPoint()]
+        xy.extend((point.x(), point.y()) for point in points)
+    return np.array(xy, dtype=float).reshape(-1, 2)
+
+
+def point_values(layer, field):
+    """Point coordinates as an (n, 2) array and the numeric `field` as an (n,) array, skipping NULL values."""
+    request = QgsFeatureRequest().setSubsetOfAttributes([field], layer.fields())
+    xy = []
+    values = []
+    for feature in layer.getFeatures(request):
+        geometry = feature.geometry()
+        try:
+            value = float(feature[field])
+        except (TypeError, ValueError):
+            continue
+        if geometry.isEmpty():
+            continue
+        points = geometry.asMultiPoint() if geometry.isMultipart() else [geometry.asPoint()]
+        for point in points:
+            xy.append((point.x(), point.y()))
+            values.append(value)
+    return np.array(xy, dtype=float).reshape(-1, 2), np.array(values, dtype=float)
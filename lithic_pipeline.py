@@ -0,0 +1,449 @@
+"""
+Run a processing model as a dependency graph of child algorithms.
+
+A step names the outputs it consumes with Ref(step, key) instead of reading them from an `outputs` dict, so the
+graph knows which steps are independent (the DORSAL and VENTRAL branches of EdgeFromProjection04, for instance).
+With more than one thread, ready steps run concurrently on worker threads, each in its own processing context that
+is handed back to the calling thread with the layers it made; algorithms flagged as not thread safe run on the calling
+thread.  A shared tracker turns the progress of the running steps into overall progress for the model.
+
+In memory mode the temporary outputs of intermediate steps stay off disk: vector outputs of in-process algorithms are
+memory layers, raster outputs read only in-process are in GDAL's /vsimem, and whatever an external tool (SAGA, the
+GDAL utilities) writes or reads goes to a RAM-backed folder, as do the vector and array files of stages, which the
+step cache can store where it could not store memory layers.  Plain copies made with gdal:translate become VRTs that
+reference their source instead of copying its pixels.  Only the model's destinations are written to disk.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from qgis.core import QgsApplication, QgsMapLayer, QgsProcessing, QgsProcessingAlgorithm, QgsProcessingContext
+from qgis.core import QgsProcessingFeedback, QgsProcessingUtils
+from qgis.PyQt.QtCore import QThread
+import processing
+
+from lithic_cache import Uncacheable
+
+# Providers whose algorithms run in the QGIS process, and so can write memory layers and read /vsimem rasters.
+IN_PROCESS_PROVIDERS = ('native', 'qgis')
+# Raster formats that reference their source rather than copy it, for algorithms that only rename or re-tag a raster.
+REFERENCE_FORMATS = {'gdal:translate': 'vrt'}
+
+
+def memory_folder():
+    """
+    Folder for memory mode intermediates that external tools read or write as files: LITHICS_MEMORY_DIR, else
+    /dev/shm (RAM-backed on Linux), else the processing temporary folder.
+    """
+    folder = os.environ.get('LITHICS_MEMORY_DIR')
+    if folder:
+        return folder
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return QgsProcessingUtils.tempFolder()
+
+
+class Ref:
+    """The `key` output of step `step`, used as a child algorithm parameter value."""
+
+    def __init__(self, step, key='OUTPUT'):
+        self.step = step
+        self.key = key
+
+    def __repr__(self):
+        return 'Ref({!r}, {!r})'.format(self.step, self.key)
+
+
+def _refs(value):
+    if isinstance(value, Ref):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _refs(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _refs(item)
+
+
+def _resolve(value, outputs):
+    if isinstance(value, Ref):
+        return outputs[value.step][value.key]
+    if isinstance(value, list):
+        return [_resolve(item, outputs) for item in value]
+    if isinstance(value, dict):
+        return {key: _resolve(item, outputs) for key, item in value.items()}
+    return value
+
+
+class Step:
+
+    def __init__(self, name, algorithm, params, result=None):
+        self.name = name
+        self.algorithm = algorithm
+        self.params = params
+        # (model output name, child output key) when this step writes one of the model's destinations.
+        self.result = result
+        self.dependencies = {ref.step for ref in _refs(params)}
+
+    @property
+    def in_process(self):
+        return self.algorithm.split(':')[0] in IN_PROCESS_PROVIDERS
+
+    @property
+    def thread_safe(self):
+        """Whether the algorithm may run outside the calling thread (it is not flagged FlagNoThreading)."""
+        algorithm = QgsApplication.processingRegistry().algorithmById(self.algorithm)
+        return algorithm is None or not algorithm.flags() & QgsProcessingAlgorithm.FlagNoThreading
+
+    def destination(self, key):
+        """(kind, default extension) of output `key`, kind being 'vector', 'raster' or None for other outputs."""
+        algorithm = QgsApplication.processingRegistry().algorithmById(self.algorithm)
+        definition = algorithm.parameterDefinition(key) if algorithm is not None else None
+        if definition is None or not definition.isDestination():
+            return None, None
+        kind = {'vectorDestination': 'vector', 'sink': 'vector', 'rasterDestination': 'raster'}.get(definition.type())
+        return kind, definition.defaultFileExtension()
+
+    def run(self, params, context, feedback):
+        return processing.run(self.algorithm, params, context=context, feedback=feedback, is_child_algorithm=True)
+
+
+class Stage(Step):
+    """
+    A step computed in-process by `function(params, context, feedback)`, which returns an outputs dict.
+
+    Outputs given as TEMPORARY_OUTPUT get a file name: a GeoTIFF, unless the function's `destinations` attribute maps
+    the output to another (kind, extension), such as ('vector', 'gpkg') or ('array', 'npy').
+    """
+
+    def __init__(self, name, function, params, result=None):
+        super().__init__(name, '{}.{}'.format(function.__module__, function.__name__), params, result)
+        self.function = function
+
+    @property
+    def in_process(self):
+        return True
+
+    @property
+    def thread_safe(self):
+        return True
+
+    def destination(self, key):
+        return getattr(self.function, 'destinations', {}).get(key, ('raster', 'tif'))
+
+    def run(self, params, context, feedback):
+        return self.function(params, context, feedback)
+
+
+class _Intermediates:
+    """Destinations for the temporary outputs of intermediate steps, and their removal after the run."""
+
+    def __init__(self, graph, memory):
+        self.graph = graph
+        self.memory = memory
+        self.folder = None
+        self.vsimem = '/vsimem/lithics_{}'.format(uuid.uuid4().hex)
+        self.layers = {}
+        self.lock = threading.Lock()
+
+    def _file(self, key, extension):
+        with self.lock:
+            if self.folder is None:
+                self.folder = tempfile.mkdtemp(prefix='lithics_', dir=memory_folder())
+        # A folder per output keeps the file named after the output, as TEMPORARY_OUTPUT does: some steps take field
+        # names from layer names.
+        return os.path.join(tempfile.mkdtemp(dir=self.folder), '{}.{}'.format(key, extension))
+
+    def destination(self, step, key):
+        kind, extension = step.destination(key)
+        if not self.memory:
+            # Processing algorithms resolve TEMPORARY_OUTPUT themselves; stages need a file name.
+            if isinstance(step, Stage):
+                return QgsProcessingUtils.generateTempFilename('{}.{}'.format(key, extension))
+            return QgsProcessing.TEMPORARY_OUTPUT
+        if kind is None:
+            return QgsProcessing.TEMPORARY_OUTPUT
+        # Stages write their vector outputs as files, which the step cache can store, unlike memory layers.
+        if kind == 'vector' and step.in_process and not isinstance(step, Stage):
+            self.layers.setdefault(step.name, set()).add(key)
+            return 'memory:' + key
+        consumers = [other for other in self.graph.steps.values() if step.name in other.dependencies]
+        if kind == 'raster' and step.in_process and all(other.in_process for other in consumers):
+            return '{}/{}/{}.tif'.format(self.vsimem, step.name, key)
+        if kind == 'raster':
+            extension = REFERENCE_FORMATS.get(step.algorithm, extension)
+        return self._file(key, extension)
+
+    def resolve(self, step, params):
+        """`params` with the TEMPORARY_OUTPUT destinations of an intermediate step replaced."""
+        if step.result:
+            # The model's own destinations are left to processing, except that a stage needs a file name for a result
+            # given as TEMPORARY_OUTPUT; it goes to the processing temporary folder, which outlives the run.
+            if isinstance(step, Stage):
+                return {key: QgsProcessingUtils.generateTempFilename('{}.{}'.format(key, step.destination(key)[1]))
+                        if value == QgsProcessing.TEMPORARY_OUTPUT else value for key, value in params.items()}
+            return params
+        return {key: self.destination(step, key) if value == QgsProcessing.TEMPORARY_OUTPUT else value
+                for key, value in params.items()}
+
+    def outputs(self, step, output, context):
+        """
+        The outputs of a finished step, with memory layer ids replaced by the layers: a step running in another
+        processing context could not look them up.
+        """
+        keys = self.layers.get(step.name)
+        if not keys:
+            return output
+        return {key: QgsProcessingUtils.mapLayerFromString(value, context) or value if key in keys else value
+                for key, value in output.items()}
+
+    def remove(self):
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+        if self.memory:
+            from osgeo import gdal
+            gdal.RmdirRecursive(self.vsimem)
+
+
+class _StepFeedback(QgsProcessingFeedback):
+    """
+    Feedback for one step: forwards messages to the model feedback, reports progress to the tracker and is canceled
+    with the model feedback.
+    """
+
+    def __init__(self, name, tracker):
+        super().__init__()
+        self.name = name
+        self.tracker = tracker
+        self.progressChanged.connect(self._progress)
+        tracker.feedback.canceled.connect(self.cancel)
+        if tracker.feedback.isCanceled():
+            self.cancel()
+
+    def _progress(self, progress):
+        self.tracker.update(self.name, progress / 100)
+
+    def setProgressText(self, text):
+        self.tracker.feedback.setProgressText('{}: {}'.format(self.name, text))
+
+    def pushInfo(self, info):
+        self.tracker.feedback.pushInfo(info)
+
+    def pushWarning(self, warning):
+        self.tracker.feedback.pushWarning('{}: {}'.format(self.name, warning))
+
+    def pushCommandInfo(self, info):
+        self.tracker.feedback.pushCommandInfo(info)
+
+    def pushDebugInfo(self, info):
+        self.tracker.feedback.pushDebugInfo(info)
+
+    def pushConsoleInfo(self, info):
+        self.tracker.feedback.pushConsoleInfo(info)
+
+    def reportError(self, error, fatalError=False):
+        self.tracker.feedback.reportError('{}: {}'.format(self.name, error), fatalError)
+
+
+class _ProgressTracker:
+    """Overall progress is the mean completion of all steps, whichever order they finish in."""
+
+    def __init__(self, feedback, total):
+        self.feedback = feedback
+        self.total = max(total, 1)
+        self.fractions = {}
+        self.lock = threading.Lock()
+
+    def update(self, name, fraction):
+        with self.lock:
+            self.fractions[name] = min(max(fraction, 0.0), 1.0)
+            progress = 100 * sum(self.fractions.values()) / self.total
+        self.feedback.setProgress(progress)
+
+
+class ModelGraph:
+    """
+    Child algorithms of a model and the data flow between them.
+
+    Steps must be added after the steps they reference, so the graph is acyclic by construction.  With `memory`,
+    intermediate outputs stay off disk (see the module docstring).
+    """
+
+    def __init__(self, memory=False):
+        self.steps = {}
+        self.memory = memory
+        # Cache key of each step, filled in when running with a cache.
+        self.keys = {}
+
+    def add(self, name, algorithm, params, result=None):
+        return self._add(Step(name, algorithm, params, (result, 'OUTPUT') if isinstance(result, str) else result))
+
+    def add_stage(self, name, function, params, result=None):
+        return self._add(Stage(name, function, params, (result, 'OUTPUT') if isinstance(result, str) else result))
+
+    def _add(self, step):
+        name = step.name
+        missing = step.dependencies - self.steps.keys()
+        if missing:
+            raise ValueError('Step {} refers to unknown step(s) {}'.format(name, ', '.join(sorted(missing))))
+        if name in self.steps:
+            raise ValueError('Duplicate step name {}'.format(name))
+        self.steps[name] = step
+        return step
+
+    def _plan(self, context, cache):
+        """
+        Cached outputs to reuse and the steps that still have to run.
+
+        A step runs if it writes a model result or feeds a step that runs, and its outputs are not in the cache.  Steps
+        that feed no model result, such as the branch of a destination that was not requested, never run.
+        """
+        cached = {}
+        if cache is not None:
+            def canonical(value, keys):
+                if isinstance(value, Ref):
+                    if keys[value.step] is None:
+                        raise Uncacheable(value.step)
+                    return {'step': keys[value.step], 'output': value.key}
+                if isinstance(value, list):
+                    return [canonical(item, keys) for item in value]
+                if isinstance(value, dict):
+                    return {key: canonical(item, keys) for key, item in value.items()}
+                return cache.fingerprint(value, context)
+
+            keys = {}
+            for step in self.steps.values():
+                try:
+                    keys[step.name] = cache.key(step.algorithm, canonical(step.params, keys))
+                except Uncacheable:
+                    # A layer the cache cannot hash, read here or upstream: the step always runs.
+                    keys[step.name] = None
+                    continue
+                if step.result is None:
+                    output = cache.get(keys[step.name])
+                    if output is not None:
+                        cached[step.name] = output
+            self.keys = keys
+
+        needed = self._needed(cached)
+        return cached, [step for step in self.steps.values() if step.name in needed]
+
+    def _needed(self, cached=()):
+        """Names of the steps that write a model result or feed one, through steps not in `cached`."""
+        needed = set()
+        for step in reversed(list(self.steps.values())):
+            if step.name in cached:
+                continue
+            if step.result or any(step.name in self.steps[other].dependencies for other in needed):
+                needed.add(step.name)
+        return needed
+
+    def run(self, context, feedback, threads=1, cache=None, profiler=None):
+        """
+        Run every step, `threads` at a time, and return the model results.
+
+        Only the steps that feed a model result run, so a model leaves out the branches of unrequested destinations
+        by not giving them a result.  With a lithic_cache.StepCache, steps whose outputs are cached are not run again,
+        nor are the steps that only feed them, and new outputs are added to the cache.  With a
+        lithic_profile.StepProfiler, every step that runs is measured and the profile is logged to `feedback`.
+        """
+        tracker = _ProgressTracker(feedback, len(self.steps))
+        intermediates = _Intermediates(self, self.memory)
+        if profiler is not None:
+            profiler.start(threads)
+        cached, plan = self._plan(context, cache)
+        outputs = dict(cached)
+        results = {}
+        planned = {step.name for step in plan}
+        for name in self.steps:
+            if name not in planned:
+                tracker.update(name, 1.0)
+        needed = self._needed()
+        unused = [name for name in self.steps if name not in needed]
+        if unused:
+            feedback.pushInfo('Skipping {}, not needed for the requested outputs'.format(', '.join(unused)))
+        if cached:
+            feedback.pushInfo('Reusing cached outputs of {}'.format(', '.join(cached)))
+            if profiler is not None:
+                for name in cached:
+                    profiler.cached(self.steps[name])
+
+        def run_step(step, params, step_context, step_feedback):
+            params = intermediates.resolve(step, params)
+            if profiler is None:
+                return step.run(params, step_context, step_feedback)
+            return profiler.run(step, params, step_context, step_feedback)
+
+        home = QThread.currentThread()
+
+        def run_threaded(step, params, step_feedback):
+            # Processing contexts are not thread safe, so each concurrent step gets its own, made on the pool thread
+            # that runs it.  The context, with the layers in its store, and any layers a stage returns are handed
+            # back to the calling thread before the step finishes, so the model context can take them over.
+            step_context = QgsProcessingContext()
+            step_context.copyThreadSafeSettings(context)
+            try:
+                output = run_step(step, params, step_context, step_feedback)
+            finally:
+                step_context.pushToThread(home)
+            for value in output.values():
+                if isinstance(value, QgsMapLayer):
+                    value.moveToThread(home)
+            return output, step_context
+
+        def finish(step, output):
+            output = intermediates.outputs(step, output, context)
+            outputs[step.name] = output
+            tracker.update(step.name, 1.0)
+            if step.result:
+                results[step.result[0]] = output[step.result[1]]
+            elif cache is not None and self.keys[step.name] is not None:
+                cache.put(self.keys[step.name], output)
+
+        try:
+            if threads <= 1:
+                for step in plan:
+                    if feedback.isCanceled():
+                        return {}
+                    step_feedback = _StepFeedback(step.name, tracker)
+                    finish(step, run_step(step, _resolve(step.params, outputs), context, step_feedback))
+                return results
+
+            remaining = {step.name: step for step in plan}
+            running = {}
+            with ThreadPoolExecutor(threads) as pool:
+                while remaining or running:
+                    if feedback.isCanceled():
+                        for future, (step, step_feedback) in running.items():
+                            step_feedback.cancel()
+                        wait(running)
+                        return {}
+                    ready = [s for s in remaining.values() if s.dependencies <= outputs.keys()]
+                    # Pool steps first, so they run while a step that needs this thread does.
+                    for step in sorted(ready, key=lambda s: not s.thread_safe):
+                        del remaining[step.name]
+                        step_feedback = _StepFeedback(step.name, tracker)
+                        if not step.thread_safe:
+                            # Algorithms flagged FlagNoThreading run here, in the model context, while the pool goes on.
+                            finish(step, run_step(step, _resolve(step.params, outputs), context, step_feedback))
+                            continue
+                        future = pool.submit(run_threaded, step, _resolve(step.params, outputs), step_feedback)
+                        running[future] = (step, step_feedback)
+                    if not running:
+                        continue
+                    finished, _ = wait(running, timeout=0.5, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        step, step_feedback = running.pop(future)
+                        output, step_context = future.result()
+                        context.takeResultsFrom(step_context)
+                        finish(step, output)
+            return results
+        finally:
+            if cache is not None:
+                cache.save()
+            if profiler is not None:
+                profiler.finish(feedback)
+            intermediates.remove()
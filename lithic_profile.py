@@ -0,0 +1,234 @@
+"""
+Opt-in profiling of model steps.
+
+A StepProfiler handed to ModelGraph.run measures every step it runs, including steps that fail: wall time, CPU time of
+the process and of the child processes it waited for (saga_cmd, gdal_grid...), peak resident memory, the features or
+pixels going in and out, and the bytes of the temporary files it wrote, in the processing temporary folder, in the
+memory mode folder or in /vsimem.  Each step is logged to the model feedback as it finishes, the slowest steps are
+summarised at the end, and write() saves the whole report as JSON.
+
+CPU times and peak memory are process-wide figures, so that the worker threads of a step (the IDW blocks, for
+instance) count towards it.  With one step at a time they belong to that step (on Linux the peak is reset before each
+step); with concurrent steps they are shared among the steps that overlap, so profile with one thread for exact
+per-step numbers.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+from lithic_cache import _file_set
+
+_PROC_STATUS = '/proc/self/status'
+_PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+
+def _windows_peak_rss():
+    import ctypes
+    from ctypes import wintypes
+
+    class Counters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    counters = Counters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes (since the last reset_peak_rss on Linux), or None."""
+    try:
+        with open(_PROC_STATUS) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if sys.platform == 'win32':
+        return _windows_peak_rss()
+    return None
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory to the current one, where the system allows it (Linux).  Returns True if reset."""
+    try:
+        with open(_PROC_CLEAR_REFS, 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def _child_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _count(value, context, counts):
+    """Add the features, pixels or array items behind a parameter or output value to `counts`."""
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            _count(item, context, counts)
+        return
+    if isinstance(value, dict):
+        for item in value.values():
+            _count(item, context, counts)
+        return
+    if isinstance(value, np.ndarray):
+        counts['items'] = counts.get('items', 0) + len(value)
+        return
+    from qgis.core import QgsMapLayer, QgsProcessingUtils, QgsRasterLayer, QgsVectorLayer
+    layer = value if isinstance(value, QgsMapLayer) else None
+    if layer is None and isinstance(value, str) and value:
+        layer = QgsProcessingUtils.mapLayerFromString(value, context)
+    if isinstance(layer, QgsVectorLayer):
+        counts['features'] = counts.get('features', 0) + max(layer.featureCount(), 0)
+    elif isinstance(layer, QgsRasterLayer):
+        counts['pixels'] = counts.get('pixels', 0) + layer.width() * layer.height() * layer.bandCount()
+
+
+def _vsimem_bytes(path):
+    """Bytes of a /vsimem file and its sidecars."""
+    from osgeo import gdal
+    folder, name = path.rsplit('/', 1)
+    stem = os.path.splitext(name)[0]
+    size = 0
+    for member in gdal.ReadDir(folder) or []:
+        if member == name or member.startswith(stem + '.'):
+            stat = gdal.VSIStatL('{}/{}'.format(folder, member))
+            size += stat.size if stat is not None else 0
+    return size
+
+
+def _temp_bytes(outputs):
+    """Bytes of the output files in the processing temporary folder, the memory mode folder or /vsimem."""
+    from qgis.core import QgsProcessingUtils
+    from lithic_pipeline import memory_folder
+    folders = {os.path.normcase(os.path.abspath(folder)) + os.sep
+               for folder in (QgsProcessingUtils.tempFolder(), memory_folder())}
+    files = set()
+    size = 0
+    for value in outputs.values():
+        if not isinstance(value, str):
+            continue
+        path = value.split('|')[0]
+        if path.startswith('/vsimem/'):
+            size += _vsimem_bytes(path)
+        elif os.path.isfile(path) and os.path.normcase(os.path.abspath(path)).startswith(tuple(folders)):
+            files.update(_file_set(path))
+    return size + sum(os.path.getsize(path) for path in files)
+
+
+def _megabytes(size):
+    return 'n/a' if size is None else '{:.1f} MB'.format(size / 1048576)
+
+
+def _counts_text(counts):
+    return ', '.join('{} {}'.format(number, kind) for kind, number in sorted(counts.items())) or 'nothing counted'
+
+
+class StepProfiler:
+
+    def __init__(self, model):
+        self.model = model
+        self.records = []
+        self.threads = 1
+        self.wall = 0.0
+        self.lock = threading.Lock()
+        self._start = None
+
+    def start(self, threads=1):
+        self.threads = threads
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def measure(self, name, algorithm, params, context, feedback):
+        """
+        Measure the block as step `name`.  The block stores the step's outputs dict in the yielded record's 'outputs';
+        their sizes are counted after the timings are taken.  A block that raises is recorded with its 'error'.
+        """
+        inputs = {}
+        _count(params, context, inputs)
+        exclusive = self.threads <= 1 and reset_peak_rss()
+        record = {'step': name, 'algorithm': algorithm, 'cached': False, 'inputs': inputs, 'outputs': None,
+                  'error': None}
+        child_cpu = _child_cpu()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = str(e) or type(e).__name__
+            raise
+        finally:
+            record['wall'] = time.perf_counter() - start
+            record['cpu'] = time.process_time() - cpu
+            record['child cpu'] = _child_cpu() - child_cpu
+            record['peak rss'] = peak_rss()
+            record['peak rss exclusive'] = exclusive
+            outputs = record['outputs'] or {}
+            record['outputs'] = {}
+            _count(outputs, context, record['outputs'])
+            record['temp bytes'] = _temp_bytes(outputs)
+            with self.lock:
+                self.records.append(record)
+            feedback.pushInfo('Profile {}: {}{:.3f} s wall, {:.3f} s CPU + {:.3f} s child CPU, peak RSS {}, in: {}, '
+                              'out: {}, {} temporary files'.format(
+                                  name, 'failed after ' if record['error'] is not None else '', record['wall'],
+                                  record['cpu'], record['child cpu'], _megabytes(record['peak rss']),
+                                  _counts_text(inputs), _counts_text(record['outputs']),
+                                  _megabytes(record['temp bytes'])))
+
+    def run(self, step, params, context, feedback):
+        """step.run(params, context, feedback), measured."""
+        with self.measure(step.name, step.algorithm, params, context, feedback) as record:
+            record['outputs'] = step.run(params, context, feedback)
+        return record['outputs']
+
+    def cached(self, step):
+        """Record a step whose outputs came from the cache."""
+        with self.lock:
+            self.records.append({'step': step.name, 'algorithm': step.algorithm, 'cached': True})
+
+    def finish(self, feedback, slowest=5):
+        """Log the total and the slowest steps."""
+        self.wall = time.perf_counter() - self._start if self._start is not None else 0.0
+        measured = sorted((record for record in self.records if not record['cached']), key=lambda r: -r['wall'])
+        total = sum(record['wall'] for record in measured)
+        feedback.pushInfo('Profile {}: {:.3f} s wall for {} steps ({} cached), {} thread(s)'.format(
+            self.model, self.wall, len(measured), len(self.records) - len(measured), self.threads))
+        for record in measured[:slowest]:
+            feedback.pushInfo('  {:<40} {:8.3f} s  {:5.1%}'.format(record['step'], record['wall'],
+                                                                  record['wall'] / total if total else 0.0))
+
+    def report(self):
+        return {'model': self.model, 'threads': self.threads, 'wall': self.wall, 'steps': self.records}
+
+    def write(self, path):
+        """Write the report as JSON.  Returns the path."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        return path
@@ -0,0 +1,174 @@
+"""
+Columnar store for wear profile tables in the layout of MB_all_wear.csv.
+
+    python lithic_store.py MB_all_wear.csv MB_all_wear.store
+
+A store is a folder with one sub-folder per microblade and set, mb=<mb>/set=<set>, holding one .npy file per column:
+measures as float32, row names as int32 and the categoricals (RghtLft, SECTION, position) as uint8 codes into
+dictionaries kept in store.json.  mb, set and src are constant within a partition, so they are kept in store.json
+rather than on every row.  The loader memory-maps only the partitions and columns it is asked for, so reading one blade
+or one set does not touch the rest of the store.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+MEASURES = ['POS_mm', 'volume', 'volume D', 'volume V', 'index', 'index D', 'index V']
+CATEGORIES = ['RghtLft', 'SECTION', 'position']
+PARTITION = ['mb', 'set', 'src']
+# The unnamed first column of the CSV (R's row names).
+ROW = 'row'
+COLUMNS = [ROW] + MEASURES + CATEGORIES + PARTITION
+META = 'store.json'
+
+
+def read_csv(path):
+    """A wear profile CSV as a dict of column arrays: float64 measures, int set and row names, str categoricals."""
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        records = list(reader)
+    table = {}
+    for index, name in enumerate(header):
+        values = [record[index] for record in records]
+        if name == '':
+            table[ROW] = np.array([int(value) for value in values], dtype=np.int64)
+        elif name in MEASURES:
+            table[name] = np.array([float(value) if value not in ('', 'NA') else np.nan for value in values])
+        elif name == 'set':
+            table[name] = np.array([int(value) for value in values], dtype=np.int64)
+        else:
+            table[name] = np.array(values, dtype=object)
+    return table
+
+
+def _file(name):
+    return name.replace(' ', '_') + '.npy'
+
+
+class WearStore:
+
+    def __init__(self, folder):
+        self.folder = folder
+        try:
+            with open(os.path.join(folder, META)) as f:
+                meta = json.load(f)
+        except IOError:
+            meta = {'version': 1, 'dictionaries': {name: [] for name in CATEGORIES}, 'partitions': []}
+        self.dictionaries = meta['dictionaries']
+        self.partitions = meta['partitions']
+
+    def _folder(self, partition):
+        return os.path.join(self.folder, 'mb={}'.format(partition['mb']), 'set={}'.format(partition['set']))
+
+    def _save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        staging = os.path.join(self.folder, META + '.tmp')
+        with open(staging, 'w') as f:
+            json.dump({'version': 1, 'dictionaries': self.dictionaries, 'partitions': self.partitions}, f, indent=1)
+        os.replace(staging, os.path.join(self.folder, META))
+
+    def encode(self, name, values):
+        """Dictionary codes of categorical values; new categories are added to the end of the dictionary."""
+        dictionary = self.dictionaries[name]
+        categories, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        lookup = {category: code for code, category in enumerate(dictionary)}
+        for category in categories:
+            if category not in lookup:
+                lookup[category] = len(dictionary)
+                dictionary.append(str(category))
+        if len(dictionary) > 256:
+            raise ValueError('More than 256 categories in {}'.format(name))
+        return np.array([lookup[category] for category in categories], dtype=np.uint8)[inverse]
+
+    def select(self, mbs=None, sets=None):
+        """Partitions of the given microblade(s) and set(s), each a single value or a list; None selects all."""
+        mbs = None if mbs is None else {mbs} if isinstance(mbs, str) else set(mbs)
+        sets = None if sets is None else {sets} if isinstance(sets, (int, np.integer)) else set(sets)
+        return [partition for partition in self.partitions
+                if (mbs is None or partition['mb'] in mbs) and (sets is None or partition['set'] in sets)]
+
+    def append(self, table):
+        """
+        Add rows (a dict of column arrays, as read_csv returns) to the store.  Rows are grouped by mb and set; each
+        affected partition is rewritten, the others are left alone.  Returns the affected partitions.
+        """
+        keys = np.array(['{}\0{}'.format(mb, number) for mb, number in zip(table['mb'], table['set'])])
+        affected = []
+        for key in np.unique(keys):
+            rows = np.nonzero(keys == key)[0]
+            mb, number = key.split('\0')
+            number = int(number)
+            columns = {ROW: table[ROW][rows].astype(np.int32)}
+            columns.update((name, table[name][rows].astype(np.float32)) for name in MEASURES)
+            columns.update((name, self.encode(name, table[name][rows])) for name in CATEGORIES)
+
+            existing = self.select(mb, number)
+            if existing:
+                partition = existing[0]
+                old = self._read(partition, columns, mmap=False)
+                columns = {name: np.concatenate([old[name], values]) for name, values in columns.items()}
+            else:
+                partition = {'mb': mb, 'set': number, 'src': str(table['src'][rows[0]]), 'rows': 0}
+                self.partitions.append(partition)
+            folder = self._folder(partition)
+            os.makedirs(folder, exist_ok=True)
+            for name, values in columns.items():
+                staging = os.path.join(folder, _file(name) + '.tmp')
+                with open(staging, 'wb') as f:
+                    np.save(f, values)
+                os.replace(staging, os.path.join(folder, _file(name)))
+            partition['rows'] = len(columns[ROW])
+            affected.append(partition)
+        self._save()
+        return affected
+
+    def _read(self, partition, columns, mmap=True):
+        folder = self._folder(partition)
+        return {name: np.load(os.path.join(folder, _file(name)), mmap_mode='r' if mmap else None)
+                for name in columns if name not in PARTITION}
+
+    def load(self, mbs=None, sets=None, columns=None, decode=True, mmap=True):
+        """
+        Columns of the selected partitions.  Measures are float32; categoricals are decoded to str arrays, or left as
+        uint8 codes into self.dictionaries with decode False.  A single partition's columns are memory-mapped.
+        """
+        columns = COLUMNS if columns is None else columns
+        partitions = self.select(mbs, sets)
+        parts = [self._read(partition, columns, mmap) for partition in partitions]
+        table = {}
+        for name in columns:
+            if name in PARTITION:
+                values = [np.full(partition['rows'], partition[name], dtype=int if name == 'set' else object)
+                          for partition in partitions]
+            else:
+                values = [part[name] for part in parts]
+            if len(values) == 1:
+                table[name] = values[0]
+            elif values:
+                table[name] = np.concatenate(values)
+            else:
+                table[name] = np.empty(0, dtype=np.uint8 if name in CATEGORIES else object)
+            if decode and name in CATEGORIES:
+                table[name] = np.array(self.dictionaries[name], dtype=object)[np.asarray(table[name], dtype=int)]
+        return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('csv', nargs='+', help='wear profile CSV file(s) to add')
+    parser.add_argument('store', help='store folder (created if missing)')
+    args = parser.parse_args(argv)
+    store = WearStore(args.store)
+    for path in args.csv:
+        affected = store.append(read_csv(path))
+        print('{}: {} partition(s) updated'.format(path, len(affected)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+In-process stages for TrendSurface.
+
+Each stage has the signature lithic_pipeline.Stage expects, function(params, context, feedback) -> outputs, so it can
+stand in for one or more child algorithms in the model graph.  The array work itself is in lithic_arrays.
+"""
+import numpy as np
+from qgis.core import QgsProcessingException
+
+import lithic_arrays
+import lithic_io
+import lithic_layers
+
+
+def _perimeter_values(params, context, rings):
+    """
+    Perimeter samples and their IDW values, per ring, and the CRS as WKT.
+
+    With SURFACE (the IDW raster) the samples read it; otherwise the IDW of the POINTS layer's FIELD is evaluated at
+    the samples only, on the grid the IDW raster would have had (CELLSIZE, buffered by BUFFER).
+    """
+    if params.get('SURFACE'):
+        grid, surface = lithic_io.read_raster(params['SURFACE'])
+        samples = [lithic_arrays.densify_line(ring, params['SPACING']) for ring in rings]
+        return samples, [grid.sample(surface, ring) for ring in samples], lithic_io.raster_crs(params['SURFACE'])
+    points = lithic_layers.as_layer(params['POINTS'], context)
+    xy, z = lithic_layers.point_values(points, params['FIELD'])
+    if not len(z):
+        raise QgsProcessingException('The points layer has no points with a numeric {} value'.format(params['FIELD']))
+    idw = lithic_arrays.IdwInterpolator(xy, z)
+    grid = lithic_arrays.buffered_grid(rings, params['CELLSIZE'], params.get('BUFFER', 0.1))
+    samples, values = lithic_arrays.perimeter_samples(rings, idw, grid, params['SPACING'])
+    return samples, values, points.crs().toWkt()
+
+
+def perimeter_samples_stage(params, context, feedback):
+    """
+    IDW of the surface points at the perimeter samples, as a point layer with the values in FIELD.
+
+    PERIMETER is the perimeter line layer, POINTS the surface points, SPACING the sample interval along the perimeter
+    and CELLSIZE the cell size of the IDW raster it stands in for.  OUTPUT is a point file.  Replaces IDW, translate,
+    convert lines to points and add raster values to points when the IDW raster itself is not wanted.
+    """
+    perimeter = lithic_layers.as_layer(params['PERIMETER'], context)
+    rings = [lithic_arrays.close_ring(line) for line in lithic_layers.line_parts(perimeter)]
+    samples, values, _ = _perimeter_values(params, context, rings)
+    xy, z = np.vstack(samples), np.concatenate(values)
+    keep = np.isfinite(z)
+    feedback.pushInfo('IDW at {} perimeter samples'.format(keep.sum()))
+    return {'OUTPUT': lithic_io.write_points(params['OUTPUT'], xy[keep], {params['FIELD']: z[keep]},
+                                            perimeter.crs().toWkt(), 'samples')}
+
+
+perimeter_samples_stage.destinations = {'OUTPUT': ('vector', 'gpkg')}
+
+
+def trend_stage(params, context, feedback):
+    """
+    Z0 "trend" surface inside the perimeter from the IDW surface sampled along it.
+
+    PERIMETER is the perimeter line layer, SURFACE the IDW raster, SPACING the sample interval along the perimeter,
+    CELLSIZE the output cell size and METHOD a lithic_arrays.TREND_METHODS entry.  Without SURFACE, the IDW of the
+    POINTS layer's FIELD is evaluated at the perimeter samples only.  Replaces convert lines to points, add raster
+    values to points, natural neighbour and the clip to the perimeter polygon; only the cells inside the perimeter
+    are interpolated.
+    """
+    perimeter = lithic_layers.as_layer(params['PERIMETER'], context)
+    rings = [lithic_arrays.close_ring(line) for line in lithic_layers.line_parts(perimeter)]
+    samples, values, crs = _perimeter_values(params, context, rings)
+    trend_grid, trend = lithic_arrays.trend_from_samples(rings, samples, values, params['CELLSIZE'], params['METHOD'])
+    trend_grid, trend = lithic_arrays.clip_to_polygons(trend_grid, trend, rings)
+    feedback.pushInfo('{} trend surface over {} cells from {} perimeter samples'.format(
+        params['METHOD'].capitalize(), np.isfinite(trend).sum(), sum(len(ring) for ring in samples)))
+    return {'OUTPUT': lithic_io.write_raster(params['OUTPUT'], trend_grid, trend, crs)}
@@ -0,0 +1,332 @@
+"""
+Warm worker: a long-lived headless QGIS that runs EdgeFromProjection04 and TrendSurface jobs as they arrive.
+
+    python lithic_worker.py serve --socket 127.0.0.1:8765
+    python lithic_worker.py serve --queue jobs
+    python lithic_worker.py submit job.json --socket 127.0.0.1:8765
+    python lithic_worker.py submit job.json --queue jobs
+
+Starting QGIS, the processing framework and its GDAL/SAGA providers takes seconds; a worker pays that once and then
+runs any number of jobs.  A job is the JSON a lithic_batch job is made of:
+
+    {
+        "name": "MB11-2 trend dorsal",
+        "algorithm": "TrendSurface",
+        "parameters": {"perimeter": "/data/MB11-2/perimeter.shp", "points": "/data/MB11-2/dorsal_pts.shp",
+                       "zfield": "Z", "Trend": "/data/out/MB11-2/dorsal_trend.tif"},
+        "folder": "/data/out/MB11-2"
+    }
+
+Paths should be absolute, as the worker may run elsewhere.  "folder", if given, is created before the job runs.  Each
+job's intermediate files go to a temporary folder of its own in the worker's folder under --temp (the system temp
+folder by default), emptied when the job ends, so a worker that runs for weeks does not fill the disk.  The reply is
+the job's lithic_batch summary record: "status" ('ok' or 'failed'), "outputs" (the output paths), "seconds" (the run
+time), "wait" (time spent queued) and "error" for a failed job.
+
+With --socket the worker listens on a local TCP port for newline-delimited JSON: one job per line, one reply per line.
+There is no authentication, so the worker only binds to a loopback address unless --allow-remote is given.
+{"command": "ping"} replies with the worker's startup time and job count, {"command": "stop"} stops it.  Jobs run one
+at a time in the worker's main thread, as QGIS wants; start one worker per port to run jobs concurrently.
+
+With --queue the worker watches a folder.  A job dropped into <queue>/incoming as a .json file is claimed by moving it
+to the worker's own folder in <queue>/running, <host>-<pid> (a rename, so several workers can share a queue), and its
+reply is written to <queue>/done under the same name.  Jobs are taken in name order; submit names them by time.  A
+worker that starts replies to the jobs left in running by workers of its host that are gone, as failed: they may be
+what killed their worker, so they are not run again.  A file named STOP in the queue folder stops the workers.
+"""
+import argparse
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+if HERE not in sys.path:
+    sys.path.insert(0, HERE)
+import lithic_batch
+
+QUEUE_FOLDERS = ('incoming', 'running', 'done')
+
+
+def parse_address(text):
+    """'host:port' or 'port' -> (host, port), on the local host by default."""
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def is_loopback(host):
+    """Whether every address `host` resolves to is a loopback address."""
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split('%')[0]).is_loopback for address in addresses)
+
+
+class Worker:
+    """A started QGIS and the jobs it has run."""
+
+    def __init__(self, temp=None, log=print):
+        self.temp = temp
+        if temp:
+            os.makedirs(temp, exist_ok=True)
+        self.log = log
+        start = time.perf_counter()
+        lithic_batch._init_worker(temp_root=temp)
+        self.startup = time.perf_counter() - start
+        self.jobs = 0
+        log('QGIS and the lithic algorithms started in {:.1f} s'.format(self.startup))
+
+    def run(self, job, queued=None):
+        """
+        Run one job queued at time `queued` (time.time()).  Returns its summary record; failures are reported in the
+        record, not raised.
+        """
+        wait = max(time.time() - queued, 0.0) if queued is not None else 0.0
+        job = dict(job)
+        job.setdefault('name', '{} {}'.format(job.get('algorithm'), self.jobs + 1))
+        record = {'job': job['name'], 'status': 'failed', 'wait': wait}
+        if job.get('algorithm') not in lithic_batch.SCRIPTS:
+            record['error'] = 'unknown algorithm {!r}, expected one of {}'.format(
+                job.get('algorithm'), ', '.join(lithic_batch.SCRIPTS))
+            return record
+        self.jobs += 1
+        try:
+            record.update(lithic_batch.run_job(job), status='ok')
+        except Exception as e:
+            record['error'] = str(e)
+        if record['status'] == 'ok':
+            self.log('{} ok in {:.1f} s'.format(job['name'], record['seconds']))
+        else:
+            self.log('{} FAILED: {}'.format(job['name'], record['error']))
+        return record
+
+    def ping(self):
+        return {'status': 'ok', 'startup': self.startup, 'jobs': self.jobs, 'pid': os.getpid()}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            received = time.time()
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line)
+            except ValueError as e:
+                reply = {'status': 'failed', 'error': 'not JSON: {}'.format(e)}
+            else:
+                command = message.get('command', 'run')
+                if command == 'ping':
+                    reply = self.server.worker.ping()
+                elif command == 'stop':
+                    reply = {'status': 'ok'}
+                    self.server.stopping = True
+                else:
+                    reply = self.server.worker.run(message, received)
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+            self.wfile.flush()
+            if self.server.stopping:
+                return
+
+
+class _Server(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, address, worker):
+        super().__init__(address, _Handler)
+        self.worker = worker
+        self.stopping = False
+
+
+def serve_socket(worker, address, allow_remote=False):
+    """
+    Answer jobs on a local TCP socket until a stop command.  Anyone who can reach the socket can run jobs, so only
+    loopback addresses are accepted unless `allow_remote`.
+    """
+    if not allow_remote and not is_loopback(address[0]):
+        raise ValueError('{} is not a loopback address; the worker has no authentication, pass --allow-remote to '
+                         'listen on it anyway'.format(address[0]))
+    with _Server(address, worker) as server:
+        worker.log('Listening on {}:{}'.format(*server.server_address))
+        while not server.stopping:
+            server.handle_request()
+
+
+def _alive(pid):
+    """Whether a process `pid` is running on this host."""
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows.
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _recover(queue, log=print):
+    """
+    Reply, as failed, to the jobs left in the running folders of this host's workers that are no longer running, and
+    remove their folders.  Folders of other hosts are left to their own workers.  Returns the number of jobs.
+    """
+    host = socket.gethostname()
+    count = 0
+    for owner in os.listdir(os.path.join(queue, 'running')):
+        folder = os.path.join(queue, 'running', owner)
+        worker_host, _, pid = owner.rpartition('-')
+        if not os.path.isdir(folder) or worker_host != host or not pid.isdigit():
+            continue
+        # A folder with this process's id is a stopped worker's whose id was reused.
+        if int(pid) != os.getpid() and _alive(int(pid)):
+            continue
+        for name in os.listdir(folder):
+            if name.endswith('.json'):
+                _write_json(os.path.join(queue, 'done', name), {
+                    'job': os.path.splitext(name)[0], 'status': 'failed',
+                    'error': 'worker {} stopped while running the job'.format(owner)})
+                count += 1
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)
+    if count:
+        log('{} job(s) left running by stopped workers replied to as failed'.format(count))
+    return count
+
+
+def _claim(queue, running_folder):
+    """Move the first job in the incoming folder, in name order, to `running_folder`.  Returns its path, or None."""
+    incoming = os.path.join(queue, 'incoming')
+    for name in sorted(name for name in os.listdir(incoming) if name.endswith('.json')):
+        running = os.path.join(running_folder, name)
+        try:
+            os.rename(os.path.join(incoming, name), running)
+        except OSError:
+            # Another worker claimed it first.
+            continue
+        return running
+    return None
+
+
+def serve_queue(worker, queue, poll=0.5):
+    """Run the jobs dropped into a queue folder until a STOP file appears."""
+    for folder in QUEUE_FOLDERS:
+        os.makedirs(os.path.join(queue, folder), exist_ok=True)
+    _recover(queue, worker.log)
+    running_folder = os.path.join(queue, 'running', '{}-{}'.format(socket.gethostname(), os.getpid()))
+    os.makedirs(running_folder, exist_ok=True)
+    worker.log('Watching {}'.format(os.path.join(queue, 'incoming')))
+    while not os.path.exists(os.path.join(queue, 'STOP')):
+        running = _claim(queue, running_folder)
+        if running is None:
+            time.sleep(poll)
+            continue
+        # Renaming keeps the modification time, which is when the job was dropped.
+        queued = os.path.getmtime(running)
+        name = os.path.basename(running)
+        try:
+            with open(running) as f:
+                job = json.load(f)
+        except ValueError as e:
+            record = {'job': name, 'status': 'failed', 'error': 'not JSON: {}'.format(e)}
+        else:
+            job.setdefault('name', os.path.splitext(name)[0])
+            record = worker.run(job, queued)
+        _write_json(os.path.join(queue, 'done', name), record)
+        os.remove(running)
+    os.rmdir(running_folder)
+
+
+def _write_json(path, value):
+    # Written next to the target and renamed, so readers (and workers, which only claim .json files) never see a
+    # partial file.
+    temp = path + '.part'
+    with open(temp, 'w') as f:
+        json.dump(value, f, indent=2)
+    os.replace(temp, path)
+
+
+def submit_socket(job, address, timeout=None):
+    """Send one job (or command) to a socket worker and return its reply."""
+    with socket.create_connection(address, timeout=timeout) as connection:
+        connection.sendall((json.dumps(job) + '\n').encode())
+        with connection.makefile('rb') as replies:
+            return json.loads(replies.readline())
+
+
+def submit_queue(job, queue, name=None, timeout=None, poll=0.5):
+    """Drop one job into a queue folder and wait for its reply (None after `timeout` seconds)."""
+    name = name or '{}_{}.json'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+    incoming = os.path.join(queue, 'incoming')
+    done = os.path.join(queue, 'done', name)
+    os.makedirs(incoming, exist_ok=True)
+    _write_json(os.path.join(incoming, name), job)
+    start = time.perf_counter()
+    while not os.path.exists(done):
+        if timeout is not None and time.perf_counter() - start > timeout:
+            return None
+        time.sleep(poll)
+    with open(done) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='start a worker')
+    submit = commands.add_parser('submit', help='send a job to a worker and print its reply')
+    submit.add_argument('job', help='job JSON file, or "ping" / "stop" for a socket worker')
+    submit.add_argument('--timeout', type=float, default=None, help='seconds to wait for the reply')
+    for command in (serve, submit):
+        where = command.add_mutually_exclusive_group(required=True)
+        where.add_argument('--socket', type=parse_address, help='[host:]port of a local TCP socket')
+        where.add_argument('--queue', help='queue folder')
+    serve.add_argument('--temp', help="folder for the jobs' temporary folders (default: the system temp folder)")
+    serve.add_argument('--allow-remote', action='store_true',
+                       help='listen on a non-loopback address; the socket has no authentication')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        if args.socket and not args.allow_remote and not is_loopback(args.socket[0]):
+            parser.error('{} is not a loopback address; pass --allow-remote to listen on it'.format(args.socket[0]))
+        worker = Worker(args.temp)
+        if args.socket:
+            serve_socket(worker, args.socket, args.allow_remote)
+        else:
+            serve_queue(worker, args.queue)
+        return 0
+
+    if args.job in ('ping', 'stop'):
+        if not args.socket:
+            parser.error('{} needs --socket; stop a queue worker with a STOP file'.format(args.job))
+        job = {'command': args.job}
+    else:
+        with open(args.job) as f:
+            job = json.load(f)
+    if args.socket:
+        reply = submit_socket(job, args.socket, args.timeout)
+    else:
+        reply = submit_queue(job, args.queue, timeout=args.timeout)
+    if reply is None:
+        print('no reply within {:g} s'.format(args.timeout))
+        return 1
+    print(json.dumps(reply, indent=2))
+    return 0 if reply.get('status') == 'ok' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+"""
+Shared fixtures: one small synthetic microblade (benchmarks/synthetic.py) and the clipped surface the infill works on.
+
+The tests need only NumPy and SciPy; nothing here imports QGIS or GDAL.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [ROOT, os.path.join(ROOT, 'benchmarks')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+import lithic_arrays
+import run_benchmarks
+import synthetic
+
+LENGTH = 8.0
+
+
+@pytest.fixture(scope='session')
+def data():
+    return synthetic.specimen(LENGTH, 0.3 * LENGTH, 0.02, points=int(10000 * LENGTH),
+                              surface_points=int(1000 * LENGTH), seed=0)
+
+
+@pytest.fixture(scope='session')
+def clipped(data):
+    """The worn dorsal surface clipped along the edge line EdgeFromProjection04 finds, and its Z=0 edge points."""
+    peaks, _ = lithic_arrays.density_peaks(data['projected'])
+    line, _ = lithic_arrays.polar_edge(peaks, lithic_arrays.line_centroid([data['perimeter']]))
+    return run_benchmarks.clipped_surface(data, line)
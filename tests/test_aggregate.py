@@ -0,0 +1,99 @@
+"""wear_agg against a group-by-group reference, and WearAggregate against wear_agg."""
+import numpy as np
+import pytest
+
+import lithic_aggregate
+import lithic_arrays
+import run_benchmarks
+
+
+@pytest.fixture(scope='module')
+def table(data):
+    faces = [(data['grid'], data['dorsal'], data['dorsal reconstruction']),
+             (data['grid'], data['ventral'], data['ventral reconstruction'])]
+    profile = lithic_arrays.wear_profile(faces, data['perimeter'], data['platform'][:-1].mean(axis=0))
+    table = run_benchmarks.wear_table(profile)
+    # Three blades of three sets each are enough, and keep the group-by-group reference quick.
+    keep = np.isin(table['mb'], ['MB1', 'MB2', 'MB3']) & (table['set'] <= 3)
+    table = {key: values[keep] for key, values in table.items()}
+    # A few missing values, which every statistic skips.
+    table['index D'][::97] = np.nan
+    return table
+
+
+def reference_stats(table):
+    keys = sorted(set(zip(np.asarray(table['src']).tolist(), np.asarray(table['position']).tolist())))
+    out = {'src': [src for src, _ in keys], 'position': [position for _, position in keys]}
+    for measure in lithic_aggregate.VOLUMES + lithic_aggregate.INDICES:
+        values = np.asarray(table[measure], dtype=float)
+        for stat, function in [('sum', np.nansum), ('mean', np.nanmean), ('median', np.nanmedian),
+                               ('max', np.nanmax)]:
+            out['{} {}'.format(measure, stat)] = np.array([
+                function(values[(table['src'] == src) & (table['position'] == position)]) for src, position in keys])
+    return out
+
+
+def assert_tables_equal(actual, expected):
+    assert list(actual) == list(expected)
+    for column, values in expected.items():
+        if np.asarray(values).dtype.kind in 'fi':
+            np.testing.assert_allclose(actual[column], values, rtol=1e-12, err_msg=column)
+        else:
+            np.testing.assert_array_equal(np.asarray(actual[column]).astype(str), np.asarray(values).astype(str),
+                                          err_msg=column)
+
+
+def test_aggregate_matches_reference(table):
+    stats = lithic_aggregate.aggregate(table)
+    expected = reference_stats(table)
+    for column, values in expected.items():
+        if column in ['src', 'position']:
+            np.testing.assert_array_equal(stats[column].astype(str), values)
+        else:
+            np.testing.assert_allclose(stats[column], values, rtol=1e-12, err_msg=column)
+
+
+def test_wear_agg_volume_shares(table):
+    result = lithic_aggregate.wear_agg(table)
+    for src in np.unique(result['src']):
+        rows = result['src'] == src
+        np.testing.assert_allclose(result['vol.sum'][rows], result['volume'][rows].sum(), rtol=1e-12)
+    assert (result['vol.pct'] <= 100).all()
+    np.testing.assert_array_equal(result['CSD'], result['set'] * lithic_aggregate.CSD_PER_SET)
+
+
+def test_wear_aggregate_chunks_match_wear_agg(table, tmp_path):
+    expected = lithic_aggregate.wear_agg(table)
+    rows = len(table['src'])
+    # Chunks that split blades between them, added to two aggregates that are then merged.
+    edges = [0, rows // 3 + 5, rows // 2, 2 * rows // 3 + 11, rows]
+    first, second = lithic_aggregate.WearAggregate(), lithic_aggregate.WearAggregate()
+    for number, (start, stop) in enumerate(zip(edges[:-1], edges[1:])):
+        (first if number % 2 else second).add({key: values[start:stop] for key, values in table.items()})
+    first.merge(second)
+    assert_tables_equal(first.table(), expected)
+
+    first.save(str(tmp_path / 'aggregate.npz'))
+    loaded = lithic_aggregate.WearAggregate.load(str(tmp_path / 'aggregate.npz'))
+    assert_tables_equal(loaded.table(), expected)
+    progression = lithic_aggregate.progression(expected['MB'], expected['set'], expected['volume'])
+    assert_tables_equal(loaded.progression(), progression)
+
+
+def test_wear_aggregate_skips_rows_it_has(table, tmp_path):
+    expected = lithic_aggregate.wear_agg(table)
+    rows = len(table['src'])
+    aggregate = lithic_aggregate.WearAggregate()
+    # A source added again, first whole and then after more rows were appended to it: only the new rows count.
+    aggregate.add({key: values[:rows // 2] for key, values in table.items()}, 'wear.csv')
+    aggregate.add({key: values[:rows // 2] for key, values in table.items()}, 'wear.csv')
+    aggregate.save(str(tmp_path / 'aggregate.npz'))
+    aggregate = lithic_aggregate.WearAggregate.load(str(tmp_path / 'aggregate.npz'))
+    assert aggregate.add(table, 'wear.csv')
+    assert aggregate.add(table, 'wear.csv') == []
+    assert_tables_equal(aggregate.table(), expected)
+
+    other = lithic_aggregate.WearAggregate()
+    other.add(table, 'wear.csv')
+    with pytest.raises(ValueError):
+        aggregate.merge(other)
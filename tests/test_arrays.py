@@ -0,0 +1,177 @@
+"""The array engines against brute-force references and against each other (tiled against whole, mask against alpha)."""
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import spsolve
+
+import lithic_arrays
+
+ALPHA = 0.275
+
+
+def assemble(grid, tiles):
+    values = np.full(grid.shape, np.nan)
+    for rows, cols, block in tiles:
+        values[rows, cols] = block
+    return values
+
+
+def brute_idw(xy, z, targets, power=1.5, max_points=20, radius=1000.0):
+    distance = np.hypot(targets[:, None, 0] - xy[None, :, 0], targets[:, None, 1] - xy[None, :, 1])
+    out = np.full(len(targets), np.nan)
+    for index, row in enumerate(distance):
+        nearest = np.argsort(row, kind='stable')[:max_points]
+        nearest = nearest[row[nearest] <= radius]
+        if not len(nearest):
+            continue
+        if row[nearest[0]] == 0:
+            out[index] = z[nearest[0]]
+            continue
+        weights = row[nearest] ** -power
+        out[index] = (weights * z[nearest]).sum() / weights.sum()
+    return out
+
+
+def test_idw_matches_brute_force(data):
+    xy, z = data['surface xy'], data['surface z']
+    rng = np.random.default_rng(1)
+    targets = np.vstack([rng.uniform(xy.min(axis=0) - 0.5, xy.max(axis=0) + 0.5, (500, 2)), xy[:20]])
+    for radius in [1000.0, 0.1]:
+        estimate = lithic_arrays.IdwInterpolator(xy, z, radius=radius, block=128, workers=2)(targets)
+        np.testing.assert_allclose(estimate, brute_idw(xy, z, targets, radius=radius), rtol=1e-15, atol=1e-15)
+
+
+def test_idw_grid_matches_targets(data):
+    idw = lithic_arrays.IdwInterpolator(data['surface xy'], data['surface z'], block=1000)
+    grid = lithic_arrays.buffered_grid([lithic_arrays.close_ring(data['perimeter'])], 0.1)
+    np.testing.assert_array_equal(idw.grid(grid).ravel(), idw(grid.centres()))
+
+
+def test_idw_without_points():
+    idw = lithic_arrays.IdwInterpolator(np.empty((0, 2)), [])
+    assert np.isnan(idw(np.zeros((3, 2)))).all()
+
+
+def brute_contains(polygons, xy):
+    inside = np.zeros(len(xy), dtype=bool)
+    for rings in polygons:
+        crossings = np.zeros(len(xy), dtype=int)
+        for ring in rings:
+            for (x0, y0), (x1, y1) in zip(ring[:-1], ring[1:]):
+                for index, (x, y) in enumerate(xy):
+                    if (y0 <= y) != (y1 <= y) and x0 + (y - y0) * (x1 - x0) / (y1 - y0) > x:
+                        crossings[index] += 1
+        inside |= crossings % 2 == 1
+    return inside
+
+
+def test_polygon_index_matches_brute_force(data):
+    hole = np.array([[-0.3, 3.0], [0.3, 3.0], [0.3, 4.0], [-0.3, 4.0], [-0.3, 3.0]])
+    polygons = [[data['perimeter'], hole], [data['platform']]]
+    rng = np.random.default_rng(2)
+    xmin, ymin, xmax, ymax = lithic_arrays.bounds([data['perimeter'], data['platform']])
+    xy = np.vstack([rng.uniform([xmin - 0.5, ymin - 0.5], [xmax + 0.5, ymax + 0.5], (2000, 2)), data['perimeter'][::7]])
+    np.testing.assert_array_equal(lithic_arrays.PolygonIndex(polygons).contains(xy), brute_contains(polygons, xy))
+
+
+def direct_harmonic(grid, inside, xy, z):
+    """Laplace's equation over the inside cells, solved directly, with harmonic_fill's boundary cells and stencil."""
+    rows, cols, on_grid = grid.cell_index(xy)
+    cell = rows[on_grid] * grid.ncols + cols[on_grid]
+    size = grid.nrows * grid.ncols
+    counts = np.bincount(cell, minlength=size)
+    fixed = counts > 0
+    boundary = np.zeros(size)
+    boundary[fixed] = np.bincount(cell, z[on_grid], size)[fixed] / counts[fixed]
+    free = inside.ravel() & ~fixed
+    number = np.full(size, -1)
+    number[free] = np.arange(free.sum())
+    matrix_rows, matrix_cols, entries = [], [], []
+    b = np.zeros(free.sum())
+    for index in np.flatnonzero(free):
+        row, col = divmod(index, grid.ncols)
+        for r, c in [(row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)]:
+            if not (0 <= r < grid.nrows and 0 <= c < grid.ncols):
+                continue
+            neighbour = r * grid.ncols + c
+            if free[neighbour]:
+                matrix_rows += [number[index], number[index]]
+                matrix_cols += [number[index], number[neighbour]]
+                entries += [1.0, -1.0]
+            elif fixed[neighbour]:
+                matrix_rows.append(number[index])
+                matrix_cols.append(number[index])
+                entries.append(1.0)
+                b[number[index]] += boundary[neighbour]
+    matrix = coo_matrix((entries, (matrix_rows, matrix_cols)), shape=(len(b), len(b))).tocsr()
+    out = np.where(fixed, boundary, np.nan)
+    out[free] = spsolve(matrix, b)
+    return out.reshape(grid.shape)
+
+
+def test_harmonic_fill_matches_direct_solve(data):
+    ring = lithic_arrays.close_ring(data['perimeter'])
+    grid = lithic_arrays.Grid.fit_nodes(*lithic_arrays.bounds([ring]), 0.05)
+    inside = lithic_arrays.rasterize_polygons([ring], grid)
+    xy = lithic_arrays.densify_line(ring, 0.025)
+    z = np.sin(xy[:, 0] * 2) + 0.1 * xy[:, 1]
+    # A small coarsest level, so the multigrid V-cycle has a few levels.
+    filled = lithic_arrays.harmonic_fill(grid, inside, xy, z, tolerance=1e-12, coarsest=200)
+    np.testing.assert_allclose(filled, direct_harmonic(grid, inside, xy, z), rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('method', lithic_arrays.TREND_METHODS)
+def test_trend_surface_tiles_match_whole(data, method):
+    perimeter = [data['perimeter']]
+    # The surface points sit on the DEM's cell centres, so a cell centre often has several points at the same distance
+    # and which one is the last of the nearest 20 turns on the last bit of its coordinates.  Tiles compute their cell
+    # centres from their own corner; jittered points keep the neighbours the same either way.
+    xy = data['surface xy'] + np.random.default_rng(3).normal(0, 1e-4, data['surface xy'].shape)
+    idw_grid, idw, trend_grid, trend = lithic_arrays.trend_surface(perimeter, xy, data['surface z'], method=method)
+    tile_idw_grid, idw_tiles, tile_trend_grid, trend_tiles = lithic_arrays.trend_surface_tiles(
+        perimeter, xy, data['surface z'], tile=64, method=method)
+    assert tile_idw_grid.geotransform == idw_grid.geotransform and tile_idw_grid.shape == idw_grid.shape
+    assert tile_trend_grid.geotransform == trend_grid.geotransform and tile_trend_grid.shape == trend_grid.shape
+    np.testing.assert_allclose(assemble(tile_idw_grid, idw_tiles), idw, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(assemble(tile_trend_grid, trend_tiles), trend, rtol=0, atol=1e-12)
+
+
+def test_trend_surface_without_idw_raster(data):
+    perimeter = [data['perimeter']]
+    _, _, trend_grid, trend = lithic_arrays.trend_surface(perimeter, data['surface xy'], data['surface z'])
+    none, _, only_grid, only = lithic_arrays.trend_surface(perimeter, data['surface xy'], data['surface z'],
+                                                           idw_raster=False)
+    assert none is None and only_grid.geotransform == trend_grid.geotransform
+    np.testing.assert_array_equal(only, trend)
+
+
+def test_infill_tiles_match_whole(data, clipped):
+    surface, xy, z = clipped
+    grid = data['grid']
+    filled_grid, filled = lithic_arrays.infill(grid, surface, xy, z, ALPHA)
+
+    def read(block):
+        values = np.full(block.shape, np.nan)
+        rows, cols, inside = grid.cell_index(block.centres())
+        values.ravel()[inside] = surface[rows[inside], cols[inside]]
+        return values
+
+    tile_grid, tiles = lithic_arrays.infill_tiles(read, grid, xy, z, ALPHA, tile=64)
+    assert tile_grid.geotransform == filled_grid.geotransform and tile_grid.shape == filled_grid.shape
+    np.testing.assert_allclose(assemble(tile_grid, tiles), filled, rtol=0, atol=1e-12)
+
+
+def test_infill_mask_matches_alpha(data, clipped):
+    surface, xy, z = clipped
+    _, alpha = lithic_arrays.infill(data['grid'], surface, xy, z, ALPHA)
+    _, mask = lithic_arrays.infill(data['grid'], surface, xy, z, ALPHA, 'mask')
+    np.testing.assert_allclose(mask, alpha, rtol=0, atol=1e-9)
+    assert np.isfinite(alpha).sum() > np.isfinite(surface).sum()
+
+
+def test_infill_keeps_known_cells(data, clipped):
+    surface, xy, z = clipped
+    grid, filled = lithic_arrays.infill(data['grid'], surface, xy, z, ALPHA)
+    rows, cols, _ = grid.cell_index(data['grid'].centres())
+    known = np.isfinite(surface).ravel()
+    np.testing.assert_array_equal(filled[rows[known], cols[known]], surface.ravel()[known])